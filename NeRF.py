@@ -2,12 +2,16 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional
-from hash_encoder import INGPHashEncoder, SHEncoder
+from hash_encoder import FrequencyEncoder, INGPHashEncoder, SHEncoder
 
 ReLUGain = math.sqrt(2)
 
 
 def MSRInitializer(Layer, ActivationGain=1.0):
+    if Layer.weight.is_meta:
+        # nothing to initialize, the weights are assigned later, e.g. by load_exported_model
+        return Layer
+
     FanIn = Layer.weight.data.size(1) * Layer.weight.data[0][0].numel()
     Layer.weight.data.normal_(0, ActivationGain / math.sqrt(FanIn))
 
@@ -30,13 +34,9 @@ def CreateEmbedding(EmbeddingType, L=10,
         return SphericalHarmonics, SphericalHarmonics.out_dim
 
     elif EmbeddingType == "pos":
-        def EmbeddingFunction(x):
-            FrequencyRepresentation = [x]  # ??? inconsistent with the paper
-            for y in range(L):
-                FrequencyRepresentation += [torch.sin(2 ** y * x), torch.cos(2 ** y * x)]
-            return torch.cat(FrequencyRepresentation, dim=1)
-
-        return EmbeddingFunction, 6 * L + 3
+        # the input itself is kept in the output, ??? inconsistent with the paper
+        FrequencyEmbedding = FrequencyEncoder(n_frequencies=L)
+        return FrequencyEmbedding, FrequencyEmbedding.output_dim
 
     return nn.Identity, 3
 
@@ -87,7 +87,8 @@ class NeRF(nn.Module):
                 # InputDimension += LightPosEmbeddingDim
                 RequiresAuxiliaryInput = False
             elif x in RequiresPositionEmbedding:
-                InputDimension = PositionEmbeddingDim + StemHiddenDim
+                # the skip input is the embedded position with the auxiliary params, as for the first layer
+                InputDimension = PositionEmbeddingDim + nAuxParams + StemHiddenDim
                 RequiresAuxiliaryInput = True
             else:
                 InputDimension = StemHiddenDim
@@ -124,7 +125,9 @@ class NeRF(nn.Module):
         # print(p)
         # if p.shape[0] == 0:
         #     print('NO SCENE PARAMS')
-        p = p.unsqueeze(0).expand(x.shape[0], -1)
+        if p.dim() < 2:
+            # one set of auxiliary params shared by every point
+            p = p.unsqueeze(0).expand(x.shape[0], -1)
         # p = self.LightPosEmbedding(p)
         # p = self.PositionEmbedding(p)
 
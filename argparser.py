@@ -31,12 +31,26 @@ def config_parser():
                         help='number of rays processed in parallel, decrease if running out of memory')
     parser.add_argument("--netchunk", type=int, default=1024 * 256,
                         help='number of pts sent through network in parallel, decrease if running out of memory')
+    parser.add_argument("--autotune", action='store_true',
+                        help='choose chunk and netchunk by probing throughput and memory at startup')
+    parser.add_argument("--mem_budget_mb", type=int, default=0,
+                        help='peak memory budget of a chunk for autotune, 0 uses half of the free memory')
+    parser.add_argument("--autotune_cache", type=str, default=None,
+                        help='autotune cache file, defaults to ~/.cache/nerf/autotune.json')
     parser.add_argument("--no_batching", action='store_true',
                         help='only take random rays from 1 image at a time')
     parser.add_argument("--no_reload", action='store_true',
                         help='do not reload weights from saved ckpt')
     parser.add_argument("--ft_path", type=str, default=None,
                         help='specific weights npy file to reload for coarse network')
+    parser.add_argument("--mixed_precision", type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='run the encoders and the MLP in reduced precision, with float32 master weights')
+    parser.add_argument("--compile", type=str, default='none', choices=['none', 'torch_compile', 'script'],
+                        help='compile the models and the ray rendering, falling back to eager code on failure')
+    parser.add_argument("--quantized_lookup", action='store_true',
+                        help='keep the hash tables of a compressed --ft_path quantized and dequantize them on lookup')
+    parser.add_argument("--morton_sort", action='store_true',
+                        help='sort the samples of each network chunk in Z-order before the hash table lookups')
 
     # rendering options
     parser.add_argument("--N_samples", type=int, default=64,
@@ -64,6 +78,40 @@ def config_parser():
                         help='render the test set instead of render_poses path')
     parser.add_argument("--render_factor", type=int, default=0,
                         help='downsampling factor to speed up rendering, set 4 or 8 for fast preview')
+    parser.add_argument("--writer_threads", type=int, default=4,
+                        help='number of threads encoding rendered PNGs in the background')
+    parser.add_argument("--quantize_int8", action='store_true',
+                        help='with render_only on the CPU, run the MLPs in int8 calibrated on the training views')
+    parser.add_argument("--render_batch_poses", type=int, default=1,
+                        help='number of poses whose rays are rendered together as one stream')
+    parser.add_argument("--render_tile", type=int, default=0,
+                        help='render frames in square tiles of this size to bound memory, 0 renders full frames')
+    parser.add_argument("--render_tile_memmap", action='store_true',
+                        help='stream tiled frames into memory-mapped .npy files next to the rendered images')
+    parser.add_argument("--render_workers", type=int, default=0,
+                        help='with render_only on the CPU, render frames (or tiles) in this many worker processes')
+    parser.add_argument("--render_worker_threads", type=int, default=0,
+                        help='number of intra-op threads of every render worker, 0 divides the cores between them')
+    parser.add_argument("--scenes", type=str, default=None,
+                        help='JSON file of named scenes with their ft_path and datadir, served from a model registry')
+    parser.add_argument("--render_scenes", type=str, nargs='+', default=None,
+                        help='with --render_only and --scenes, render these scenes in order, all scenes by default')
+    parser.add_argument("--registry_mem_mb", type=int, default=2048,
+                        help='memory budget of the scenes kept resident by the model registry')
+    parser.add_argument("--registry_prefetch", type=int, default=1,
+                        help='number of likely next scenes the model registry loads in the background')
+    parser.add_argument("--render_reproject", action='store_true',
+                        help='reuse the previous frame\'s depth when rendering camera paths')
+    parser.add_argument("--reproj_keyframe", type=int, default=10,
+                        help='render every N-th path frame in full to stop reprojection drift, 0 only renders the first frame in full')
+    parser.add_argument("--reproj_band", type=float, default=0.05,
+                        help='half width of the sampling band around the reprojected depth')
+    parser.add_argument("--reproj_samples", type=int, default=16,
+                        help='number of coarse samples per reprojected ray')
+    parser.add_argument("--reproj_importance", type=int, default=16,
+                        help='number of fine samples per reprojected ray')
+    parser.add_argument("--reproj_acc_thresh", type=float, default=0.95,
+                        help='minimal accumulated opacity for a pixel\'s depth to be reused')
 
     # training options
     parser.add_argument("--precrop_iters", type=int, default=0,
@@ -114,6 +162,32 @@ def config_parser():
                         help='frequency of testset saving')
     parser.add_argument("--i_video", type=int, default=10000,
                         help='frequency of render_poses video saving')
+    parser.add_argument("--profile", action='store_true',
+                        help='time the phases of every training step and log them to metrics.jsonl')
+    parser.add_argument("--i_metrics", type=int, default=100,
+                        help='number of training steps aggregated into a metrics.jsonl record')
+    parser.add_argument("--profile_trace_start", type=int, default=10,
+                        help='step at which the torch.profiler trace starts')
+    parser.add_argument("--profile_trace_steps", type=int, default=0,
+                        help='number of steps traced with torch.profiler when profiling, 0 disables tracing')
+    parser.add_argument("--detect_syncs", type=int, default=0,
+                        help='record the host syncs of the first N training steps (or of rendering with '
+                             'render_only) with their call sites in sync_report.json')
+    parser.add_argument("--i_val_rays", type=int, default=0,
+                        help='frequency of held-out random ray validation, 0 disables it')
+    parser.add_argument("--n_val_rays", type=int, default=4096,
+                        help='number of held-out rays sampled from the val (or test) views for validation')
+
+    parser.add_argument("--eval_worker", action='store_true',
+                        help='render test sets and videos in a background process while training continues')
+    parser.add_argument("--eval_threads", type=int, default=0,
+                        help='number of intra-op threads of the evaluation worker, 0 keeps the torch default')
+
+    # distributed training, see dist_train
+    parser.add_argument("--dist_nprocs", type=int, default=0,
+                        help='number of training processes dist_train starts on this host when not run by torchrun')
+    parser.add_argument("--dist_dense_tables", action='store_true',
+                        help='all-reduce the full hash table gradients instead of the touched rows')
 
     parser.add_argument("--finest_res", type=int, default=1024,
                         help='finest resolution for hashed embedding')
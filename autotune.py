@@ -0,0 +1,164 @@
+import json
+import math
+import os
+import platform
+
+import torch
+
+from bench_utils import PeakMemory, time_fn
+from nerf_utils import device
+from render import render
+
+# probed sizes, netchunk in points and chunk in rays
+NETCHUNK_SIZES = [2 ** k for k in range(12, 21)]
+CHUNK_SIZES = [2 ** k for k in range(8, 18)]
+
+
+def default_cache_path():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'nerf', 'autotune.json')
+
+
+def default_mem_budget():
+    """
+    Half of the free device memory on CUDA, or of the available RAM on CPU, in bytes.
+    """
+    if torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+        return free // 2
+    with open('/proc/meminfo') as fp:
+        meminfo = dict(line.split(':', 1) for line in fp)
+    return int(meminfo['MemAvailable'].split()[0]) * 1024 // 2
+
+
+def cache_key(args, mem_budget):
+    """
+    The machine and the options that change the cost of a ray or a point.
+
+    The default budget follows the free memory, which changes from run to run, so it enters the key rounded
+    down to a power of two MiB, while an explicit args.mem_budget_mb is kept as is.
+    """
+    machine = [platform.node(), platform.machine(), torch.__version__, torch.get_num_threads(),
+               torch.cuda.get_device_name() if torch.cuda.is_available() else platform.processor()]
+    budget_mb = args.mem_budget_mb if args.mem_budget_mb > 0 else 2 ** int(math.log2(max(mem_budget >> 20, 1)))
+    config = [args.i_embed, args.log2_hashmap_size, args.finest_res, args.netdepth, args.netwidth,
+              args.N_samples, args.N_importance, args.use_viewdirs, args.mixed_precision, args.compile,
+              args.morton_sort, budget_mb]
+    return json.dumps(machine + config)
+
+
+def probe(make_fn, sizes, mem_budget, max_time):
+    """
+    Measure the throughput of make_fn(size)() for growing sizes.
+
+    Probing stops at the first size exceeding mem_budget or running out of memory, and after the first
+    call taking longer than max_time seconds, since larger sizes rarely pay off past that point.
+    Memory grows linearly with the size, so the peak of a size is also extrapolated from the smaller sizes,
+    which covers buffers that a sampled RSS misses when the allocator reuses freed memory.
+
+    :return: list of dicts with the 'size', its 'throughput' in items/s and 'peak_bytes', of the sizes within budget.
+    """
+    results = []
+    bytes_per_item = 0.
+    for size in sizes:
+        try:
+            fn = make_fn(size)
+            with PeakMemory() as memory:
+                fn()
+            peak_bytes = max(memory.peak_bytes, bytes_per_item * size)
+            bytes_per_item = max(bytes_per_item, memory.peak_bytes / size)
+            if peak_bytes > mem_budget:
+                break
+            timing = time_fn(fn, warmup=0, repeats=2)
+        except (RuntimeError, MemoryError) as e:
+            if 'memory' not in str(e):
+                raise
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            break
+
+        results.append({'size': size, 'throughput': size / timing['median'], 'peak_bytes': peak_bytes})
+        print('  {:8d}: {:12.0f} /s  {:8.1f} MiB'.format(size, results[-1]['throughput'], peak_bytes / 2 ** 20))
+        if timing['median'] > max_time:
+            break
+    return results
+
+
+def best_size(results, sizes):
+    if not results:
+        print('  even the smallest size exceeds the memory budget, using', sizes[0])
+        return sizes[0]
+    return max(results, key=lambda result: result['throughput'])['size']
+
+
+def autotune(args, H, W, K, render_kwargs, n_aux=0, cache_path=None, max_time=2.):
+    """
+    Choose args.netchunk and args.chunk by probing the network and the renderer of render_kwargs.
+
+    netchunk is probed first with network_query_fn, which reads args.netchunk on every call, then chunk with
+    render() using the chosen netchunk. Both maximize throughput while keeping the peak memory of a call within
+    args.mem_budget_mb. Results are cached per machine and configuration, so later runs skip the probe.
+
+    :param args: The parsed arguments, args.chunk and args.netchunk are overwritten.
+    :param H: int. Height of the images, used for NDC rays.
+    :param W: int. Width of the images, used for NDC rays.
+    :param K: array of shape (3, 3). The intrinsic matrix of the camera
+    :param render_kwargs: The keyword arguments of render() for testing, including near and far.
+    :param n_aux: int. Number of auxiliary scene params of the model.
+    :param cache_path: str. JSON cache of the tuned sizes, see default_cache_path.
+    :param max_time: float. Sizes taking longer than this many seconds per call end the probe.
+    :return: chunk, netchunk
+    """
+    mem_budget = args.mem_budget_mb * 2 ** 20 if args.mem_budget_mb > 0 else default_mem_budget()
+    cache_path = cache_path or default_cache_path()
+    key = cache_key(args, mem_budget)
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as fp:
+            cache = json.load(fp)
+    if key in cache:
+        args.chunk, args.netchunk = cache[key]['chunk'], cache[key]['netchunk']
+        print('Autotune: cached chunk {} netchunk {}'.format(args.chunk, args.netchunk))
+        return args.chunk, args.netchunk
+
+    near, far = render_kwargs['near'], render_kwargs['far']
+    aux_scene_params = torch.full((n_aux,), .5)
+    n_samples = max(args.N_samples, 1)
+
+    def random_rays(n_rays):
+        # rays from a sphere around the origin through the scene
+        rays_o = torch.randn(n_rays, 3, device=device)
+        rays_o = rays_o / torch.norm(rays_o, dim=-1, keepdim=True) * (near + far) / 2
+        rays_d = -rays_o + 0.2 * torch.randn(n_rays, 3, device=device)
+        return rays_o, rays_d / torch.norm(rays_d, dim=-1, keepdim=True)
+
+    def make_network_fn(size):
+        n_rays = max(size // n_samples, 1)
+        rays_o, rays_d = random_rays(n_rays)
+        z_vals = torch.linspace(near, far, n_samples, device=device)
+        pts = rays_o[:, None] + rays_d[:, None] * z_vals[:, None]
+        args.netchunk = size
+        return lambda: render_kwargs['network_query_fn'](pts, rays_d, render_kwargs['network_fn'], aux_scene_params)
+
+    def make_render_fn(size):
+        rays = torch.stack(random_rays(size), 0)
+        return lambda: render(H, W, K, chunk=size, rays=rays, aux_scene_params=aux_scene_params,
+                              **render_kwargs)
+
+    with torch.no_grad():
+        print('Autotune: probing netchunk (points/s) within {:.0f} MiB'.format(mem_budget / 2 ** 20))
+        netchunk_results = probe(make_network_fn, NETCHUNK_SIZES, mem_budget, max_time)
+        args.netchunk = best_size(netchunk_results, NETCHUNK_SIZES)
+
+        print('Autotune: probing chunk (rays/s) with netchunk {}'.format(args.netchunk))
+        chunk_results = probe(make_render_fn, CHUNK_SIZES, mem_budget, max_time)
+        args.chunk = best_size(chunk_results, CHUNK_SIZES)
+    print('Autotune: chunk {} netchunk {}'.format(args.chunk, args.netchunk))
+
+    cache[key] = {'chunk': args.chunk, 'netchunk': args.netchunk,
+                  'netchunk_probe': netchunk_results, 'chunk_probe': chunk_results}
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, 'w') as fp:
+        json.dump(cache, fp, indent=2)
+
+    return args.chunk, args.netchunk
@@ -0,0 +1,209 @@
+import argparse
+
+import torch
+
+from argparser import config_parser
+from bench_utils import PeakMemory, compare, load_results, save_results, time_fn
+from hash_encoder import INGPHashEncoder, SHEncoder
+from NeRF import CreateEmbedding, NeRF
+from nerf_utils import device, get_rays, sample_pdf
+from render import raw2outputs
+from run_nerf import nerf_model_kwargs
+from utils import morton_codes
+
+BOUNDING_BOX = (torch.tensor([-1.5, -1.5, -1.5], device=device), torch.tensor([1.5, 1.5, 1.5], device=device))
+N_SAMPLES = 64
+
+
+def bounding_box(dtype):
+    # in the dtype of the kernel, a float32 box would promote reduced precision points to float32
+    return tuple(b.to(dtype) for b in BOUNDING_BOX)
+
+
+def unit_directions(n, dtype):
+    d = torch.randn(n, 3, dtype=dtype, device=device)
+    return d / torch.norm(d, dim=-1, keepdim=True)
+
+
+def points_in_box(n, dtype):
+    box_min, box_max = bounding_box(dtype)
+    return box_min + (box_max - box_min) * torch.rand(n, 3, dtype=dtype, device=device)
+
+
+def points_on_rays(n, dtype):
+    """
+    n points as run_network passes them, N_SAMPLES consecutive samples along each of n / N_SAMPLES random rays.
+    """
+    box_min, box_max = bounding_box(dtype)
+    n_rays = max(n // N_SAMPLES, 1)
+    rays_o = box_min + (box_max - box_min) * torch.rand(n_rays, 1, 3, dtype=dtype, device=device)
+    t = torch.linspace(0., 1., N_SAMPLES, dtype=dtype, device=device)[None, :, None]
+    return (rays_o + unit_directions(n_rays, dtype)[:, None] * t * (box_max - box_min)).reshape(-1, 3)[:n]
+
+
+# Each kernel takes a batch size and a dtype and returns the function to time and the number of items it
+# processes: points for the encoders and the network, rays for compositing and sampling, pixels for get_rays.
+
+def hash_encoder(n, dtype):
+    encoder = INGPHashEncoder(bounding_box(dtype)).to(device, dtype)
+    x = points_in_box(n, dtype)
+    return lambda: encoder(x), n
+
+
+def hash_encoder_rays(n, dtype):
+    encoder = INGPHashEncoder(bounding_box(dtype)).to(device, dtype)
+    x = points_on_rays(n, dtype)
+    return lambda: encoder(x), n
+
+
+def hash_encoder_morton(n, dtype):
+    encoder = INGPHashEncoder(bounding_box(dtype), morton_sort=True).to(device, dtype)
+    x = points_on_rays(n, dtype)
+    return lambda: encoder(x), n
+
+
+def morton_sort(n, dtype):
+    # the overhead of hash_encoder_morton over hash_encoder_rays: codes, sort and the two permutations
+    x = points_on_rays(n, dtype)
+    features = torch.empty(n, 32, dtype=dtype, device=device)
+
+    def fn():
+        order = torch.argsort(morton_codes(x, bounding_box(dtype)))
+        inverse = torch.empty_like(order)
+        inverse[order] = torch.arange(n, device=device)
+        return features[inverse], x[order]
+
+    return fn, n
+
+
+def sh_encoder(n, dtype):
+    encoder = SHEncoder().to(device, dtype)
+    d = unit_directions(n, dtype)
+    return lambda: encoder(d), n
+
+
+def pos_embedding(n, dtype):
+    embed, _ = CreateEmbedding('pos', L=10)
+    embed = embed.to(device, dtype)
+    x = points_in_box(n, dtype)
+    return lambda: embed(x), n
+
+
+def nerf_forward(n, dtype):
+    model = NeRF(**nerf_model_kwargs(config_parser().parse_args([]), bounding_box(dtype))).to(device, dtype)
+    x, d = points_in_box(n, dtype), unit_directions(n, dtype)
+    p = torch.rand(n, 1, dtype=dtype, device=device)
+    return lambda: model(x, d, p), n
+
+
+def raw2outputs_kernel(n, dtype):
+    n_rays = max(n // N_SAMPLES, 1)
+    raw = torch.randn(n_rays, N_SAMPLES, 4, dtype=dtype, device=device)
+    z_vals = torch.sort(torch.rand(n_rays, N_SAMPLES, dtype=dtype, device=device), -1)[0] * 4. + 2.
+    rays_d = unit_directions(n_rays, dtype)
+    return lambda: raw2outputs(raw, z_vals, rays_d, white_bkgd=True), n_rays
+
+
+def sample_pdf_kernel(n, dtype):
+    n_rays = max(n // N_SAMPLES, 1)
+    z_vals = torch.sort(torch.rand(n_rays, N_SAMPLES, dtype=dtype, device=device), -1)[0]
+    bins = .5 * (z_vals[..., 1:] + z_vals[..., :-1])
+    weights = torch.rand(n_rays, N_SAMPLES - 2, dtype=dtype, device=device)
+    return lambda: sample_pdf(bins, weights, 2 * N_SAMPLES, det=True), n_rays
+
+
+def get_rays_kernel(n, dtype):
+    side = max(int(n ** .5), 1)
+    K = torch.tensor([[side, 0, .5 * side], [0, side, .5 * side], [0, 0, 1]], dtype=dtype, device=device)
+    c2w = torch.eye(4, dtype=dtype, device=device)[:3]
+    return lambda: get_rays(side, side, K, c2w), side * side
+
+
+KERNELS = {
+    'hash_encoder': hash_encoder,
+    'hash_encoder_rays': hash_encoder_rays,
+    'hash_encoder_morton': hash_encoder_morton,
+    'morton_sort': morton_sort,
+    'sh_encoder': sh_encoder,
+    'pos_embedding': pos_embedding,
+    'nerf_forward': nerf_forward,
+    'raw2outputs': raw2outputs_kernel,
+    'sample_pdf': sample_pdf_kernel,
+    'get_rays': get_rays_kernel,
+}
+
+DTYPES = {
+    'float32': torch.float32,
+    'float64': torch.float64,
+    'bfloat16': torch.bfloat16,
+}
+
+
+def run(kernels, batch_sizes, dtypes, warmup=3, repeats=10):
+    """
+    Time every kernel for every batch size and dtype.
+
+    :return: dict of 'kernel/dtype/batch_size' -> dict with the timing statistics, 'items_per_s' and 'peak_bytes'.
+    """
+    results = {}
+    for kernel in kernels:
+        for dtype in dtypes:
+            for n in batch_sizes:
+                name = '{}/{}/{}'.format(kernel, dtype, n)
+                try:
+                    with torch.no_grad():
+                        fn, items = KERNELS[kernel](n, DTYPES[dtype])
+                        # measured on the first call, before warm-up leaves the buffers cached
+                        with PeakMemory() as memory:
+                            fn()
+                        timing = time_fn(fn, warmup=warmup, repeats=repeats)
+                except (NotImplementedError, RuntimeError) as e:
+                    # reduced precision kernels missing on this device, anything else is a bug
+                    if 'not implemented' not in str(e):
+                        raise
+                    print('{:40s} skipped: {}'.format(name, str(e).splitlines()[0]))
+                    continue
+
+                results[name] = dict(timing, items=items, items_per_s=items / timing['median'],
+                                     peak_bytes=memory.peak_bytes)
+                print('{:40s} {:10.3f} ms  {:14.0f} items/s  {:8.1f} MiB'.format(
+                    name, 1e3 * timing['median'], results[name]['items_per_s'], memory.peak_bytes / 2 ** 20))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the rendering hot path.')
+    parser.add_argument('--kernels', type=str, nargs='*', default=list(KERNELS), choices=list(KERNELS),
+                        help='kernels to benchmark')
+    parser.add_argument('--batch_sizes', type=int, nargs='*', default=[2 ** 12, 2 ** 15, 2 ** 18],
+                        help='number of points per call, rays are batch size / {}'.format(N_SAMPLES))
+    parser.add_argument('--dtypes', type=str, nargs='*', default=['float32'], choices=list(DTYPES),
+                        help='dtypes of the inputs and parameters')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed calls before timing')
+    parser.add_argument('--repeats', type=int, default=10, help='timed calls')
+    parser.add_argument('--threads', type=int, default=0, help='number of intra-op threads, 0 keeps the default')
+    parser.add_argument('--save', type=str, default=None, help='save the results as a JSON baseline')
+    parser.add_argument('--baseline', type=str, default=None, help='compare against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    results = run(args.kernels, args.batch_sizes, args.dtypes, args.warmup, args.repeats)
+
+    if args.save is not None:
+        save_results(args.save, results)
+        print('Saved', args.save)
+
+    if args.baseline is not None:
+        print('\nSpeedup vs', args.baseline)
+        for name, old, new, ratio, regressed in compare(results, load_results(args.baseline), 'items_per_s',
+                                                        threshold=args.threshold):
+            print('{:40s} {:6.2f}x{}'.format(name, ratio, '  REGRESSION' if regressed else ''))
+
+
+if __name__ == '__main__':
+    main()
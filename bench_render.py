@@ -0,0 +1,154 @@
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from argparser import config_parser
+from bench_utils import PeakMemory, compare, load_results, peak_rss, save_results
+from load_blender import FAR, NEAR, orbit_render_poses
+from nerf_utils import device
+from run_nerf import create_models, create_nerf, create_render_kwargs, render_images
+from utils import get_bbox3d_for_blenderobj
+
+DEFAULT_BOUNDING_BOX = (torch.tensor([-1.5, -1.5, -1.5]), torch.tensor([1.5, 1.5, 1.5]))
+DEFAULT_CAMERA_ANGLE_X = 0.6911112070083618
+
+# metric -> whether higher values are better
+METRICS = {
+    'fps': True,
+    'rays_per_s': True,
+    'samples_per_s': True,
+    'peak_rss': False,
+}
+
+
+def bench_parser():
+    parser = config_parser()
+    parser.add_argument("--bench_res", type=int, default=200,
+                        help='height and width of the rendered frames at render_factor 0')
+    parser.add_argument("--bench_poses", type=int, default=8,
+                        help='number of poses of the fixed camera path')
+    parser.add_argument("--bench_render_factors", type=int, nargs='*', default=[0, 2],
+                        help='render_factor settings to benchmark')
+    parser.add_argument("--bench_chunks", type=int, nargs='*', default=[1024 * 32, 1024 * 128],
+                        help='chunk settings to benchmark')
+    parser.add_argument("--bench_N_samples", type=int, nargs='*', default=[64],
+                        help='N_samples settings to benchmark')
+    parser.add_argument("--bench_out", type=str, default='bench_render.json',
+                        help='path of the JSON results')
+    parser.add_argument("--bench_baseline", type=str, default=None,
+                        help='baseline results, regressions past the thresholds exit with a non-zero code')
+    parser.add_argument("--bench_threshold", type=float, default=0.1,
+                        help='relative slowdown of fps, rays/s and samples/s counted as a regression')
+    parser.add_argument("--bench_rss_threshold", type=float, default=0.25,
+                        help='relative increase of the peak RSS counted as a regression')
+    return parser
+
+
+def load_scene(args):
+    """
+    Bounding box and camera of the scene in args.datadir, defaults if it holds no blender scene.
+    """
+    transforms_path = os.path.join(args.datadir, 'transforms_train.json')
+    if not os.path.exists(transforms_path):
+        return DEFAULT_BOUNDING_BOX, DEFAULT_CAMERA_ANGLE_X
+
+    with open(transforms_path) as fp:
+        meta = json.load(fp)
+    return (get_bbox3d_for_blenderobj(meta, args.bench_res, args.bench_res, near=NEAR, far=FAR),
+            float(meta['camera_angle_x']))
+
+
+def create_renderer(args, bounding_box):
+    """
+    Test render kwargs of the checkpoint args.ft_path, or of randomly initialised models without one.
+    """
+    if args.ft_path is not None:
+        _, render_kwargs_test, _, _, _ = create_nerf(args, bounding_box=bounding_box)
+    else:
+        _, render_kwargs_test = create_render_kwargs(args, *create_models(args, bounding_box=bounding_box))
+    render_kwargs_test.update({'near': NEAR, 'far': FAR})
+    return render_kwargs_test
+
+
+def bench_config(args, render_factor, chunk, N_samples):
+    """
+    Render the camera path with one setting of render_factor, chunk and N_samples.
+
+    Runs in a fresh process for every setting, so that its peak RSS is not that of an earlier, larger one.
+    """
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+    bounding_box, camera_angle_x = load_scene(args)
+    render_kwargs = dict(create_renderer(args, bounding_box), N_samples=N_samples)
+
+    H = W = args.bench_res
+    focal = .5 * W / np.tan(.5 * camera_angle_x)
+    K = np.array([[focal, 0, 0.5 * W], [0, focal, 0.5 * H], [0, 0, 1]])
+    render_poses = orbit_render_poses((NEAR + FAR) / 2, args.bench_poses).to(device)
+    n_rays = len(render_poses) * (H // max(render_factor, 1)) * (W // max(render_factor, 1))
+
+    with torch.no_grad():
+        # warm-up frame, which is not timed
+        render_images(render_poses[:1], (H, W, focal), K, chunk, render_kwargs, render_factor=render_factor)
+        t = time.perf_counter()
+        with PeakMemory() as memory:
+            render_images(render_poses, (H, W, focal), K, chunk, render_kwargs, render_factor=render_factor)
+        elapsed = time.perf_counter() - t
+
+    return {
+        'fps': len(render_poses) / elapsed,
+        'rays_per_s': n_rays / elapsed,
+        'samples_per_s': n_rays * (N_samples + args.N_importance) / elapsed,
+        'peak_rss': peak_rss(),
+        'peak_bytes': memory.peak_bytes,
+    }
+
+
+def main():
+    args = bench_parser().parse_args()
+    args.dataset_type = 'blender'
+
+    results = {}
+    ctx = mp.get_context('spawn')
+    for render_factor, chunk, N_samples in itertools.product(args.bench_render_factors, args.bench_chunks,
+                                                             args.bench_N_samples):
+        name = 'rf{}/chunk{}/samples{}'.format(render_factor, chunk, N_samples)
+        with ctx.Pool(1) as pool:
+            results[name] = pool.apply(bench_config, (args, render_factor, chunk, N_samples))
+
+    print()
+    for name, result in results.items():
+        print('{:32s} {:8.2f} fps  {:12.0f} rays/s  {:14.0f} samples/s  peak RSS {:8.1f} MiB'.format(
+            name, result['fps'], result['rays_per_s'], result['samples_per_s'], result['peak_rss'] / 2 ** 20))
+
+    save_results(args.bench_out, results)
+    print('Saved', args.bench_out)
+
+    if args.bench_baseline is not None:
+        baseline = load_results(args.bench_baseline)
+        regressions = []
+        for metric, higher_is_better in METRICS.items():
+            threshold = args.bench_threshold if higher_is_better else args.bench_rss_threshold
+            for name, old, new, ratio, regressed in compare(results, baseline, metric, higher_is_better, threshold):
+                if regressed:
+                    regressions.append('{} {}: {:.4g} -> {:.4g} ({:.2f}x)'.format(name, metric, old, new, ratio))
+
+        if regressions:
+            print('Regressions against', args.bench_baseline)
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print('No regressions against', args.bench_baseline)
+
+
+if __name__ == '__main__':
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+    main()
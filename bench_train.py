@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import torch
+
+from run_nerf import train
+from synthetic_scene import make_scene
+
+# command line arguments of train() shared by all benchmarked configurations
+BASE_ARGS = [
+    '--dataset_type', 'blender',
+    '--no_batching', '--use_viewdirs', '--white_bkgd', '--use_aux_params',
+    '--lrate', '0.01', '--lrate_decay', '10',
+    '--N_samples', '32', '--N_importance', '32',
+    '--log2_hashmap_size', '16', '--finest_res', '256',
+]
+
+# name -> additional command line arguments of train()
+DEFAULT_CONFIGS = {
+    'hash': [],
+    'hash_log2T19': ['--log2_hashmap_size', '19'],
+    'hash_64_samples': ['--N_samples', '64', '--N_importance', '64'],
+}
+
+
+def time_to_psnr(val_log, target_psnr):
+    """
+    The first validation record reaching target_psnr, or None if training never reached it.
+    """
+    for record in val_log:
+        if record['psnr'] >= target_psnr:
+            return record
+    return None
+
+
+def run_config(name, extra_args, scene_dir, basedir, N_iters, N_rand, target_psnr, i_val_rays, n_val_rays):
+    """
+    Train one configuration and gather its throughput and convergence.
+    """
+    cmdline = BASE_ARGS + [
+        '--datadir', scene_dir, '--basedir', basedir, '--expname', name,
+        '--N_iters', str(N_iters), '--N_rand', str(N_rand),
+        '--i_val_rays', str(i_val_rays), '--n_val_rays', str(n_val_rays),
+        # keep checkpoints, test sets and videos out of the timings
+        '--i_weights', str(N_iters + 1), '--i_testset', str(N_iters + 1), '--i_video', str(N_iters + 1),
+        '--i_print', str(N_iters + 1),
+    ] + extra_args
+
+    t = time.time()
+    expdir = train(cmdline)
+    wall_time = time.time() - t
+
+    with open(os.path.join(expdir, 'val_psnr.jsonl')) as fp:
+        val_log = [json.loads(line) for line in fp]
+
+    # the validation log is timed from the start of the training loop, which leaves out loading and setup
+    last = val_log[-1]
+    reached = time_to_psnr(val_log, target_psnr)
+    return {
+        'args': extra_args,
+        'wall_time': wall_time,
+        'it_per_s': last['step'] / last['time'],
+        'rays_per_s': last['step'] * N_rand / last['time'],
+        'final_psnr': last['psnr'],
+        'target_psnr': target_psnr,
+        'time_to_target': reached['time'] if reached is not None else None,
+        'steps_to_target': reached['step'] if reached is not None else None,
+        'val_log': val_log,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark training speed and time to PSNR on a synthetic scene.')
+    parser.add_argument('--scene_dir', type=str, default='./data/synthetic_bench',
+                        help='synthetic scene directory, generated if it does not exist')
+    parser.add_argument('--H', type=int, default=64, help='image height of the generated scene')
+    parser.add_argument('--basedir', type=str, default='./logs', help='where the benchmark runs are stored')
+    parser.add_argument('--configs', type=str, default=None,
+                        help='JSON file mapping config names to lists of train() arguments')
+    parser.add_argument('--only', type=str, nargs='*', default=None, help='names of the configs to run')
+    parser.add_argument('--N_iters', type=int, default=2000, help='training iterations per config')
+    parser.add_argument('--N_rand', type=int, default=1024, help='rays per training step')
+    parser.add_argument('--target_psnr', type=float, default=25., help='validation PSNR to time')
+    parser.add_argument('--i_val_rays', type=int, default=50, help='frequency of validation')
+    parser.add_argument('--n_val_rays', type=int, default=4096, help='number of validation rays')
+    parser.add_argument('--out', type=str, default='bench_train.json', help='path of the JSON results')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.scene_dir, 'transforms_train.json')):
+        print('Generating synthetic scene in', args.scene_dir)
+        make_scene(args.scene_dir, H=args.H, W=args.H)
+
+    configs = DEFAULT_CONFIGS
+    if args.configs is not None:
+        with open(args.configs) as fp:
+            configs = json.load(fp)
+    if args.only:
+        configs = {name: configs[name] for name in args.only}
+
+    os.makedirs(args.basedir, exist_ok=True)
+    basedir = tempfile.mkdtemp(prefix='bench_train_', dir=args.basedir)
+
+    results = {
+        'revision': git_revision(),
+        'machine': platform.node(),
+        'torch': torch.__version__,
+        'device': torch.cuda.get_device_name() if torch.cuda.is_available() else platform.processor(),
+        'scene_dir': os.path.abspath(args.scene_dir),
+        'N_iters': args.N_iters,
+        'N_rand': args.N_rand,
+        'configs': {},
+    }
+    for name, extra_args in configs.items():
+        result = run_config(name, extra_args, args.scene_dir, basedir, args.N_iters, args.N_rand, args.target_psnr,
+                            args.i_val_rays, args.n_val_rays)
+        results['configs'][name] = result
+        print('{}: {:.2f} it/s  {:.0f} rays/s  final PSNR {:.2f}  time to {} dB: {}'.format(
+            name, result['it_per_s'], result['rays_per_s'], result['final_psnr'], args.target_psnr,
+            'not reached' if result['time_to_target'] is None else '{:.1f}s'.format(result['time_to_target'])))
+
+    with open(args.out, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print('Saved', args.out)
+
+
+if __name__ == '__main__':
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+    main()
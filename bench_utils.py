@@ -0,0 +1,134 @@
+import json
+import os
+import resource
+import statistics
+import threading
+import time
+
+import torch
+
+
+def synchronize():
+    """
+    Wait for queued CUDA kernels, so that timings cover the work and not only its launch.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def time_fn(fn, warmup=3, repeats=10, min_time=0.):
+    """
+    Time a function after warm-up runs.
+
+    :param fn: callable without arguments.
+    :param warmup: int. Number of untimed calls, which fill caches and allocator pools.
+    :param repeats: int. Minimal number of timed calls.
+    :param min_time: float. Keep repeating until this many seconds were timed in total.
+    :return: dict with the 'median', 'mean', 'std' and 'min' time per call in seconds and the number of 'repeats'.
+    """
+    for _ in range(warmup):
+        fn()
+    synchronize()
+
+    times = []
+    while len(times) < repeats or sum(times) < min_time:
+        t = time.perf_counter()
+        fn()
+        synchronize()
+        times.append(time.perf_counter() - t)
+
+    return {
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'std': statistics.stdev(times) if len(times) > 1 else 0.,
+        'min': min(times),
+        'repeats': len(times),
+    }
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes.
+    """
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes since it started.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemory:
+    def __init__(self, interval=1e-3):
+        """
+        Measure the peak memory allocated inside a with block, relative to its start.
+
+        On CUDA this is the peak of the caching allocator. On CPU the resident set size is sampled by a
+        background thread every interval seconds, so short lived peaks between samples can be missed.
+
+        :param interval: float. Sampling interval on CPU in seconds.
+        """
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if torch.cuda.is_available():
+            synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self._start = torch.cuda.memory_allocated()
+        else:
+            self._start = current_rss()
+            self._peak = self._start
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if torch.cuda.is_available():
+            synchronize()
+            self.peak_bytes = torch.cuda.max_memory_allocated() - self._start
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak_bytes = max(self._peak, current_rss()) - self._start
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, current_rss())
+
+
+def save_results(path, results):
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+
+def load_results(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def compare(results, baseline, key, higher_is_better=True, threshold=0.1):
+    """
+    Compare a metric of each benchmark against a baseline.
+
+    :param results: dict of benchmark name -> dict of metrics.
+    :param baseline: dict of benchmark name -> dict of metrics, benchmarks missing from it are skipped.
+    :param key: str. The metric to compare.
+    :param higher_is_better: bool. Direction of the metric.
+    :param threshold: float. Relative change past which a benchmark counts as regressed.
+    :return: list of (name, baseline value, value, ratio, regressed) tuples, ratio > 1 is an improvement.
+    """
+    rows = []
+    for name, result in results.items():
+        if name not in baseline or key not in baseline[name]:
+            continue
+        old, new = baseline[name][key], result[key]
+        ratio = new / old if higher_is_better else old / new
+        rows.append((name, old, new, ratio, ratio < 1. - threshold))
+    return rows
@@ -0,0 +1,72 @@
+import functools
+
+import torch
+
+COMPILERS = {
+    # shapes vary with the chunk sizes and the number of samples, marking them dynamic avoids recompiles
+    'torch_compile': lambda fn: torch.compile(fn, dynamic=True),
+    # called only when chosen, TorchScript is deprecated and warns when used
+    'script': lambda fn: torch.jit.script(fn),
+}
+
+
+def _compile_errors():
+    # errors of torch.compile compiling a graph on a call, any other error would be raised by the eager code
+    # as well, and running it again could repeat side effects of the failed call
+    from torch._dynamo import exc
+    return exc.BackendCompilerFailed, exc.Unsupported
+
+
+def _with_fallback(compile_fn, eager, name, mode):
+    try:
+        compiled = compile_fn()
+    except Exception as e:
+        print('Compiling {} with {} failed, running it eagerly: {}'.format(name, mode, str(e).splitlines()[0]))
+        return eager
+
+    failed = False
+
+    @functools.wraps(eager)
+    def wrapper(*args, **kwargs):
+        nonlocal failed
+        if not failed:
+            try:
+                return compiled(*args, **kwargs)
+            except _compile_errors() as e:
+                failed = True
+                print('Running {} compiled with {} failed, running it eagerly: {}'.format(
+                    name, mode, str(e).splitlines()[0] if str(e) else type(e).__name__))
+        return eager(*args, **kwargs)
+
+    return wrapper
+
+
+def maybe_compile(fn, mode='torch_compile', name=None):
+    """
+    Compile fn with torch.compile or TorchScript, falling back to fn if compiling it fails.
+
+    torch.compile compiles lazily, so a failure can also surface on a later call, e.g. on a new input shape.
+    From then on fn runs eagerly. Errors raised while running the compiled code are not caught.
+
+    :param fn: The function to compile.
+    :param mode: str. 'none', 'torch_compile' or 'script'.
+    :param name: str. Name of fn in the messages.
+    """
+    if mode == 'none':
+        return fn
+    return _with_fallback(lambda: COMPILERS[mode](fn), fn, name or getattr(fn, '__name__', repr(fn)), mode)
+
+
+def compile_module(module, mode='torch_compile'):
+    """
+    Replace the forward of module by a compiled one, see maybe_compile.
+
+    The module itself is kept, so its parameters, state dict and checkpoints do not change.
+    """
+    if mode == 'none':
+        return module
+    eager = module.forward
+    # TorchScript compiles the module with its submodules, torch.compile traces the bound forward
+    target = module if mode == 'script' else eager
+    module.forward = _with_fallback(lambda: COMPILERS[mode](target), eager, type(module).__name__, mode)
+    return module
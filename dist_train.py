@@ -0,0 +1,209 @@
+import os
+import socket
+import sys
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from argparser import config_parser
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def init_process_group():
+    """
+    Join the gloo process group described by the environment of torchrun, or of spawn_local.
+
+    The CPU cores of the host are split between its processes, which would otherwise each start one
+    intra-op thread per core.
+    """
+    dist.init_process_group('gloo')
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    torch.set_num_threads(max(os.cpu_count() // local_world_size, 1))
+
+
+def broadcast_object(obj):
+    """
+    obj of rank 0 on every rank.
+    """
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, 0)
+    return objects[0]
+
+
+def broadcast_models(*models):
+    """
+    Copy the parameters and buffers of rank 0 to the other ranks, so that all of them start from the same weights.
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for model in models:
+            if model is None:
+                continue
+            for tensor in list(model.parameters()) + list(model.buffers()):
+                dist.broadcast(tensor.data, 0)
+
+
+class GradientAllReduce:
+    def __init__(self, models, dense_tables=False):
+        """
+        Average the gradients of models over the ranks, called between backward and the optimizer step.
+
+        The gradients of the MLPs are all-reduced as one flat buffer. The hash tables have 2^19 rows per level,
+        of which a batch touches only a few thousand, so their gradients are exchanged as the touched rows:
+        every rank gathers the row indices and values of all the others and sums them into a zeroed gradient.
+        The result is the same as a dense all-reduce, at a fraction of the traffic. When the gathered rows would
+        outweigh the tables, the tables are all-reduced densely instead.
+
+        :param models: list of NeRF models, None entries are skipped.
+        :param dense_tables: bool. All-reduce the hash table gradients densely as well, for comparison.
+        """
+        self.dense, self.tables = [], []
+        for model in models:
+            if model is None:
+                continue
+            tables = set(model.PositionEmbedding.embeddings.parameters()) if model.isINGP() else set()
+            for param in model.parameters():
+                if param.requires_grad:
+                    (self.tables if param in tables and not dense_tables else self.dense).append(param)
+
+        # rows of the tables in one index space
+        self.offsets = [0]
+        for table in self.tables:
+            self.offsets.append(self.offsets[-1] + table.shape[0])
+        self.n_features = self.tables[0].shape[1] if self.tables else 0
+        # bytes sent by this rank in the last call
+        self.last_bytes = 0
+
+    def __call__(self):
+        if not is_distributed():
+            return
+        self.last_bytes = 0
+        with torch.no_grad():
+            self._all_reduce_dense(self.dense)
+            if self.tables:
+                self._all_reduce_tables()
+
+    def _all_reduce_dense(self, params):
+        world_size = get_world_size()
+        for param in params:
+            if param.grad is None:
+                param.grad = torch.zeros_like(param)
+        flat = torch.cat([param.grad.reshape(-1) for param in params])
+        dist.all_reduce(flat)
+        flat /= world_size
+        self.last_bytes += flat.numel() * flat.element_size()
+
+        offset = 0
+        for param in params:
+            param.grad.copy_(flat[offset:offset + param.numel()].view_as(param))
+            offset += param.numel()
+
+    def _all_reduce_tables(self):
+        world_size = get_world_size()
+        indices, values = [], []
+        for table, offset in zip(self.tables, self.offsets):
+            if table.grad is None:
+                table.grad = torch.zeros_like(table)
+            rows = torch.nonzero(table.grad.any(1)).squeeze(1)
+            indices.append(rows + offset)
+            values.append(table.grad[rows].float())
+        indices, values = torch.cat(indices), torch.cat(values)
+
+        # all_gather takes tensors of the same size on every rank, padded to the largest count
+        count = torch.tensor([indices.shape[0]])
+        counts = [torch.zeros_like(count) for _ in range(world_size)]
+        dist.all_gather(counts, count)
+        counts = [c.item() for c in counts]
+        size = max(counts)
+        # every rank receives world_size padded blocks of int64 indices and float32 rows, once they outweigh the
+        # tables, e.g. with many ranks or large batches, the dense all-reduce is cheaper
+        if size * world_size * (self.n_features + 2) >= self.offsets[-1] * self.n_features:
+            self._all_reduce_dense(self.tables)
+            return
+        padded_indices = torch.zeros(size, dtype=indices.dtype)
+        padded_indices[:indices.shape[0]] = indices
+        padded_values = torch.zeros(size, self.n_features)
+        padded_values[:values.shape[0]] = values
+
+        gathered_indices = [torch.empty_like(padded_indices) for _ in range(world_size)]
+        gathered_values = [torch.empty_like(padded_values) for _ in range(world_size)]
+        dist.all_gather(gathered_indices, padded_indices)
+        dist.all_gather(gathered_values, padded_values)
+        self.last_bytes += (padded_indices.numel() * padded_indices.element_size()
+                            + padded_values.numel() * padded_values.element_size())
+        indices = torch.cat([rows[:n] for rows, n in zip(gathered_indices, counts)])
+        values = torch.cat([rows[:n] for rows, n in zip(gathered_values, counts)]) / world_size
+
+        # the gathered rows are sorted by table on every rank, split them at the table offsets
+        order = torch.argsort(indices, stable=True)
+        indices, values = indices[order], values[order]
+        bounds = torch.searchsorted(indices, torch.tensor(self.offsets)).tolist()
+        for table, offset, start, end in zip(self.tables, self.offsets, bounds[:-1], bounds[1:]):
+            table.grad.zero_()
+            table.grad.index_add_(0, indices[start:end] - offset, values[start:end].to(table.grad.dtype))
+
+
+def _spawned_main(local_rank, nprocs, port, cmdline):
+    os.environ.update({'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port), 'RANK': str(local_rank),
+                       'WORLD_SIZE': str(nprocs), 'LOCAL_RANK': str(local_rank), 'LOCAL_WORLD_SIZE': str(nprocs)})
+    _run(cmdline)
+
+
+def _run(cmdline):
+    # imported here, run_nerf imports this module
+    from run_nerf import train
+
+    init_process_group()
+    try:
+        train(cmdline)
+    finally:
+        dist.destroy_process_group()
+
+
+def spawn_local(nprocs, cmdline):
+    """
+    Train with nprocs processes on this host.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    mp.spawn(_spawned_main, args=(nprocs, port, cmdline), nprocs=nprocs)
+
+
+def main():
+    """
+    Data parallel training: every rank samples its own N_rand rays per step, the gradients are averaged over the
+    ranks, and rank 0 logs, evaluates and writes the checkpoints.
+
+    Launched by torchrun, e.g. on each of two nodes
+        torchrun --nnodes 2 --nproc_per_node 4 --rdzv_endpoint host0:29500 dist_train.py --config ...
+    or without it on one host with --dist_nprocs.
+    """
+    cmdline = sys.argv[1:]
+    parser = config_parser()
+    args = parser.parse_args(cmdline)
+    if args.render_only:
+        parser.error('--render_only is not distributed, run run_nerf.py')
+    if 'RANK' in os.environ:
+        _run(cmdline)
+    else:
+        spawn_local(max(args.dist_nprocs, 1), cmdline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import os
+import queue
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from render_writer import RenderWriter
+
+
+class EvalWorker:
+    def __init__(self, args, hwf, K, near, far, bounding_box, render_poses,
+                 test_poses, test_images, test_aux_scene_params, max_pending=2):
+        """
+        Render test views and videos in a separate process while training continues.
+
+        Weights are snapshot into shared memory and handed to the worker, which loads them into its own
+        copy of the models, renders the test set (computing PSNR) or the render_poses video, and reports
+        the results back together with the step the weights belong to.
+
+        :param args: The parsed training arguments.
+        :param hwf: tuple. A tuple of (height, width, focal)
+        :param K: array of shape (3, 3). The intrinsic matrix of the camera
+        :param near: float. The near plane
+        :param far: float. The far plane
+        :param bounding_box: The bounding box of the scene, see create_nerf.
+        :param render_poses: Tensor of shape (n, 4, 4). The camera path of the videos.
+        :param test_poses: Tensor of shape (m, 4, 4). The poses of the test views.
+        :param test_images: array of shape (m, H, W, 3). The ground truth of the test views.
+        :param test_aux_scene_params: Tensor of shape (m, ...). Auxiliary scene params of the test views.
+        :param max_pending: int. Snapshots are dropped while this many evaluations are queued or running.
+        """
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.max_pending = max_pending
+        self.n_pending = 0
+
+        scene = {
+            'hwf': hwf,
+            'K': K,
+            'near': near,
+            'far': far,
+            'bounding_box': bounding_box,
+            'render_poses': render_poses.cpu(),
+            'test_poses': test_poses.cpu(),
+            'test_images': test_images,
+            'test_aux_scene_params': test_aux_scene_params.cpu() if test_aux_scene_params is not None else None,
+        }
+        self.process = ctx.Process(target=_worker_main,
+                                   args=(args, scene, torch.Tensor().type(), self.jobs, self.results),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, step, kind, models):
+        """
+        Snapshot the weights of models and queue an evaluation of kind 'testset' or 'video'.
+
+        :return: bool. False if the snapshot was dropped because the worker is busy.
+        """
+        self._check_alive()
+        if self.n_pending >= self.max_pending:
+            return False
+
+        states = {name: {k: v.detach().to('cpu', copy=True).share_memory_() for k, v in model.state_dict().items()}
+                  for name, model in models.items() if model is not None}
+        self.jobs.put((step, kind, states))
+        self.n_pending += 1
+        return True
+
+    def poll(self):
+        """
+        Return the results of finished evaluations without blocking.
+        """
+        results = self._drain()
+        if not results:
+            self._check_alive()
+        return results
+
+    def _drain(self):
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.n_pending -= len(results)
+        return results
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError('Evaluation worker died with exit code {}'.format(self.process.exitcode))
+
+    def close(self):
+        """
+        Wait for the queued evaluations and stop the worker, returning the remaining results.
+        """
+        self.jobs.put(None)
+        results = []
+        while self.n_pending > len(results) and self.process.is_alive():
+            try:
+                results.append(self.results.get(timeout=1.))
+            except queue.Empty:
+                pass
+        self.process.join()
+        self.n_pending -= len(results)
+        return results + self._drain()
+
+
+def _worker_main(args, scene, default_tensor_type, jobs, results):
+    # imported here since run_nerf imports this module
+    from run_nerf import create_models, create_render_kwargs
+
+    torch.set_default_tensor_type(default_tensor_type)
+    if args.eval_threads > 0:
+        torch.set_num_threads(args.eval_threads)
+
+    models = dict(zip(('network_fn_state_dict', 'network_fine_state_dict'),
+                      create_models(args, bounding_box=scene['bounding_box'])))
+    _, render_kwargs_test = create_render_kwargs(args, models['network_fn_state_dict'],
+                                                 models['network_fine_state_dict'])
+    render_kwargs_test.update({'near': scene['near'], 'far': scene['far']})
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        step, kind, states = job
+        for name, state in states.items():
+            models[name].load_state_dict(state)
+        del states
+
+        try:
+            results.put(_evaluate(args, scene, render_kwargs_test, step, kind))
+        except Exception:
+            # report the failure with its step, the next snapshot may still succeed
+            results.put({'step': step, 'kind': kind, 'error': traceback.format_exc()})
+
+
+def _evaluate(args, scene, render_kwargs_test, step, kind):
+    from run_nerf import create_reproject_kwargs, render_images
+    from nerf_utils import device
+
+    hwf, K = scene['hwf'], scene['K']
+    expdir = os.path.join(args.basedir, args.expname)
+
+    with torch.no_grad():
+        if kind == 'testset':
+            testsavedir = os.path.join(expdir, 'testset_{:06d}'.format(step))
+            os.makedirs(testsavedir, exist_ok=True)
+            rgbs, _ = render_images(scene['test_poses'].to(device), hwf, K, args.chunk, render_kwargs_test,
+                                    gt_imgs=scene['test_images'], savedir=testsavedir,
+                                    aux_scene_params=scene['test_aux_scene_params'],
+                                    batch_poses=args.render_batch_poses)
+            mse = np.mean(np.square(rgbs - scene['test_images']), axis=(1, 2, 3))
+            return {'step': step, 'kind': kind, 'path': testsavedir,
+                    'psnr': float(np.mean(-10. * np.log10(mse)))}
+        else:
+            moviebase = os.path.join(expdir, '{}_spiral_{:06d}_'.format(args.expname, step))
+            with RenderWriter(video_path=moviebase + 'rgb.mp4', disp_video_path=moviebase + 'disp.mp4',
+                              n_threads=args.writer_threads) as writer:
+                render_images(scene['render_poses'].to(device), hwf, K, args.chunk, render_kwargs_test,
+                              reproject_kwargs=create_reproject_kwargs(args),
+                              batch_poses=args.render_batch_poses, writer=writer)
+            return {'step': step, 'kind': kind, 'path': moviebase}
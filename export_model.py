@@ -0,0 +1,147 @@
+import json
+import os
+import struct
+import time
+
+import numpy as np
+import torch
+
+from NeRF import NeRF
+from argparser import config_parser
+from load_blender import load_blender_bbox
+from nerf_utils import device
+
+# file layout: MAGIC, the little endian uint64 length of the JSON header, the header, then the tensors
+MAGIC = b'NERFINF1'
+ALIGNMENT = 64
+MODELS = ('network_fn', 'network_fine')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_exported_model(path):
+    """
+    Whether path is an inference-only model written by export_model.
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def export_model(path, state_dicts, model_kwargs, bounding_box, global_step=0):
+    """
+    Write the weights of the coarse and fine model as an inference-only file.
+
+    The JSON header holds the keyword arguments of NeRF, the bounding box, the global step and an index of
+    the tensors. The tensors follow as raw bytes, each aligned to 64 bytes, so that load_exported_model can
+    map them without copying. Optimizer state is not written.
+
+    :param path: str. Output path.
+    :param state_dicts: dict of 'network_fn' and optionally 'network_fine' to the state dicts of the models.
+    :param model_kwargs: dict. Keyword arguments of NeRF, except BoundingBox.
+    :param bounding_box: pair of arrays of shape (3,). The bounding box of the scene.
+    :param global_step: int. Training step of the weights.
+    """
+    tensors, index, offset = [], {}, 0
+    for model in MODELS:
+        if state_dicts.get(model) is None:
+            continue
+        for name, tensor in state_dicts[model].items():
+            tensor = tensor.detach().cpu().contiguous()
+            nbytes = tensor.numel() * tensor.element_size()
+            index[model + '.' + name] = {'dtype': str(tensor.dtype).replace('torch.', ''),
+                                         'shape': list(tensor.shape), 'offset': offset, 'nbytes': nbytes}
+            tensors.append(tensor)
+            offset = _align(offset + nbytes)
+
+    model_kwargs = {k: v for k, v in model_kwargs.items() if k != 'BoundingBox'}
+    header = json.dumps({
+        'model_kwargs': model_kwargs,
+        'bounding_box': [np.asarray(torch.as_tensor(b).cpu()).tolist() for b in bounding_box],
+        'global_step': global_step,
+        'tensors': index,
+    }).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(path, 'wb') as fp:
+        fp.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for tensor, entry in zip(tensors, index.values()):
+            fp.seek(data_start + entry['offset'])
+            # raw bytes of any dtype, including those numpy lacks such as bfloat16
+            fp.write(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+        fp.truncate(data_start + offset)
+
+
+def read_header(path):
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an exported model'.format(path))
+        header_length, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_length))
+    header['data_start'] = _align(len(MAGIC) + 8 + header_length)
+    return header
+
+
+def load_exported_model(path):
+    """
+    Load the models of an exported file.
+
+    The models are built on the meta device, so no memory is allocated or initialized for their weights,
+    and then take over tensors viewing a copy-on-write memory map of the file. On the CPU nothing is read
+    until a weight is used, on CUDA the weights are copied to the device once.
+
+    :return: model, model_fine (None if the file has none), the bounding box and the global step
+    """
+    header = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+
+    state_dicts = {}
+    for key, entry in header['tensors'].items():
+        model, name = key.split('.', 1)
+        start = header['data_start'] + entry['offset']
+        tensor = torch.from_numpy(data[start:start + entry['nbytes']])
+        tensor = tensor.view(getattr(torch, entry['dtype'])).view(entry['shape'])
+        state_dicts.setdefault(model, {})[name] = tensor
+
+    bounding_box = tuple(torch.tensor(b) for b in header['bounding_box'])
+    models = []
+    for model in MODELS:
+        if model not in state_dicts:
+            models.append(None)
+            continue
+        with torch.device('meta'):
+            nerf = NeRF(BoundingBox=bounding_box, **header['model_kwargs'])
+        nerf.load_state_dict(state_dicts[model], assign=True)
+        models.append(nerf.to(device))
+
+    model, model_fine = models
+    return model, model_fine, bounding_box, header['global_step']
+
+
+def main():
+    # imported here, run_nerf loads exported models through this module
+    from run_nerf import nerf_model_kwargs
+
+    parser = config_parser()
+    parser.add_argument("--out", type=str, required=True, help='path of the exported model')
+    args = parser.parse_args()
+    if args.ft_path is None:
+        parser.error('--ft_path is required')
+
+    ckpt = torch.load(args.ft_path, map_location='cpu')
+    bounding_box, _, _ = load_blender_bbox(args.datadir)
+    export_model(args.out, {model: ckpt.get(model + '_state_dict') for model in MODELS},
+                 nerf_model_kwargs(args), bounding_box, global_step=ckpt['global_step'])
+    print('Exported {} ({:.1f} MiB) to {} ({:.1f} MiB)'.format(args.ft_path, os.path.getsize(args.ft_path) / 2 ** 20,
+                                                             args.out, os.path.getsize(args.out) / 2 ** 20))
+
+    t = time.time()
+    load_exported_model(args.out)
+    print('Loaded in {:.1f} ms'.format(1e3 * (time.time() - t)))
+
+
+if __name__ == '__main__':
+    main()
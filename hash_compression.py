@@ -0,0 +1,248 @@
+import io
+import lzma
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from NeRF import NeRF
+from argparser import config_parser
+from hash_encoder import INGPHashEncoder
+from load_blender import load_blender_bbox, load_blender_camera
+from nerf_utils import device, get_rays, mse2psnr
+
+MAGIC = b'NERFQZ1\n'
+MODELS = ('network_fn', 'network_fine')
+
+
+def is_compressed_model(path):
+    """
+    Whether path is a model written by save_compressed.
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def quantize_int8(table):
+    """
+    Affine 8 bit quantization of a (T, F) table with a scale and offset per feature.
+    """
+    low, high = table.min(0).values, table.max(0).values
+    scale = torch.clamp((high - low) / 255., min=1e-12)
+    codes = torch.round((table - low) / scale).to(torch.uint8)
+    return {'mode': 'int8', 'codes': codes, 'scale': scale, 'offset': low}
+
+
+def kmeans(x, k, n_iters=10, chunk=1 << 16, seed=0):
+    """
+    Lloyd's k-means of the rows of x, initialized with k random rows.
+
+    :return: centroids of shape (k, F) and the index of the nearest centroid of every row
+    """
+    generator = torch.Generator(device='cpu').manual_seed(seed)
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:k].to(x.device)].clone()
+    for it in range(n_iters + 1):
+        # distances of all rows at once would take T * k floats
+        assignment = torch.cat([torch.cdist(x[i:i + chunk], centroids).argmin(-1)
+                                for i in range(0, x.shape[0], chunk)])
+        if it == n_iters:
+            break
+        counts = torch.bincount(assignment, minlength=k).to(x.dtype)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        # empty clusters keep their centroid
+        centroids = torch.where(counts[:, None] > 0, sums / counts.clamp(min=1)[:, None], centroids)
+    return centroids, assignment
+
+
+def quantize_vq(table, codebook_size=256, n_iters=10):
+    """
+    Vector quantization of the rows of a (T, F) table with a k-means codebook.
+    """
+    codebook, codes = kmeans(table, codebook_size, n_iters)
+    # the smallest dtype holding every code, int16 would wrap past 32768 and gather the wrong rows
+    codes = codes.to(torch.uint8 if codebook_size <= 256 else torch.int16 if codebook_size <= 2 ** 15
+                     else torch.int32)
+    return {'mode': 'vq', 'codes': codes, 'codebook': codebook.half()}
+
+
+def dequantize(level, indices=None):
+    """
+    The float32 rows indices of a quantized level, all rows if indices is None.
+    """
+    codes = level['codes'] if indices is None else level['codes'][indices]
+    if level['mode'] == 'int8':
+        return codes.float() * level['scale'] + level['offset']
+    if level['mode'] == 'vq':
+        return level['codebook'].float()[codes.long()]
+    if level['mode'] == 'fp16':
+        return codes.float()
+    raise ValueError('unknown quantization {}'.format(level['mode']))
+
+
+def compress_encoder(encoder, mode='int8', codebook_levels=0, codebook_size=256, n_iters=10):
+    """
+    Quantize the levels of an INGPHashEncoder.
+
+    :param mode: str. 'int8' or 'fp16', the quantization of the levels without codebook.
+    :param codebook_levels: int. Number of finest levels vector quantized with a k-means codebook instead.
+        The finest levels hold most of the hash collisions, their features cluster well.
+    :param codebook_size: int. Entries of each codebook.
+    :return: list of one dict per level, see dequantize
+    """
+    levels = []
+    for i, embedding in enumerate(encoder.embeddings):
+        table = embedding.weight.detach().float()
+        if i >= encoder.n_levels - codebook_levels:
+            levels.append(quantize_vq(table, codebook_size, n_iters))
+        elif mode == 'fp16':
+            levels.append({'mode': 'fp16', 'codes': table.half()})
+        else:
+            levels.append(quantize_int8(table))
+    return levels
+
+
+class QuantizedEmbedding(nn.Module):
+    def __init__(self, level):
+        """
+        Inference-only nn.Embedding of a quantized level, rows are dequantized when they are looked up.
+        The quantized tables stay resident, which takes a quarter (int8) to an eighth (codebook) of the memory
+        of the float32 tables.
+        """
+        super(QuantizedEmbedding, self).__init__()
+        self.mode = level['mode']
+        for name, value in level.items():
+            if torch.is_tensor(value):
+                self.register_buffer(name, value)
+
+    def forward(self, indices):
+        level = dict(self.named_buffers())
+        level['mode'] = self.mode
+        return dequantize(level, indices)
+
+
+def decompress_encoder(encoder, levels, on_the_fly=False):
+    """
+    Load quantized levels into encoder, as float32 tables or as QuantizedEmbedding modules if on_the_fly.
+    """
+    for i, level in enumerate(levels):
+        if on_the_fly:
+            encoder.embeddings[i] = QuantizedEmbedding(level)
+        else:
+            encoder.embeddings[i].weight = nn.Parameter(dequantize(level))
+
+
+def compress_model(model, **kwargs):
+    """
+    The dense parameters of model in float32 and the quantized levels of its hash encoder.
+    See compress_encoder for kwargs.
+    """
+    encoder = model.PositionEmbedding
+    if not isinstance(encoder, INGPHashEncoder):
+        raise ValueError('only models with a hash encoder can be compressed')
+    dense = {name: value.detach().cpu() for name, value in model.state_dict().items()
+             if not name.startswith('PositionEmbedding.embeddings.')}
+    levels = [{name: value.cpu() if torch.is_tensor(value) else value for name, value in level.items()}
+              for level in compress_encoder(encoder, **kwargs)]
+    return {'dense': dense, 'levels': levels}
+
+
+def save_compressed(path, models, model_kwargs, bounding_box, global_step=0, **kwargs):
+    """
+    Write the coarse and fine models compressed: quantized hash tables, then entropy coded with lzma.
+
+    :param models: dict of 'network_fn' and optionally 'network_fine' to the models.
+    :param model_kwargs: dict. Keyword arguments of NeRF, except BoundingBox.
+    :param bounding_box: pair of arrays of shape (3,). The bounding box of the scene.
+    :param kwargs: See compress_encoder.
+    """
+    state = {
+        'model_kwargs': {k: v for k, v in model_kwargs.items() if k != 'BoundingBox'},
+        'bounding_box': [np.asarray(torch.as_tensor(b).cpu()).tolist() for b in bounding_box],
+        'global_step': global_step,
+        'models': {name: compress_model(model, **kwargs) for name, model in models.items() if model is not None},
+    }
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    with open(path, 'wb') as fp:
+        fp.write(MAGIC + lzma.compress(buffer.getvalue(), preset=9))
+
+
+def load_compressed_model(path, on_the_fly=False):
+    """
+    Load the models of a compressed file, dequantizing the hash tables now, or during lookups if on_the_fly.
+
+    :return: model, model_fine (None if the file has none), the bounding box and the global step
+    """
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a compressed model'.format(path))
+        state = torch.load(io.BytesIO(lzma.decompress(fp.read())), map_location=device)
+
+    bounding_box = tuple(torch.tensor(b) for b in state['bounding_box'])
+    models = []
+    for name in MODELS:
+        if name not in state['models']:
+            models.append(None)
+            continue
+        with torch.device('meta'):
+            model = NeRF(BoundingBox=bounding_box, **state['model_kwargs'])
+        # the tables are replaced by decompress_encoder
+        model.load_state_dict(state['models'][name]['dense'], strict=False, assign=True)
+        decompress_encoder(model.PositionEmbedding, state['models'][name]['levels'], on_the_fly)
+        models.append(model.to(device))
+
+    model, model_fine = models
+    return model, model_fine, bounding_box, state['global_step']
+
+
+def main():
+    # imported here, run_nerf loads compressed models through this module
+    from run_nerf import create_nerf, nerf_model_kwargs
+    from render import render
+
+    parser = config_parser()
+    parser.add_argument("--out", type=str, required=True, help='path of the compressed model')
+    parser.add_argument("--table_dtype", type=str, default='int8', choices=['int8', 'fp16'],
+                        help='quantization of the hash table levels without codebook')
+    parser.add_argument("--codebook_levels", type=int, default=4,
+                        help='number of finest hash table levels vector quantized with a k-means codebook')
+    parser.add_argument("--codebook_size", type=int, default=256, help='entries of each codebook')
+    args = parser.parse_args()
+    if args.ft_path is None:
+        parser.error('--ft_path is required')
+
+    bounding_box, near, far = load_blender_bbox(args.datadir)
+    _, render_kwargs, step, _, _ = create_nerf(args, bounding_box=bounding_box)
+    render_kwargs.update({'near': near, 'far': far})
+
+    t = time.time()
+    with torch.no_grad():
+        save_compressed(args.out, {name: render_kwargs[name] for name in MODELS}, nerf_model_kwargs(args),
+                        bounding_box, global_step=step, mode=args.table_dtype,
+                        codebook_levels=args.codebook_levels, codebook_size=args.codebook_size)
+    print('Compressed {} ({:.1f} MiB) to {} ({:.2f} MiB) in {:.1f} s'.format(
+        args.ft_path, os.path.getsize(args.ft_path) / 2 ** 20, args.out, os.path.getsize(args.out) / 2 ** 20,
+        time.time() - t))
+
+    # quality of the compressed models, against renders of the original ones
+    render_poses, (H, W, focal) = load_blender_camera(args.datadir, args.half_res)
+    K = np.array([[focal, 0, 0.5 * W], [0, focal, 0.5 * H], [0, 0, 1]])
+    aux_scene_params = torch.full((nerf_model_kwargs(args).get('nAuxParams', 0),), .5)
+    model, model_fine, _, _ = load_compressed_model(args.out)
+    with torch.no_grad():
+        for c2w in render_poses[::len(render_poses) // 4].to(device):
+            rays = torch.stack(get_rays(H, W, K, c2w[:3, :4]), 0).reshape(2, -1, 3)
+            rgb, _, _, _ = render(H, W, K, chunk=args.chunk, rays=rays, aux_scene_params=aux_scene_params,
+                                  **render_kwargs)
+            rgb_compressed, _, _, _ = render(H, W, K, chunk=args.chunk, rays=rays, aux_scene_params=aux_scene_params,
+                                             **{**render_kwargs, 'network_fn': model, 'network_fine': model_fine})
+            print('PSNR against the original render: {:.2f}'.format(
+                mse2psnr(torch.mean((rgb - rgb_compressed) ** 2)).item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
+import math
+from fractions import Fraction
+
 import torch
 import torch.nn as nn
 import utils
@@ -5,25 +8,35 @@ import utils
 
 class INGPHashEncoder(nn.Module):
     def __init__(self, bounding_box, n_levels=16, n_feature_per_level=2,
-                 log2_table_size=19, coarsest_resolution=16, finest_resolution=512):
+                 log2_table_size=19, coarsest_resolution=16, finest_resolution=512, morton_sort=False):
         """
         bounding_box: array of 2 * 3, the bounding box of the scene
+        morton_sort: sort the points of each call by the Morton code of their voxel before the lookups and restore
+            their order afterwards. Samples arrive in ray order, i.e. at scattered table rows, sorted neighbouring
+            points share voxels and cache lines of the tables.
         """
         super(INGPHashEncoder, self).__init__()
         self.bounding_box = bounding_box
         self.n_levels = n_levels
         self.n_feature_per_level = n_feature_per_level
         self.log2_table_size = log2_table_size
-        # convert to torch tensor
-        self.coarsest_resolution = torch.tensor(coarsest_resolution)
-        self.finest_resolution = torch.tensor(finest_resolution)
+        self.morton_sort = morton_sort
+        # convert to torch tensor, on the CPU so that the encoder can also be built on the meta device
+        self.coarsest_resolution = torch.tensor(coarsest_resolution, device='cpu')
+        self.finest_resolution = torch.tensor(finest_resolution, device='cpu')
         # compute output dimension
         self.output_dim = self.n_levels * self.n_feature_per_level
         # setup b
         self.b = torch.exp((torch.log(self.finest_resolution) - torch.log(self.coarsest_resolution)) / (n_levels - 1))
+        # resolution of each level, computed once as Python floats so that forward does not touch the device
+        self.resolutions = [torch.floor(self.coarsest_resolution * (self.b ** i)).item() for i in range(n_levels)]
+        self.hash_mask = (1 << log2_table_size) - 1
         # setup hash table
         num_embeddings = 2 ** log2_table_size
-        self.embeddings = nn.ModuleList([nn.Embedding(num_embeddings, n_feature_per_level) for _ in range(n_levels)])
+        # created from empty weights, the default normal initialization would be overwritten below anyway
+        self.embeddings = nn.ModuleList([nn.Embedding(num_embeddings, n_feature_per_level,
+                                                      _weight=torch.empty(num_embeddings, n_feature_per_level))
+                                         for _ in range(n_levels)])
 
         # initialize weight with uniform distribution
         for i in range(n_levels):
@@ -36,10 +49,21 @@ class INGPHashEncoder(nn.Module):
         param x: 3D point positions, with the shape of (N, 3)
         return: The shape of the output will be (N, self.output_dim)
         """
+        if self.morton_sort and x.shape[0] > 1:
+            order = torch.argsort(utils.morton_codes(x, self.bounding_box))
+            inverse = torch.empty_like(order)
+            inverse[order] = torch.arange(order.shape[0], device=order.device)
+            return self.encode(x[order])[inverse]
+        return self.encode(x)
+
+    def encode(self, x):
+        """
+        The embedding of x in the order of x, see forward.
+        """
         x_all_embedding = []
         # for each level of hash table
         for i in range(self.n_levels):
-            resolution = torch.floor(self.coarsest_resolution * (self.b ** i))
+            resolution = self.resolutions[i]
             voxel_min_vertex, voxel_max_vertex, hashed_voxel_indices = self.get_voxel_vertices(x, resolution)
             # obtain embedding from the hash table, (N, 8, n_feature_per_level)
             voxel_embedding = self.embeddings[i](hashed_voxel_indices)
@@ -59,9 +83,8 @@ class INGPHashEncoder(nn.Module):
         """
         box_min, box_max = self.bounding_box
 
-        if not torch.all(x <= box_max) or not torch.all(x >= box_min):
-            print("clamp points because some of them are out of bounds")
-            x = torch.clamp(x, min=box_min, max=box_max)
+        # clamp points out of bounds unconditionally, checking for them first would sync with the device
+        x = torch.clamp(x, min=box_min, max=box_max)
 
         grid_size = (box_max - box_min) / resolution
 
@@ -70,7 +93,7 @@ class INGPHashEncoder(nn.Module):
         # compute the minimum vertex position for each point's corresponding voxel
         voxel_min_vertex = bottom_left_index * grid_size + box_min
         # we can compute the maximum vertex position by just adding the size of the voxel
-        voxel_max_vertex = voxel_min_vertex + torch.tensor([1.0, 1.0, 1.0]) * grid_size
+        voxel_max_vertex = voxel_min_vertex + grid_size
 
         # bottom_left_index: (N, 3), BOX_OFFSET: (1, 8, 3)
         # we want to broadcast 8 offsets to each index, hence we expand bottom_left_index to (N, 1, 3)
@@ -88,7 +111,7 @@ class INGPHashEncoder(nn.Module):
         for i in range(x.shape[-1]):
             xor_result ^= x[..., i] * primes[i]
 
-        return torch.tensor((1 << self.log2_table_size) - 1).to(xor_result.device) & xor_result
+        return xor_result & self.hash_mask
 
     @staticmethod
     def trilinear_interpolate(x, voxel_min_vertex, voxel_max_vertex, voxel_embedding):
@@ -124,85 +147,205 @@ class INGPHashEncoder(nn.Module):
         return c
 
 
+def _poly_mul(p, q):
+    """
+    Product of two polynomials in x, y, z, given as dicts of exponents (a, b, c) to coefficients.
+    """
+    product = {}
+    for (a, b, c), u in p.items():
+        for (d, e, f), v in q.items():
+            key = (a + d, b + e, c + f)
+            product[key] = product.get(key, 0) + u * v
+    return product
+
+
+def sh_polynomials(degree):
+    """
+    Real spherical harmonics of the bands l < degree as homogeneous polynomials in x, y, z, in the order and with
+    the signs of SHEncoder: index l^2 + l + m, with the Condon-Shortley phase.
+
+    Y_lm = sqrt(2) K_lm Re((x + iy)^m) Q_l^m(z) for m > 0, sqrt(2) K_lm Im((x + iy)^|m|) Q_l^|m|(z) for m < 0,
+    K_l0 Q_l^0(z) for m = 0, where Q_l^m = (-1)^m d^m P_l / dz^m and P_l is the Legendre polynomial. Every term of
+    Q_l^m is multiplied by the power of x^2 + y^2 + z^2 making it of degree l - m, so that the polynomials do not
+    assume unit inputs.
+
+    :return: list of degree^2 dicts of exponents (a, b, c) to coefficients
+    """
+    polynomials = []
+    for l in range(degree):
+        # Rodrigues' formula, P_l = d^l/dz^l (z^2 - 1)^l / (2^l l!), as exact coefficients of z^k
+        legendre = [Fraction(0)] * (2 * l + 1)
+        for k in range(l + 1):
+            legendre[2 * k] = Fraction(math.comb(l, k) * (-1) ** (l - k))
+        for _ in range(l):
+            legendre = [k * c for k, c in enumerate(legendre)][1:]
+        legendre = [c / (2 ** l * math.factorial(l)) for c in legendre]
+
+        for m in range(-l, l + 1):
+            am = abs(m)
+            q = legendre
+            for _ in range(am):
+                q = [-k * c for k, c in enumerate(q)][1:]
+            radial = {}
+            for k, c in enumerate(q):
+                if c == 0:
+                    continue
+                # (x^2 + y^2 + z^2)^j z^k, with 2 j + k = l - |m|
+                term = {(0, 0, k): c}
+                for _ in range((l - am - k) // 2):
+                    term = _poly_mul(term, {(2, 0, 0): 1, (0, 2, 0): 1, (0, 0, 2): 1})
+                radial = {key: radial.get(key, 0) + term.get(key, 0) for key in set(radial) | set(term)}
+
+            # real (m >= 0) or imaginary (m < 0) part of (x + iy)^|m|
+            azimuthal = {(am - j, j, 0): math.comb(am, j) * (-1) ** (j // 2)
+                         for j in range(am + 1) if j % 2 == (m < 0)}
+            scale = math.sqrt((2 * l + 1) / (4 * math.pi) * math.factorial(l - am) / math.factorial(l + am))
+            if m != 0:
+                scale *= math.sqrt(2)
+            polynomials.append({key: scale * float(c) for key, c in _poly_mul(azimuthal, radial).items() if c != 0})
+    return polynomials
+
+
 class SHEncoder(nn.Module):
     def __init__(self, input_dim=3, degree=4):
+        """
+        Real spherical harmonics of the bands l < degree, i.e. degree^2 outputs.
+
+        The harmonics are polynomials of the inputs, so all of them are one matmul of the monomials of the inputs
+        with a constant coefficient matrix, derived for any degree by sh_polynomials.
 
+        :param input_dim: int. Must be 3.
+        :param degree: int. Number of bands.
+        """
         super().__init__()
 
         self.input_dim = input_dim
         self.degree = degree
 
         assert self.input_dim == 3
-        assert self.degree >= 1 and self.degree <= 5
+        assert self.degree >= 1
 
         self.out_dim = degree ** 2
 
-        self.C0 = 0.28209479177387814
-        self.C1 = 0.4886025119029199
-        self.C2 = [
-            1.0925484305920792,
-            -1.0925484305920792,
-            0.31539156525252005,
-            -1.0925484305920792,
-            0.5462742152960396
-        ]
-        self.C3 = [
-            -0.5900435899266435,
-            2.890611442640554,
-            -0.4570457994644658,
-            0.3731763325901154,
-            -0.4570457994644658,
-            1.445305721320277,
-            -0.5900435899266435
-        ]
-        self.C4 = [
-            2.5033429417967046,
-            -1.7701307697799304,
-            0.9461746957575601,
-            -0.6690465435572892,
-            0.10578554691520431,
-            -0.6690465435572892,
-            0.47308734787878004,
-            -1.7701307697799304,
-            0.6258357354491761
-        ]
+        polynomials = sh_polynomials(degree)
+        monomials = sorted({key for polynomial in polynomials for key in polynomial}, key=lambda key: (sum(key), key))
+        basis = torch.zeros(len(monomials), self.out_dim, dtype=torch.float64, device='cpu')
+        for j, polynomial in enumerate(polynomials):
+            for key, c in polynomial.items():
+                basis[monomials.index(key), j] = c
+        # not saved, and on the CPU so that the encoder can also be built on the meta device
+        self.register_buffer('basis', basis.float(), persistent=False)
+
+        # every monomial of degree >= 2 is the product of one of a lower degree with x, y or z
+        variables = [(1, 0, 0), (0, 1, 0), (0, 0, 1)]
+        self.variables = [monomials.index(key) if key in monomials else None for key in variables]
+        self.products = []
+        for i, key in enumerate(monomials):
+            if sum(key) >= 2:
+                v = next(v for v in range(3) if key[v] > 0)
+                parent = tuple(e - (u == v) for u, e in enumerate(key))
+                self.products.append((i, monomials.index(parent), monomials.index(variables[v])))
+        self.n_monomials = len(monomials)
 
     def forward(self, input, **kwargs):
+        shape = input.shape[:-1]
+        input = input.reshape(-1, self.input_dim)
+        # the coefficients of the higher bands are large, half precision would lose the cancellations
+        with torch.autocast(input.device.type, enabled=False):
+            if torch.is_grad_enabled() and input.requires_grad:
+                # out= does not support autograd
+                monomials = [torch.ones_like(input[:, 0])] + [None] * (self.n_monomials - 1)
+                for v, i in enumerate(self.variables):
+                    if i is not None:
+                        monomials[i] = input[:, v]
+                for i, parent, variable in self.products:
+                    monomials[i] = monomials[parent] * monomials[variable]
+                monomials = torch.stack(monomials, 0)
+            else:
+                # one row per monomial, so that the products run on contiguous memory
+                monomials = torch.empty((self.n_monomials, input.shape[0]), dtype=input.dtype, device=input.device)
+                monomials[0] = 1.
+                for v, i in enumerate(self.variables):
+                    if i is not None:
+                        monomials[i] = input[:, v]
+                for i, parent, variable in self.products:
+                    torch.mul(monomials[parent], monomials[variable], out=monomials[i])
+            result = monomials.t() @ self.basis.to(input.dtype)
+        return result.view(*shape, self.out_dim)
+
+
+class FrequencyEncoder(nn.Module):
+    def __init__(self, n_frequencies=10, input_dim=3):
+        """
+        Frequency positional encoding [x, sin(2^0 x), cos(2^0 x), ..., sin(2^(L-1) x), cos(2^(L-1) x)].
+
+        The inputs are multiplied by all frequencies in one outer product and sin and cos are evaluated once
+        each on the result, which is then concatenated into a preallocated output. That is 4 kernels instead of
+        3L + 1. The products are laid out frequency-major, (L, N, input_dim), so that sin and cos run on
+        contiguous memory and the concatenation copies whole (N, input_dim) blocks.
+        The frequency bands can be attenuated, either by annealing them in with set_alpha (coarse-to-fine
+        training as in Nerfies), or by passing the variance of the inputs to forward (integrated positional
+        encoding as in mip-NeRF).
+
+        :param n_frequencies: int. The number of frequencies L.
+        :param input_dim: int. The dimension of the inputs.
+        """
+        super(FrequencyEncoder, self).__init__()
+        self.n_frequencies = n_frequencies
+        self.input_dim = input_dim
+        self.output_dim = input_dim * (2 * n_frequencies + 1)
+        # not saved, and on the CPU so that the encoder can also be built on the meta device
+        self.register_buffer('frequencies', 2. ** torch.arange(n_frequencies, dtype=torch.float32, device='cpu'),
+                             persistent=False)
+        self.alpha = None
 
-        result = torch.empty((*input.shape[:-1], self.out_dim), dtype=input.dtype, device=input.device)
-        x, y, z = input.unbind(-1)
-
-        result[..., 0] = self.C0
-        if self.degree > 1:
-            result[..., 1] = -self.C1 * y
-            result[..., 2] = self.C1 * z
-            result[..., 3] = -self.C1 * x
-            if self.degree > 2:
-                xx, yy, zz = x * x, y * y, z * z
-                xy, yz, xz = x * y, y * z, x * z
-                result[..., 4] = self.C2[0] * xy
-                result[..., 5] = self.C2[1] * yz
-                result[..., 6] = self.C2[2] * (2.0 * zz - xx - yy)
-                # result[..., 6] = self.C2[2] * (3.0 * zz - 1) # xx + yy + zz == 1, but this will lead to different backward gradients, interesting...
-                result[..., 7] = self.C2[3] * xz
-                result[..., 8] = self.C2[4] * (xx - yy)
-                if self.degree > 3:
-                    result[..., 9] = self.C3[0] * y * (3 * xx - yy)
-                    result[..., 10] = self.C3[1] * xy * z
-                    result[..., 11] = self.C3[2] * y * (4 * zz - xx - yy)
-                    result[..., 12] = self.C3[3] * z * (2 * zz - 3 * xx - 3 * yy)
-                    result[..., 13] = self.C3[4] * x * (4 * zz - xx - yy)
-                    result[..., 14] = self.C3[5] * z * (xx - yy)
-                    result[..., 15] = self.C3[6] * x * (xx - 3 * yy)
-                    if self.degree > 4:
-                        result[..., 16] = self.C4[0] * xy * (xx - yy)
-                        result[..., 17] = self.C4[1] * yz * (3 * xx - yy)
-                        result[..., 18] = self.C4[2] * xy * (7 * zz - 1)
-                        result[..., 19] = self.C4[3] * yz * (7 * zz - 3)
-                        result[..., 20] = self.C4[4] * (zz * (35 * zz - 30) + 3)
-                        result[..., 21] = self.C4[5] * xz * (7 * zz - 3)
-                        result[..., 22] = self.C4[6] * (xx - yy) * (7 * zz - 1)
-                        result[..., 23] = self.C4[7] * xz * (xx - 3 * yy)
-                        result[..., 24] = self.C4[8] * (xx * (xx - 3 * yy) - yy * (3 * xx - yy))
-
-        return result
+    def set_alpha(self, alpha):
+        """
+        Anneal the frequency bands in: band k is masked by (1 - cos(pi * clamp(alpha - k, 0, 1))) / 2.
+        alpha = L enables all bands, None disables the mask.
+        """
+        self.alpha = alpha
+
+    def band_weights(self, var=None):
+        """
+        Weights of the frequency bands, of shape (L, 1, 1), or (L, N, input_dim) with var, None without a mask.
+        """
+        weights = None
+        if self.alpha is not None:
+            bands = torch.arange(self.n_frequencies, dtype=self.frequencies.dtype, device=self.frequencies.device)
+            weights = ((1. - torch.cos(math.pi * torch.clamp(self.alpha - bands, 0., 1.))) / 2.)[:, None, None]
+        if var is not None:
+            # expected value of sin and cos of a Gaussian with variance var
+            integrated = torch.exp(-0.5 * self.frequencies[:, None, None] ** 2 * var[None])
+            weights = integrated if weights is None else weights * integrated
+        return weights
+
+    def forward(self, x, var=None):
+        """
+        param x: Inputs, with the shape of (N, input_dim)
+        param var: Variance of the inputs, with the shape of (N, input_dim), or None
+        return: The shape of the output will be (N, self.output_dim)
+        """
+        n = x.shape[0]
+        frequencies = self.frequencies.to(x.dtype)[:, None]
+        weights = self.band_weights(var)
+
+        if torch.is_grad_enabled() and (x.requires_grad or weights is not None and weights.requires_grad):
+            # out= does not support autograd
+            scaled = (frequencies * x.reshape(1, -1)).view(self.n_frequencies, n, self.input_dim)
+            sin, cos = torch.sin(scaled), torch.cos(scaled)
+            if weights is not None:
+                sin, cos = sin * weights, cos * weights
+            return torch.cat([x] + [band for pair in zip(sin, cos) for band in pair], -1)
+
+        # sin and cos of each frequency follow each other, the products are written into the cos half first
+        sin_cos = torch.empty((self.n_frequencies, 2, n, self.input_dim), dtype=x.dtype, device=x.device)
+        scaled = torch.mul(frequencies, x.reshape(1, -1), out=sin_cos[:, 1].view(self.n_frequencies, -1))
+        scaled = scaled.view(self.n_frequencies, n, self.input_dim)
+        torch.sin(scaled, out=sin_cos[:, 0])
+        scaled.cos_()
+        if weights is not None:
+            sin_cos.mul_(weights[:, None])
+
+        out = torch.empty((n, self.output_dim), dtype=x.dtype, device=x.device)
+        return torch.cat([x, *sin_cos.view(2 * self.n_frequencies, n, self.input_dim)], -1, out=out)
@@ -7,6 +7,10 @@ import cv2
 
 from utils import get_bbox3d_for_blenderobj
 
+# near and far plane of the blender scenes
+NEAR = 0.1
+FAR = 2.
+
 trans_t = lambda t: torch.Tensor([
     [1, 0, 0, 0],
     [0, 1, 0, 0],
@@ -34,6 +38,10 @@ def pose_spherical(theta, phi, radius):
     return c2w
 
 
+def orbit_render_poses(radius, n_frames=80):
+    return torch.stack([pose_spherical(angle, -30.0, radius) for angle in np.linspace(-180, 180, n_frames + 1)[:-1]], 0)
+
+
 def load_blender_data(basedir, half_res=False, testskip=1, use_aux_params=False):
     splits = ['train', 'val', 'test']
     metas = {}
@@ -96,12 +104,12 @@ def load_blender_data(basedir, half_res=False, testskip=1, use_aux_params=False)
     camera_angle_x = float(meta['camera_angle_x'])
     focal = .5 * W / np.tan(.5 * camera_angle_x)
 
-    near = 0.1
-    far = 2
+    near = NEAR
+    far = FAR
     radius = (near + far) / 2
 
     # orbiting camera video:
-    render_poses = torch.stack([pose_spherical(angle, -30.0, radius) for angle in np.linspace(-180, 180, 80 + 1)[:-1]], 0)
+    render_poses = orbit_render_poses(radius)
 
     # static video pose:
     # render_poses = torch.stack([pose_spherical(angle, -30.0, radius) for angle in np.linspace(-180, 180, 40 + 1)[:-1]], 0)
@@ -125,3 +133,26 @@ def load_blender_data(basedir, half_res=False, testskip=1, use_aux_params=False)
         return imgs, poses, render_poses, [H, W, focal], i_split, bounding_box, near, far, aux_scene_params
 
     return imgs, poses, render_poses, [H, W, focal], i_split, bounding_box, near, far, None
+
+
+def load_blender_bbox(basedir):
+    """
+    The bounding box and the near and far plane of a blender scene, without loading all of its images.
+    """
+    with open(os.path.join(basedir, 'transforms_train.json'), 'r') as fp:
+        meta = json.load(fp)
+    H, W = imageio.imread(os.path.join(basedir, meta['frames'][0]['file_path'] + '.png')).shape[:2]
+    return get_bbox3d_for_blenderobj(meta, H, W, near=NEAR, far=FAR), NEAR, FAR
+
+
+def load_blender_camera(basedir, half_res=False):
+    """
+    The orbiting render poses and [H, W, focal] of a blender scene, without loading all of its images.
+    """
+    with open(os.path.join(basedir, 'transforms_train.json'), 'r') as fp:
+        meta = json.load(fp)
+    H, W = imageio.imread(os.path.join(basedir, meta['frames'][0]['file_path'] + '.png')).shape[:2]
+    focal = .5 * W / np.tan(.5 * float(meta['camera_angle_x']))
+    if half_res:
+        H, W, focal = H // 2, W // 2, focal / 2.
+    return orbit_render_poses((NEAR + FAR) / 2), [H, W, focal]
@@ -0,0 +1,72 @@
+import torch
+import torch.nn as nn
+
+from hash_encoder import INGPHashEncoder
+
+DTYPES = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class _LowPrecisionGather(torch.autograd.Function):
+    """
+    Rows indices of the low precision copy, with the gradient accumulated in float32 into the master weight.
+    """
+
+    @staticmethod
+    def forward(ctx, indices, weight, low):
+        ctx.save_for_backward(indices)
+        ctx.weight_shape = weight.shape
+        return nn.functional.embedding(indices, low)
+
+    @staticmethod
+    def backward(ctx, grad):
+        indices, = ctx.saved_tensors
+        grad_weight = torch.zeros(ctx.weight_shape, dtype=torch.float32, device=grad.device)
+        grad_weight.index_put_((indices.reshape(-1),), grad.reshape(-1, grad.shape[-1]).float(), accumulate=True)
+        return None, grad_weight, None
+
+
+class MixedPrecisionEmbedding(nn.Module):
+    def __init__(self, weight, dtype=torch.bfloat16):
+        """
+        nn.Embedding gathering from a bf16 or fp16 copy of its float32 master weight.
+
+        The hash table lookups are bound by memory bandwidth, which the half width copy halves. The master weight
+        stays the parameter, so the optimizer state, the updates and the checkpoints remain float32. The copy is
+        refreshed on the first lookup after the master weight changed, i.e. once per optimizer step.
+
+        :param weight: nn.Parameter of shape (T, F). The master weight, e.g. of the replaced nn.Embedding.
+        :param dtype: torch.dtype. Precision of the copy.
+        """
+        super(MixedPrecisionEmbedding, self).__init__()
+        self.weight = weight
+        self.dtype = dtype
+        self.register_buffer('low', weight.detach().to(dtype), persistent=False)
+        self._version = weight._version
+
+    def forward(self, indices):
+        if self.weight._version != self._version or self.low.device != self.weight.device:
+            self.low = self.weight.detach().to(self.dtype)
+            self._version = self.weight._version
+        return _LowPrecisionGather.apply(indices, self.weight, self.low)
+
+
+def use_mixed_precision(model, dtype):
+    """
+    Replace the hash table levels of model by MixedPrecisionEmbedding modules sharing their parameters,
+    so that an optimizer created before keeps updating them. Other encoders are left as they are.
+    """
+    encoder = getattr(model, 'PositionEmbedding', None)
+    if dtype is None or not isinstance(encoder, INGPHashEncoder):
+        return
+    for i, embedding in enumerate(encoder.embeddings):
+        if isinstance(embedding, nn.Embedding):
+            encoder.embeddings[i] = MixedPrecisionEmbedding(embedding.weight, dtype)
+
+
+def grad_scaler(precision):
+    """
+    Loss scaling for fp16, which underflows small gradients. bf16 has the exponent range of float32 and does
+    not need it, the returned scaler is disabled then and passes losses and steps through.
+    """
+    device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.amp.GradScaler(device_type, enabled=precision == 'fp16')
@@ -0,0 +1,207 @@
+import copy
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from load_blender import load_blender_bbox
+
+
+def model_bytes(*models):
+    """
+    Memory held by the parameters and buffers of models, None entries are skipped.
+    """
+    return sum(t.numel() * t.element_size() for model in models if model is not None
+               for t in list(model.parameters()) + list(model.buffers()))
+
+
+class ModelRegistry:
+    def __init__(self, args, scenes, max_bytes, prefetch=1):
+        """
+        Memory bounded LRU set of trained scenes, loaded on demand from their checkpoints.
+
+        Scenes are loaded with create_nerf on first use, and the least recently used scenes are evicted once the
+        resident models exceed max_bytes. The most recently requested scene is always kept, even if it alone
+        exceeds the budget. The registry counts which scene follows which, and after every request loads the
+        most likely successors in a background thread, so that they are often resident when requested.
+        A prefetched scene that does not fit next to the scene in use is dropped instead of evicting it.
+
+        get() is thread safe, so a long running renderer can share one registry between its request handlers.
+
+        :param args: The parsed arguments shared by all scenes.
+        :param scenes: dict of scene name to a dict with the 'ft_path' of its checkpoint, its 'datadir' and
+            optionally other arguments overriding args for that scene, e.g. 'log2_hashmap_size'.
+        :param max_bytes: int. Budget of the resident models.
+        :param prefetch: int. Number of likely successors loaded in the background, 0 disables prefetching.
+        """
+        self.args = args
+        self.scenes = scenes
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+
+        self.lock = threading.Lock()
+        self.resident = OrderedDict()
+        self.loading = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.successors = defaultdict(Counter)
+        self.last_scene = None
+        # sizes of the scenes loaded so far, to skip prefetches that would not fit
+        self.scene_bytes = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetch_hits = 0
+        self.evictions = 0
+        self.load_times = []
+
+    @classmethod
+    def from_file(cls, args, path, max_bytes, prefetch=1):
+        """
+        Registry of the scenes listed in the JSON file path, see __init__ for its format.
+        Relative paths of the scenes are resolved against the directory of the file.
+        """
+        with open(path) as fp:
+            scenes = json.load(fp)
+        root = os.path.dirname(os.path.abspath(path))
+        for scene in scenes.values():
+            for key in ('ft_path', 'datadir'):
+                scene[key] = os.path.join(root, scene[key])
+        return cls(args, scenes, max_bytes, prefetch)
+
+    @property
+    def resident_bytes(self):
+        return sum(entry['bytes'] for entry in self.resident.values())
+
+    def scene_args(self, name):
+        """
+        The arguments of scene name, args with the overrides of the scene applied.
+        """
+        args = copy.copy(self.args)
+        for key, value in self.scenes[name].items():
+            setattr(args, key, value)
+        args.no_reload = False
+        return args
+
+    def _load(self, name):
+        # imported here, run_nerf imports the registry for render-only use
+        from run_nerf import create_nerf, nerf_model_kwargs
+
+        t = time.time()
+        args = self.scene_args(name)
+        bounding_box, near, far = load_blender_bbox(args.datadir)
+        _, render_kwargs, _, _, _ = create_nerf(args, bounding_box=bounding_box)
+        render_kwargs.update({'near': near, 'far': far})
+        entry = {
+            'render_kwargs': render_kwargs,
+            'args': args,
+            'n_aux': nerf_model_kwargs(args).get('nAuxParams', 0),
+            'bytes': model_bytes(render_kwargs['network_fn'], render_kwargs['network_fine']),
+            'load_time': time.time() - t,
+            'prefetched': False,
+        }
+        return entry
+
+    def _insert(self, name, entry):
+        # called with the lock held
+        self.load_times.append(entry['load_time'])
+        self.scene_bytes[name] = entry['bytes']
+        self.resident[name] = entry
+        # a prefetch never evicts the scene in use
+        kept = {name, self.last_scene} if entry['prefetched'] else {name}
+        for evicted in list(self.resident):
+            if self.resident_bytes <= self.max_bytes:
+                break
+            if evicted not in kept:
+                del self.resident[evicted]
+                self.evictions += 1
+                print('Registry: evicted', evicted)
+        if entry['prefetched'] and self.resident_bytes > self.max_bytes and name != self.last_scene:
+            del self.resident[name]
+            print('Registry: dropped prefetched', name)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _start_load(self, name, prefetched):
+        # called with the lock held, returns the future of a load running in the background
+        if name in self.loading:
+            return self.loading[name]
+
+        def load():
+            entry = self._load(name)
+            entry['prefetched'] = prefetched
+            with self.lock:
+                self._insert(name, entry)
+                del self.loading[name]
+            return entry
+
+        self.loading[name] = self.executor.submit(load)
+        return self.loading[name]
+
+    def get(self, name):
+        """
+        The scene name with its 'render_kwargs' for testing including near and far, its 'args' and 'n_aux'.
+
+        Raises KeyError for unknown scenes.
+        """
+        if name not in self.scenes:
+            raise KeyError('unknown scene {}'.format(name))
+
+        with self.lock:
+            if self.last_scene is not None:
+                self.successors[self.last_scene][name] += 1
+            self.last_scene = name
+
+            entry = self.resident.get(name)
+            if entry is not None:
+                self.resident.move_to_end(name)
+                self.hits += 1
+                if entry['prefetched']:
+                    self.prefetch_hits += 1
+                    entry['prefetched'] = False
+                future = None
+            else:
+                self.misses += 1
+                future = self._start_load(name, prefetched=False)
+
+        if future is not None:
+            entry = future.result()
+            with self.lock:
+                if name in self.resident:
+                    self.resident.move_to_end(name)
+                if entry['prefetched']:
+                    # requested while it was being prefetched, the load was shortened
+                    self.prefetch_hits += 1
+                    entry['prefetched'] = False
+
+        self._prefetch(name)
+        return entry
+
+    def _prefetch(self, name):
+        with self.lock:
+            in_use = self.resident[name]['bytes'] if name in self.resident else 0
+            likely = [successor for successor, _ in self.successors[name].most_common()
+                      if successor != name and successor not in self.resident
+                      and in_use + self.scene_bytes.get(successor, 0) <= self.max_bytes][:self.prefetch]
+            for successor in likely:
+                self._start_load(successor, prefetched=True)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        load_times = np.array(self.load_times) if self.load_times else np.zeros(1)
+        return {
+            'requests': requests,
+            'hit_rate': self.hits / max(requests, 1),
+            'prefetch_hits': self.prefetch_hits,
+            'evictions': self.evictions,
+            'loads': len(self.load_times),
+            'load_time_mean': float(load_times.mean()),
+            'load_time_p50': float(np.median(load_times)),
+            'load_time_max': float(load_times.max()),
+            'resident': list(self.resident),
+            'resident_mb': self.resident_bytes / 2 ** 20,
+        }
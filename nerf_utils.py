@@ -1,3 +1,4 @@
+import math
 import torch
 import numpy as np
 
@@ -9,7 +10,7 @@ def img2mse(x, y):
 
 
 def mse2psnr(x):
-    return -10. * torch.log(x) / torch.log(torch.Tensor([10.]))
+    return -10. * torch.log(x) / math.log(10.)
 
 
 def to8b(x):
@@ -18,8 +19,15 @@ def to8b(x):
 
 # Ray helpers
 def get_rays(h, w, k, c2w):
-    i, j = torch.meshgrid(torch.linspace(0, w - 1, w),
-                          torch.linspace(0, h - 1, h))  # pytorch's mesh grid has indexing='ij'
+    return get_rays_window(k, c2w, 0, h, 0, w)
+
+
+def get_rays_window(k, c2w, y0, y1, x0, x1):
+    """
+    Generate the rays of the pixels in rows [y0, y1) and columns [x0, x1) of an image, see get_rays.
+    """
+    i, j = torch.meshgrid(torch.linspace(x0, x1 - 1, x1 - x0),
+                          torch.linspace(y0, y1 - 1, y1 - y0))  # pytorch's mesh grid has indexing='ij'
     i = i.t()
     j = j.t()
     dirs = torch.stack([(i - k[0][2]) / k[0][0], -(j - k[1][2]) / k[1][1], -torch.ones_like(i)], -1)
@@ -62,6 +70,45 @@ def ndc_rays(h, w, focal, near, rays_o, rays_d):
     return rays_o, rays_d
 
 
+def reproject_depth(h, w, k, depth, mask, c2w_src, c2w_dst, tol):
+    """
+    Forward-warp a rendered depth map into a new camera by splatting its surface points.
+
+    Depth is measured along the (unnormalized) rays of get_rays, whose camera-space z component is -1,
+    so it equals the camera-space depth in both the source and the destination view.
+
+    :param h: int. Height of image in pixels.
+    :param w: int. Width of image in pixels.
+    :param k: array of shape (3, 3). The intrinsic matrix of the camera
+    :param depth: Tensor of shape (h, w). Depth map rendered from c2w_src.
+    :param mask: Tensor of shape (h, w). True where depth describes a reliable surface.
+    :param c2w_src: array of shape (3, 4). Camera the depth map was rendered from.
+    :param c2w_dst: array of shape (3, 4). Camera to reproject into.
+    :param tol: float. Pixels whose splatted depths disagree by more than this are marked inconsistent.
+    :return: depth, valid. Predicted depth of shape (h, w) and a boolean mask of pixels that
+             received a consistent reprojection.
+    """
+    rays_o, rays_d = get_rays(h, w, k, c2w_src)
+    pts = (rays_o + rays_d * depth[..., None])[mask]  # (M, 3) surface points in world frame
+
+    # world frame -> destination camera frame, (p - t) @ R == R^T (p - t)
+    cam = (pts - c2w_dst[:3, -1]) @ c2w_dst[:3, :3]
+    z = -cam[:, 2]
+    col = torch.round(cam[:, 0] / z * k[0][0] + k[0][2]).long()
+    row = torch.round(-cam[:, 1] / z * k[1][1] + k[1][2]).long()
+
+    inside = (z > 0) & (col >= 0) & (col < w) & (row >= 0) & (row < h)
+    flat = row[inside] * w + col[inside]
+    z = z[inside]
+
+    # z-buffer the splats, keeping the spread of depths that landed on each pixel
+    z_min = torch.full((h * w,), float('inf')).scatter_reduce(0, flat, z, reduce='amin')
+    z_max = torch.full((h * w,), -float('inf')).scatter_reduce(0, flat, z, reduce='amax')
+    valid = torch.isfinite(z_min) & (z_max - z_min < tol)
+
+    return torch.where(valid, z_min, torch.zeros_like(z_min)).reshape(h, w), valid.reshape(h, w)
+
+
 # Hierarchical sampling (section 5.2)
 def sample_pdf(bins, weights, n_samples, det=False, pytest=False):
     # Get pdf
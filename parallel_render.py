@@ -0,0 +1,140 @@
+import copy
+import io
+import os
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+from nerf_utils import get_rays_window
+from render import render
+
+# set in every worker by _init_worker
+_worker = {}
+
+
+def _picklable(model):
+    """
+    model without the forward replaced by compile_utils.compile_module, which can not be pickled.
+    The workers compile their models again.
+    """
+    if model is None or 'forward' not in model.__dict__:
+        return model
+    model = copy.copy(model)
+    del model.__dict__['forward']
+    return model
+
+
+def _init_worker(args, models, near, far, hwf, K, chunk, n_threads):
+    # imported here, run_nerf imports this module
+    from run_nerf import create_render_kwargs
+
+    torch.set_num_threads(n_threads)
+    models = torch.load(io.BytesIO(models), map_location='cpu', weights_only=False)
+    _, render_kwargs = create_render_kwargs(args, *models)
+    render_kwargs.update({'near': near, 'far': far})
+    _worker.update({'render_kwargs': render_kwargs, 'hwf': hwf, 'K': K, 'chunk': chunk})
+
+
+def _render_task(task):
+    """
+    Render a frame, or the window (y0, y1, x0, x1) of it.
+
+    :return: the frame index, the window and the rgb and disparity as numpy arrays
+    """
+    i, c2w, aux_scene_params, window = task
+    (H, W, _), K = _worker['hwf'], _worker['K']
+    with torch.no_grad():
+        if window is None:
+            rgb, disp, _, _ = render(H, W, K, chunk=_worker['chunk'], c2w=c2w, aux_scene_params=aux_scene_params,
+                                     **_worker['render_kwargs'])
+        else:
+            rays_o, rays_d = get_rays_window(K, c2w, *window)
+            rgb, disp, _, _ = render(H, W, K, chunk=_worker['chunk'], rays=torch.stack([rays_o, rays_d], 0),
+                                     aux_scene_params=aux_scene_params, **_worker['render_kwargs'])
+    return i, window, rgb.cpu().numpy(), disp.cpu().numpy()
+
+
+def render_images_parallel(args, render_kwargs, render_poses, aux_scene_params, hwf, K, chunk, n_workers,
+                           n_threads=0, tile=0, gt_imgs=None, savedir=None, memmap_dir=None, writer=None):
+    """
+    Render a sequence of poses in a pool of worker processes, as render_images does in one.
+
+    Each worker loads its own copy of the models of render_kwargs, builds its render kwargs around them and
+    runs n_threads intra-op threads. Frames, or tiles of frames if tile > 0, are handed out one at a time as
+    workers become free, so slow frames do not hold up the others, and the results are gathered in order and
+    passed to writer.
+
+    :param args: The parsed arguments the models were created with.
+    :param render_kwargs: The keyword arguments of render() for testing, including near and far, on the CPU.
+    :param render_poses: Tensor of shape (n, 4, 4).
+    :param aux_scene_params: Sequence of the auxiliary scene params of every frame.
+    :param n_workers: int. Number of worker processes.
+    :param n_threads: int. Intra-op threads of every worker, 0 divides the cores between the workers.
+    :param tile: int. Side length of the square tiles in pixels, 0 distributes whole frames.
+    :param gt_imgs: array of shape (n, H, W, 3) or None. Ground truth for the PSNR of every frame.
+    :param savedir: str or None. Directory of the PNGs.
+    :param memmap_dir: str or None. With tile > 0, tiles are gathered into .npy files memory-mapped from here.
+    :param writer: RenderWriter. Receives the frames in order.
+    """
+    H, W, _ = hwf
+    n_threads = n_threads if n_threads > 0 else max(os.cpu_count() // n_workers, 1)
+    # serialized whole, which also covers the int8 models of quantize_mlp whose weights can not be shared
+    buffer = io.BytesIO()
+    torch.save(tuple(_picklable(render_kwargs[name]) for name in ('network_fn', 'network_fine')), buffer)
+    models = buffer.getvalue()
+
+    render_poses = render_poses.cpu()
+    tasks = []
+    for i, c2w in enumerate(render_poses):
+        aux = torch.as_tensor(aux_scene_params[i]).cpu()
+        if tile > 0:
+            tasks += [(i, c2w[:3, :4], aux, (y0, min(y0 + tile, H), x0, min(x0 + tile, W)))
+                      for y0 in range(0, H, tile) for x0 in range(0, W, tile)]
+        else:
+            tasks.append((i, c2w[:3, :4], aux, None))
+    n_tiles = len(tasks) // len(render_poses)
+
+    psnrs = []
+    t = time.time()
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(n_workers, initializer=_init_worker,
+                  initargs=(args, models, render_kwargs['near'], render_kwargs['far'], hwf, K, chunk,
+                            n_threads)) as pool:
+        rgb_out, disp_out, n_done = None, None, 0
+        progress = tqdm(total=len(render_poses))
+        # imap returns the results in the order of the tasks, so the tiles of one frame arrive before the next
+        for i, window, rgb, disp in pool.imap(_render_task, tasks, chunksize=1):
+            if window is None:
+                rgb_out, disp_out = rgb, disp
+            else:
+                if rgb_out is None:
+                    if memmap_dir is not None:
+                        rgb_out = np.lib.format.open_memmap(os.path.join(memmap_dir, '{:03d}_rgb.npy'.format(i)),
+                                                            mode='w+', dtype=np.float32, shape=(H, W, 3))
+                        disp_out = np.lib.format.open_memmap(os.path.join(memmap_dir, '{:03d}_disp.npy'.format(i)),
+                                                             mode='w+', dtype=np.float32, shape=(H, W))
+                    else:
+                        rgb_out = np.empty((H, W, 3), dtype=np.float32)
+                        disp_out = np.empty((H, W), dtype=np.float32)
+                y0, y1, x0, x1 = window
+                rgb_out[y0:y1, x0:x1] = rgb.reshape(y1 - y0, x1 - x0, 3)
+                disp_out[y0:y1, x0:x1] = disp.reshape(y1 - y0, x1 - x0)
+            n_done += 1
+            if n_done < n_tiles:
+                continue
+
+            if gt_imgs is not None:
+                psnrs.append(-10. * np.log10(np.mean(np.square(rgb_out - gt_imgs[i]))))
+            writer.write(rgb_out, disp_out,
+                         png_path=os.path.join(savedir, '{:03d}.png'.format(i)) if savedir is not None else None)
+            rgb_out, disp_out, n_done = None, None, 0
+            progress.update()
+        progress.close()
+
+    print('Rendered {} frames with {} workers of {} threads in {:.1f} s'.format(
+        len(render_poses), n_workers, n_threads, time.time() - t))
+    if psnrs:
+        print("Avg PSNR over Test set: ", sum(psnrs) / len(psnrs))
@@ -0,0 +1,123 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+def phase(profiler, name):
+    """
+    Time a block as phase name of profiler, or do nothing if profiler is None.
+    """
+    return profiler.phase(name) if profiler is not None else nullcontext()
+
+
+class StepProfiler:
+    def __init__(self, path, log_every=100, sync=None, trace_dir=None, trace_start=10, trace_steps=0):
+        """
+        Lightweight per-phase timers of training steps, written as JSONL records.
+
+        Every log_every steps, one record with the mean time per step of every phase, the rays/s, the samples
+        per ray and the latest loss and PSNR is appended to path. Phases can nest, e.g. compositing inside the
+        render of a batch, so their times do not need to add up to the step time.
+
+        CUDA kernels run asynchronously, so phases are only attributed correctly if the device is synchronized
+        at their boundaries. This costs a little throughput and is done by default when CUDA is available.
+
+        :param path: str. Path of the JSONL metrics file.
+        :param log_every: int. Number of steps aggregated into a record.
+        :param sync: bool. Synchronize CUDA at phase boundaries, None to synchronize if CUDA is available.
+        :param trace_dir: str. Directory of the torch.profiler trace.
+        :param trace_start: int. Step at which the torch.profiler trace starts.
+        :param trace_steps: int. Number of steps traced with torch.profiler, 0 disables tracing.
+        """
+        self.file = open(path, 'a')
+        self.log_every = log_every
+        self.sync = torch.cuda.is_available() if sync is None else sync
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace = None
+
+        self.start_time = time.time()
+        self._reset()
+
+    def _reset(self):
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.step_time = 0.
+        self.n_steps = 0
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def phase(self, name):
+        self._synchronize()
+        t = time.perf_counter()
+        # label the phase in the torch.profiler trace
+        with torch.profiler.record_function(name) if self.trace is not None else nullcontext():
+            yield
+            self._synchronize()
+        self.phases[name] += time.perf_counter() - t
+
+    def count(self, name, value):
+        """
+        Add value to the counter name of the current step, e.g. the number of rays or samples.
+        """
+        self.counters[name] += value
+
+    def start_step(self, step):
+        if self.trace_steps > 0 and step == self.trace_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities)
+            self.trace.start()
+
+        self._synchronize()
+        self._step_start = time.perf_counter()
+
+    def end_step(self, step, **metrics):
+        """
+        Finish a step and write a record every log_every steps.
+
+        :param metrics: Scalar tensors or numbers of the step, e.g. loss and psnr. Only the values of the last
+            step of a record are converted to Python numbers, which avoids a device sync on every step.
+        """
+        self._synchronize()
+        self.step_time += time.perf_counter() - self._step_start
+        self.n_steps += 1
+
+        if self.trace is not None and step == self.trace_start + self.trace_steps - 1:
+            self.trace.stop()
+            path = os.path.join(self.trace_dir, 'trace_{:06d}.json'.format(self.trace_start))
+            self.trace.export_chrome_trace(path)
+            self.trace = None
+            print('Saved torch.profiler trace', path)
+
+        if self.n_steps == self.log_every:
+            self.write(step, metrics)
+
+    def write(self, step, metrics):
+        record = {
+            'step': step,
+            'time': time.time() - self.start_time,
+            'step_time': self.step_time / self.n_steps,
+            'phases': {name: t / self.n_steps for name, t in self.phases.items()},
+            'rays_per_s': self.counters['rays'] / self.step_time,
+            'samples_per_ray': self.counters['samples'] / max(self.counters['rays'], 1),
+        }
+        record.update({name: float(value) for name, value in metrics.items()})
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self._reset()
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        self.file.close()
@@ -0,0 +1,130 @@
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized as nnq
+from torch.ao.quantization.observer import HistogramObserver
+
+from render import render
+from validation import RayValidator
+
+
+def quantized_layers(model):
+    """
+    (parent, name) of the nn.Linear layers of a NeRF model run in int8, the encoders stay in float.
+    """
+    layers = [(model, 'DensityLayer'), (model, 'GeoFeatLayer')]
+    for module_list in (model.StemLayers, model.ColorLayers):
+        layers += [(module_list, str(i)) for i in range(len(module_list))]
+    return layers
+
+
+class Int8Linear(nn.Module):
+    def __init__(self, linear, input_qparams, output_qparams):
+        """
+        Inference-only nn.Linear with int8 weights and uint8 activations, run by the CPU quantized engine.
+
+        Weights are quantized symmetrically per output channel, inputs and outputs with the calibrated affine
+        scales and zero points. Inputs and outputs are float tensors, so that the layer replaces linear in
+        NeRF.forward as is.
+
+        :param linear: nn.Linear. The float layer.
+        :param input_qparams: (scale, zero_point) of the inputs.
+        :param output_qparams: (scale, zero_point) of the outputs.
+        """
+        super(Int8Linear, self).__init__()
+        weight = linear.weight.detach().float().cpu()
+        weight_scale = weight.abs().amax(1).clamp(min=1e-8) / 127.
+        qweight = torch.quantize_per_channel(weight, weight_scale.double(),
+                                             torch.zeros(weight.shape[0], dtype=torch.long), 0, torch.qint8)
+
+        self.linear = nnq.Linear(linear.in_features, linear.out_features)
+        self.linear.set_weight_bias(qweight, linear.bias.detach().float().cpu() if linear.bias is not None else None)
+        self.linear.scale, self.linear.zero_point = float(output_qparams[0]), int(output_qparams[1])
+        self.input_scale, self.input_zero_point = float(input_qparams[0]), int(input_qparams[1])
+        # read by NeRF.forward
+        self.RequiresAuxiliaryInput = getattr(linear, 'RequiresAuxiliaryInput', False)
+
+    def forward(self, x):
+        x = torch.quantize_per_tensor(x.float(), self.input_scale, self.input_zero_point, torch.quint8)
+        return self.linear(x).dequantize()
+
+
+def quantize_models(render_kwargs, rays, aux_scene_params=None, chunk=1024 * 32):
+    """
+    Calibrate the activation ranges of the MLPs of render_kwargs on rays and return int8 copies of the models.
+
+    The calibration rays are rendered as in testing, so the observers see the inputs of the coarse and the fine
+    samples. Outliers are clipped by histogram observers instead of stretching the scales.
+
+    :param render_kwargs: The keyword arguments of render() for testing, including near and far, on the CPU.
+    :param rays: tensor of shape (2, N, 3). Calibration rays, e.g. from the training views.
+    :param aux_scene_params: tensor of shape (N, n_aux) or None. Auxiliary scene params of the rays.
+    :return: render_kwargs with the quantized models
+    """
+    models = {name: copy.deepcopy(render_kwargs[name]) for name in ('network_fn', 'network_fine')}
+
+    observers, hooks = {}, []
+    for model in models.values():
+        if model is None:
+            continue
+        for parent, name in quantized_layers(model):
+            layer = getattr(parent, name)
+            # reduce_range leaves headroom against overflows in the 16 bit accumulation of x86 kernels
+            observers[layer] = (HistogramObserver(dtype=torch.quint8, reduce_range=True),
+                                HistogramObserver(dtype=torch.quint8, reduce_range=True))
+
+            def observe(layer, inputs, output):
+                observers[layer][0](inputs[0].detach())
+                observers[layer][1](output.detach())
+
+            hooks.append(layer.register_forward_hook(observe))
+
+    with torch.no_grad():
+        render(0, 0, None, chunk=chunk, rays=rays, aux_scene_params=aux_scene_params,
+               **{**render_kwargs, **models})
+    for hook in hooks:
+        hook.remove()
+
+    for model in models.values():
+        if model is None:
+            continue
+        for parent, name in quantized_layers(model):
+            layer = getattr(parent, name)
+            input_observer, output_observer = observers[layer]
+            setattr(parent, name, Int8Linear(layer, input_observer.calculate_qparams(),
+                                             output_observer.calculate_qparams()))
+
+    return {**render_kwargs, **models}
+
+
+def quantize_for_render(render_kwargs, images, poses, aux_scene_params, i_train, i_test, hwf, K,
+                        n_calibration_rays=4096, n_check_rays=4096, chunk=1024 * 32):
+    """
+    Quantize the MLPs with rays of the training views and check the quality on rays of the test views.
+
+    Prints the PSNR of the float and the int8 models against the test pixels, the PSNR of the int8 against
+    the float renders and the time of both renders.
+
+    :return: render_kwargs with the quantized models
+    """
+    calibration = RayValidator(images, poses, aux_scene_params, i_train, hwf, K, n_rays=n_calibration_rays,
+                               seed=1)
+    quantized_kwargs = quantize_models(render_kwargs, calibration.rays, calibration.aux_scene_params, chunk)
+
+    check = RayValidator(images, poses, aux_scene_params, i_test, hwf, K, n_rays=n_check_rays)
+    rgbs = []
+    with torch.no_grad():
+        for name, kwargs in (('float', render_kwargs), ('int8', quantized_kwargs)):
+            t = time.time()
+            rgb, _, _, _ = render(0, 0, None, chunk=chunk, rays=check.rays,
+                                  aux_scene_params=check.aux_scene_params, **kwargs)
+            t = time.time() - t
+            rgbs.append(rgb)
+            psnr = -10. * torch.log10(torch.mean((rgb - check.target) ** 2))
+            print('Quantization check: {} PSNR {:.2f} in {:.3f} s'.format(name, psnr.item(), t))
+        psnr = -10. * torch.log10(torch.mean((rgbs[0] - rgbs[1]) ** 2))
+    print('Quantization check: int8 against float PSNR {:.2f}'.format(psnr.item()))
+
+    return quantized_kwargs
@@ -3,17 +3,23 @@ import torch.nn.functional
 from torch.distributions import Categorical
 
 from nerf_utils import *
+from profiler import phase
 
 DEBUG = False
 
 
-def batchify_rays(rays_flat, chunk=1024 * 32, aux_scene_params=None, **kwargs):
+def batchify_rays(rays_flat, chunk=1024 * 32, aux_scene_params=None, render_rays_fn=None, **kwargs):
     """
     Render rays in smaller mini batches to avoid OOM.
+    render_rays_fn replaces render_rays, e.g. by a compiled version of it.
     """
+    render_rays_fn = render_rays if render_rays_fn is None else render_rays_fn
+    per_ray_aux = aux_scene_params is not None and aux_scene_params.dim() == 2
     all_ret = {}
     for i in range(0, rays_flat.shape[0], chunk):
-        ret = render_rays(rays_flat[i:i + chunk], aux_scene_params=aux_scene_params, **kwargs)
+        ret = render_rays_fn(rays_flat[i:i + chunk],
+                             aux_scene_params=aux_scene_params[i:i + chunk] if per_ray_aux else aux_scene_params,
+                             **kwargs)
         for k in ret:
             if k not in all_ret:
                 all_ret[k] = []
@@ -40,7 +46,7 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0., white_bkgd=False, pytest=
     raw2alpha = lambda raw, dists, act_fn=nn.functional.relu: 1. - torch.exp(-act_fn(raw) * dists)
 
     dists = z_vals[..., 1:] - z_vals[..., :-1]
-    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[..., :1].shape)], -1)  # [N_rays, N_samples]
+    dists = torch.cat([dists, torch.full_like(dists[..., :1], 1e10)], -1)  # [N_rays, N_samples]
 
     dists = dists * torch.norm(rays_d[..., None, :], dim=-1)
 
@@ -51,7 +57,7 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0., white_bkgd=False, pytest=
 
     alpha = raw2alpha(raw[..., 3] + noise, dists)  # [N_rays, N_samples]
     # weights = alpha * tf.math.cumprod(1.-alpha + 1e-10, -1, exclusive=True)
-    weights = alpha * torch.cumprod(torch.cat([torch.ones((alpha.shape[0], 1)), 1. - alpha + 1e-10], -1), -1)[:, :-1]
+    weights = alpha * torch.cumprod(torch.cat([torch.ones_like(alpha[:, :1]), 1. - alpha + 1e-10], -1), -1)[:, :-1]
     rgb_map = torch.sum(weights[..., None] * rgb, -2)  # [N_rays, 3]
 
     depth_map = torch.sum(weights * z_vals, -1)
@@ -63,7 +69,8 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0., white_bkgd=False, pytest=
 
     # Calculate weights sparsity loss
     mask = weights.sum(-1) > 0.5
-    entropy = Categorical(probs=weights + 1e-5).entropy()
+    # argument validation would check the probabilities on the host
+    entropy = Categorical(probs=weights + 1e-5, validate_args=False).entropy()
     sparsity_loss = entropy * mask
 
     return rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss
@@ -90,6 +97,8 @@ def render(H, W, K, chunk=1024 * 32, rays=None, c2w=None, ndc=True,
       use_viewdirs: bool. If True, use viewing direction of a point in space in model.
       c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for
        camera while using other c2w argument for viewing directions.
+      aux_scene_params: auxiliary scene params shared by all rays, or array of shape
+       [batch_size, n_aux] with one set of params per ray.
     Returns:
       rgb_map: [batch_size, 3]. Predicted RGB values for rays.
       disp_map: [batch_size]. Disparity map. Inverse of depth.
@@ -136,6 +145,138 @@ def render(H, W, K, chunk=1024 * 32, rays=None, c2w=None, ndc=True,
     return ret_list + [ret_dict]
 
 
+def render_batched(H, W, K, c2ws, aux_scene_params=None, chunk=1024 * 32, **kwargs):
+    """
+    Render full images for several poses as a single stream of rays, so that every chunk is filled
+    up to its full size instead of ending each frame with a partly empty one.
+    Args:
+      H, W, K, chunk: see render().
+      c2ws: array of shape [n_poses, 3, 4]. Camera-to-world transformation matrices.
+      aux_scene_params: list of n_poses auxiliary scene params, one per pose, or None.
+    Returns:
+      rgb_map: [n_poses, H, W, 3]. Predicted RGB values for rays.
+      disp_map: [n_poses, H, W]. Disparity map. Inverse of depth.
+      acc_map: [n_poses, H, W]. Accumulated opacity (alpha) along a ray.
+      extras: dict with everything returned by render_rays().
+    """
+    rays_o, rays_d = zip(*[get_rays(H, W, K, c2w) for c2w in c2ws])
+    rays = torch.stack([torch.stack(rays_o, 0), torch.stack(rays_d, 0)], 0)  # [2, n_poses, H, W, 3]
+
+    if aux_scene_params is not None:
+        # (n_poses, n_aux) -> (n_poses * H * W, n_aux)
+        aux_scene_params = torch.stack([torch.as_tensor(p) for p in aux_scene_params], 0).float()
+        aux_scene_params = aux_scene_params.reshape(len(c2ws), -1).repeat_interleave(H * W, dim=0)
+
+    return render(H, W, K, chunk=chunk, rays=rays, aux_scene_params=aux_scene_params, **kwargs)
+
+
+def render_tiled(H, W, K, c2w, tile=256, chunk=1024 * 32, rgb_out=None, disp_out=None, acc_out=None,
+                 aux_scene_params=None, **kwargs):
+    """
+    Render a full image tile by tile, so that memory is bounded by the tile rather than the frame size.
+    Rays are generated per tile and every rendered tile is copied into the output arrays, which may be
+    preallocated by the caller (e.g. np.memmap to stream very large frames to disk).
+    Args:
+      H, W, K, c2w, chunk: see render().
+      tile: int. Side length of the square tiles in pixels.
+      rgb_out: array of shape [H, W, 3] or None. Output RGB image, allocated in host memory if None.
+      disp_out: array of shape [H, W] or None. Output disparity map, allocated if None.
+      acc_out: array of shape [H, W] or None. Output accumulated opacity, allocated if None.
+    Returns:
+      rgb_out, disp_out, acc_out: numpy arrays holding the rendered image.
+    """
+    rgb_out = np.empty((H, W, 3), dtype=np.float32) if rgb_out is None else rgb_out
+    disp_out = np.empty((H, W), dtype=np.float32) if disp_out is None else disp_out
+    acc_out = np.empty((H, W), dtype=np.float32) if acc_out is None else acc_out
+
+    for y0 in range(0, H, tile):
+        for x0 in range(0, W, tile):
+            y1, x1 = min(y0 + tile, H), min(x0 + tile, W)
+            rays_o, rays_d = get_rays_window(K, c2w, y0, y1, x0, x1)
+            rgb, disp, acc, _ = render(H, W, K, chunk=chunk, rays=torch.stack([rays_o, rays_d], 0),
+                                       aux_scene_params=aux_scene_params, **kwargs)
+            rgb_out[y0:y1, x0:x1] = rgb.cpu().numpy()
+            disp_out[y0:y1, x0:x1] = disp.cpu().numpy()
+            acc_out[y0:y1, x0:x1] = acc.cpu().numpy()
+
+    return rgb_out, disp_out, acc_out
+
+
+def render_reprojected(H, W, K, c2w, prev_frame=None, chunk=1024 * 32, near=0., far=1.,
+                       N_samples=64, N_importance=0, reproj_band=0.05, reproj_samples=16,
+                       reproj_importance=16, reproj_acc_thresh=0.95, aux_scene_params=None, **kwargs):
+    """
+    Render a full image, reusing the depth of the previous frame of a camera path.
+
+    Pixels that the previous frame's depth map reprojects onto consistently are rendered with
+    reproj_samples + reproj_importance samples in a narrow band around the predicted surface.
+    Disoccluded pixels, and guided pixels whose band turned out not to contain an opaque surface,
+    fall back to full N_samples + N_importance sampling between near and far.
+    Args:
+      H, W, K, c2w, chunk, near, far: see render().
+      prev_frame: dict with 'c2w', 'depth' and 'mask' of the previous frame, or None to render
+        every pixel with full sampling (e.g. for key frames).
+      reproj_band: float. Half width of the sampling band around the reprojected depth.
+      reproj_samples: int. Number of coarse samples per ray inside the band.
+      reproj_importance: int. Number of fine samples per ray inside the band.
+      reproj_acc_thresh: float. Minimal accumulated opacity for a pixel's depth to be reused.
+    Returns:
+      rgb_map: [H, W, 3]. Predicted RGB values for rays.
+      disp_map: [H, W]. Disparity map. Inverse of depth.
+      acc_map: [H, W]. Accumulated opacity (alpha) along a ray.
+      frame: dict with the 'c2w', 'depth' and 'mask' to pass as prev_frame of the next frame, and
+        'reprojected', the mask of pixels rendered with the narrow band.
+    """
+    assert not kwargs.get('ndc', False), 'reprojection requires rays in world coordinates (ndc=False)'
+    kwargs['ndc'] = False
+
+    rays_o, rays_d = get_rays(H, W, K, c2w)
+    rays_o = torch.reshape(rays_o, [-1, 3])
+    rays_d = torch.reshape(rays_d, [-1, 3])
+
+    rgb_map = torch.zeros((H * W, 3))
+    disp_map = torch.zeros((H * W,))
+    acc_map = torch.zeros((H * W,))
+
+    def render_subset(index, **subset_kwargs):
+        rgb, disp, acc, _ = render(H, W, K, chunk=chunk, rays=torch.stack([rays_o[index], rays_d[index]], 0),
+                                   aux_scene_params=aux_scene_params, **subset_kwargs)
+        rgb_map[index], disp_map[index], acc_map[index] = rgb, disp, acc
+        return acc
+
+    if prev_frame is not None:
+        pred_depth, guided = reproject_depth(H, W, K, prev_frame['depth'], prev_frame['mask'],
+                                             prev_frame['c2w'], c2w, reproj_band)
+        pred_depth, guided = pred_depth.reshape(-1), guided.reshape(-1)
+    else:
+        guided = torch.zeros((H * W,), dtype=torch.bool)
+
+    guided_index = torch.nonzero(guided)[:, 0]
+    if guided_index.shape[0] > 0:
+        band_depth = pred_depth[guided_index, None]
+        acc = render_subset(guided_index,
+                            near=torch.clamp(band_depth - reproj_band, min=near, max=far),
+                            far=torch.clamp(band_depth + reproj_band, min=near, max=far),
+                            N_samples=reproj_samples, N_importance=reproj_importance, **kwargs)
+        # the band missed the surface, e.g. a new occluder moved in front of it
+        guided[guided_index[acc < reproj_acc_thresh]] = False
+
+    full_index = torch.nonzero(~guided)[:, 0]
+    if full_index.shape[0] > 0:
+        render_subset(full_index, near=near, far=far, N_samples=N_samples, N_importance=N_importance, **kwargs)
+
+    rgb_map = rgb_map.reshape(H, W, 3)
+    disp_map = disp_map.reshape(H, W)
+    acc_map = acc_map.reshape(H, W)
+    frame = {
+        'c2w': c2w,
+        'depth': 1. / torch.clamp(disp_map, min=1e-10),
+        'mask': acc_map > reproj_acc_thresh,
+        'reprojected': guided.reshape(H, W),
+    }
+    return rgb_map, disp_map, acc_map, frame
+
+
 def render_rays(ray_batch,
                 network_fn,
                 network_query_fn,
@@ -149,7 +290,8 @@ def render_rays(ray_batch,
                 raw_noise_std=0.,
                 verbose=False,
                 pytest=False,
-                aux_scene_params=None):
+                aux_scene_params=None,
+                profiler=None):
     """
     Volumetric rendering.
     Args:
@@ -170,6 +312,8 @@ def render_rays(ray_batch,
       white_bkgd: bool. If True, assume a white background.
       raw_noise_std: ...
       verbose: bool. If True, print more debugging info.
+      profiler: StepProfiler. If given, the phases of rendering are timed and the rays
+        and network samples are counted.
     Returns:
       rgb_map: [num_rays, 3]. Estimated RGB color of a ray. Comes from fine model.
       disp_map: [num_rays]. Disparity map. 1 / depth.
@@ -187,46 +331,59 @@ def render_rays(ray_batch,
     bounds = torch.reshape(ray_batch[..., 6:8], [-1, 1, 2])
     near, far = bounds[..., 0], bounds[..., 1]  # [-1,1]
 
-    t_vals = torch.linspace(0., 1., steps=N_samples)
-    if not lindisp:
-        z_vals = near * (1. - t_vals) + far * (t_vals)
-    else:
-        z_vals = 1. / (1. / near * (1. - t_vals) + 1. / far * (t_vals))
+    with phase(profiler, 'coarse_sampling'):
+        t_vals = torch.linspace(0., 1., steps=N_samples)
+        if not lindisp:
+            z_vals = near * (1. - t_vals) + far * (t_vals)
+        else:
+            z_vals = 1. / (1. / near * (1. - t_vals) + 1. / far * (t_vals))
 
-    z_vals = z_vals.expand([N_rays, N_samples])
+        z_vals = z_vals.expand([N_rays, N_samples])
 
-    if perturb > 0.:
-        # get intervals between samples
-        mids = .5 * (z_vals[..., 1:] + z_vals[..., :-1])
-        upper = torch.cat([mids, z_vals[..., -1:]], -1)
-        lower = torch.cat([z_vals[..., :1], mids], -1)
-        # stratified samples in those intervals
-        t_rand = torch.rand(z_vals.shape)
+        if perturb > 0.:
+            # get intervals between samples
+            mids = .5 * (z_vals[..., 1:] + z_vals[..., :-1])
+            upper = torch.cat([mids, z_vals[..., -1:]], -1)
+            lower = torch.cat([z_vals[..., :1], mids], -1)
+            # stratified samples in those intervals
+            t_rand = torch.rand(z_vals.shape)
 
-        z_vals = lower + (upper - lower) * t_rand
+            z_vals = lower + (upper - lower) * t_rand
 
-    pts = rays_o[..., None, :] + rays_d[..., None, :] * z_vals[..., :, None]  # [N_rays, N_samples, 3]
+        pts = rays_o[..., None, :] + rays_d[..., None, :] * z_vals[..., :, None]  # [N_rays, N_samples, 3]
 
     # query network with coarse samples
-    raw = network_query_fn(pts, viewdirs, network_fn, aux_scene_params=aux_scene_params)
-    rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss = raw2outputs(raw, z_vals, rays_d, raw_noise_std,
-                                                                                white_bkgd, pytest=pytest)
+    with phase(profiler, 'coarse_query'):
+        raw = network_query_fn(pts, viewdirs, network_fn, aux_scene_params=aux_scene_params)
+    with phase(profiler, 'compositing'):
+        rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss = raw2outputs(raw, z_vals, rays_d,
+                                                                                    raw_noise_std, white_bkgd,
+                                                                                    pytest=pytest)
 
     rgb_map_0, disp_map_0, acc_map_0, sparsity_loss_0 = rgb_map, disp_map, acc_map, sparsity_loss
+    n_network_samples = pts.shape[0] * pts.shape[1]
 
-    z_vals_mid = .5 * (z_vals[..., 1:] + z_vals[..., :-1])
-    z_samples = sample_pdf(z_vals_mid, weights[..., 1:-1], N_importance, det=(perturb == 0.), pytest=pytest)
-    z_samples = z_samples.detach()
+    with phase(profiler, 'fine_sampling'):
+        z_vals_mid = .5 * (z_vals[..., 1:] + z_vals[..., :-1])
+        z_samples = sample_pdf(z_vals_mid, weights[..., 1:-1], N_importance, det=(perturb == 0.), pytest=pytest)
+        z_samples = z_samples.detach()
 
-    z_vals, _ = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
-    pts = rays_o[..., None, :] + rays_d[..., None, :] * z_vals[..., :, None]  # [N_rays, N_samples + N_importance, 3]
+        z_vals, _ = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
+        pts = rays_o[..., None, :] + rays_d[..., None, :] * z_vals[..., :, None]  # [N_rays, N_samples + N_importance, 3]
 
     # query network with coarse and fine samples
     run_fn = network_fn if network_fine is None else network_fine
-    raw = network_query_fn(pts, viewdirs, run_fn, aux_scene_params=aux_scene_params)
+    with phase(profiler, 'fine_query'):
+        raw = network_query_fn(pts, viewdirs, run_fn, aux_scene_params=aux_scene_params)
+
+    with phase(profiler, 'compositing'):
+        rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss = raw2outputs(raw, z_vals, rays_d,
+                                                                                    raw_noise_std, white_bkgd,
+                                                                                    pytest=pytest)
 
-    rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss = raw2outputs(raw, z_vals, rays_d, raw_noise_std,
-                                                                                white_bkgd, pytest=pytest)
+    if profiler is not None:
+        profiler.count('rays', N_rays)
+        profiler.count('samples', n_network_samples + pts.shape[0] * pts.shape[1])
 
     ret = {'rgb_map': rgb_map, 'disp_map': disp_map, 'acc_map': acc_map, 'sparsity_loss': sparsity_loss}
     if retraw:
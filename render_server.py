@@ -0,0 +1,289 @@
+import asyncio
+import io
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import imageio
+import numpy as np
+import torch
+
+from argparser import config_parser
+from load_blender import load_blender_bbox
+from nerf_utils import device, get_rays, to8b
+from render import render
+
+STATUS = {
+    200: '200 OK',
+    400: '400 Bad Request',
+    404: '404 Not Found',
+    500: '500 Internal Server Error',
+}
+
+
+class RayBatcher:
+    def __init__(self, render_fn, max_batch_rays=1024 * 64, batch_window=0.):
+        """
+        Coalesce the rays of concurrent requests into shared renders.
+
+        Requests queue up while a batch renders on a worker thread. The next batch then takes as many queued
+        requests as fit into max_batch_rays, so that they share the chunks of a single batchify_rays call.
+
+        Only requests of the same model are batched together, the model is passed to render_fn as its
+        render_kwargs.
+
+        :param render_fn: callable(render_kwargs, rays, aux_scene_params) returning rgb, disp and acc arrays,
+            one row per ray.
+        :param max_batch_rays: int. Rays of a batch, a larger request is rendered alone.
+        :param batch_window: float. Seconds to wait for more requests before rendering a batch.
+        """
+        self.render_fn = render_fn
+        self.max_batch_rays = max_batch_rays
+        self.batch_window = batch_window
+        # a single thread renders, batches queue up behind it
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.wakeup = asyncio.Event()
+
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_rays = 0
+
+    async def submit(self, render_kwargs, rays, aux_scene_params):
+        """
+        Render rays of shape (2, N, 3) with aux_scene_params of shape (N, n_aux) once they are batched.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((render_kwargs, rays, aux_scene_params, future))
+        self.n_requests += 1
+        self.wakeup.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+
+            # requests whose clients disconnected while queued have their futures cancelled
+            self.pending = [request for request in self.pending if not request[3].done()]
+            if not self.pending:
+                self.wakeup.clear()
+                continue
+
+            # requests of the model of the oldest request, in order of arrival
+            render_kwargs = self.pending[0][0]
+            batch, n_rays = [], 0
+            for request in list(self.pending):
+                if request[0] is not render_kwargs:
+                    continue
+                if batch and n_rays + request[1].shape[1] > self.max_batch_rays:
+                    break
+                self.pending.remove(request)
+                batch.append(request)
+                n_rays += request[1].shape[1]
+            if not self.pending:
+                self.wakeup.clear()
+
+            # a failing batch fails its requests only, the batcher serves all later requests
+            try:
+                rays = torch.cat([rays for _, rays, _, _ in batch], 1)
+                aux_scene_params = torch.cat([aux for _, _, aux, _ in batch], 0)
+                outputs = await loop.run_in_executor(self.executor, self.render_fn, render_kwargs, rays,
+                                                     aux_scene_params)
+
+                self.n_batches += 1
+                self.n_rays += n_rays
+                start = 0
+                for _, request_rays, _, future in batch:
+                    end = start + request_rays.shape[1]
+                    if not future.done():
+                        future.set_result([output[start:end] for output in outputs])
+                    start = end
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self):
+        return {
+            'requests': self.n_requests,
+            'batches': self.n_batches,
+            'rays': self.n_rays,
+            'requests_per_batch': self.n_requests / max(self.n_batches, 1),
+            'pending': len(self.pending),
+        }
+
+
+class RenderServer:
+    def __init__(self, render_kwargs=None, chunk=1024 * 32, n_aux=0, max_batch_rays=1024 * 64, batch_window=0.,
+                 registry=None):
+        """
+        Minimal HTTP server rendering images from warm models, either a single model or the scenes of a
+        ModelRegistry.
+
+        POST /render takes a JSON object with
+            pose: 3x4 or 4x4 camera to world matrix.
+            H, W: resolution.
+            focal, or K: 3x3 intrinsic matrix.
+            aux: list of n_aux auxiliary scene params, zeros by default.
+            scene: name of the scene, required with a registry.
+            format: 'png' for an 8 bit image, or 'npy' for the float32 rgb array.
+        GET /stats returns the batching and registry statistics.
+
+        :param render_kwargs: The keyword arguments of render() for testing, including near and far.
+            Ignored if registry is given.
+        :param chunk: int. Rays rendered at once within a batch.
+        :param n_aux: int. Number of auxiliary scene params of the model.
+        :param max_batch_rays: int. See RayBatcher.
+        :param batch_window: float. See RayBatcher.
+        :param registry: ModelRegistry. Scenes served by name, loaded on demand.
+        """
+        if registry is None and render_kwargs.get('ndc', True):
+            raise ValueError('the render server does not support NDC rays')
+
+        self.render_kwargs = render_kwargs
+        self.chunk = chunk
+        self.n_aux = n_aux
+        self.registry = registry
+        self.batcher = RayBatcher(self.render_rays, max_batch_rays, batch_window)
+
+    def render_rays(self, render_kwargs, rays, aux_scene_params):
+        # runs on the batcher's thread, where grad mode is not inherited
+        with torch.no_grad():
+            rgb, disp, acc, _ = render(0, 0, None, chunk=self.chunk, rays=rays, aux_scene_params=aux_scene_params,
+                                       **render_kwargs)
+        return rgb.cpu().numpy(), disp.cpu().numpy(), acc.cpu().numpy()
+
+    async def model(self, request):
+        """
+        The render_kwargs and the number of aux params of the model of request.
+        """
+        if self.registry is None:
+            return self.render_kwargs, self.n_aux
+        # loading a scene blocks, so it runs outside of the event loop
+        scene = await asyncio.get_running_loop().run_in_executor(None, self.registry.get, request['scene'])
+        if scene['render_kwargs'].get('ndc', True):
+            raise ValueError('the render server does not support NDC rays')
+        return scene['render_kwargs'], scene['n_aux']
+
+    async def render_request(self, request):
+        render_kwargs, n_aux = await self.model(request)
+        H, W = int(request['H']), int(request['W'])
+        if H <= 0 or W <= 0:
+            raise ValueError('expected a positive resolution, got {}x{}'.format(H, W))
+        if 'K' in request:
+            K = np.array(request['K'], dtype=np.float32)
+            if K.shape != (3, 3):
+                raise ValueError('expected K of shape (3, 3), got {}'.format(K.shape))
+        else:
+            focal = float(request['focal'])
+            K = np.array([[focal, 0, 0.5 * W], [0, focal, 0.5 * H], [0, 0, 1]], dtype=np.float32)
+        pose = np.array(request['pose'], dtype=np.float32)
+        if pose.shape not in ((3, 4), (4, 4)):
+            raise ValueError('expected a pose of shape (3, 4) or (4, 4), got {}'.format(pose.shape))
+        c2w = torch.Tensor(pose[:3, :4]).to(device)
+        aux = np.array(request.get('aux', [0.] * n_aux), dtype=np.float32).reshape(-1)
+        if aux.shape[0] != n_aux:
+            raise ValueError('expected {} aux params, got {}'.format(n_aux, aux.shape[0]))
+
+        rays_o, rays_d = get_rays(H, W, K, c2w)
+        rays = torch.stack([rays_o.reshape(-1, 3), rays_d.reshape(-1, 3)], 0)
+        aux_scene_params = torch.Tensor(aux).to(device).expand(H * W, -1)
+
+        rgb, _, _ = await self.batcher.submit(render_kwargs, rays, aux_scene_params)
+        rgb = rgb.reshape(H, W, 3)
+
+        if request.get('format', 'png') == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, rgb.astype(np.float32))
+            return 'application/octet-stream', buffer.getvalue()
+        return 'image/png', imageio.imwrite('<bytes>', to8b(rgb), format='png')
+
+    async def dispatch(self, method, path, body):
+        if method == 'POST' and path == '/render':
+            try:
+                request = json.loads(body)
+                content_type, payload = await self.render_request(request)
+            except (KeyError, ValueError, TypeError) as e:
+                return 400, 'application/json', json.dumps({'error': repr(e)}).encode()
+            return 200, content_type, payload
+        if method == 'GET' and path == '/stats':
+            stats = self.batcher.stats()
+            if self.registry is not None:
+                stats['registry'] = self.registry.stats()
+            return 200, 'application/json', json.dumps(stats).encode()
+        return 404, 'application/json', json.dumps({'error': 'not found'}).encode()
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            t = time.time()
+            status, content_type, payload = await self.dispatch(method, path, body)
+            print('{} {} {} {:.1f} ms'.format(method, path, status, 1e3 * (time.time() - t)))
+        except Exception:
+            status, content_type, payload = 500, 'text/plain', traceback.format_exc().encode()
+
+        writer.write('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+            STATUS[status], content_type, len(payload)).encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving on http://{}:{}'.format(host, port))
+        batcher = asyncio.ensure_future(self.batcher.run())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def main():
+    # imported here since run_nerf is heavy and only needed to build the models
+    from run_nerf import create_nerf, nerf_model_kwargs
+    from model_registry import ModelRegistry
+
+    parser = config_parser()
+    parser.add_argument("--host", type=str, default='127.0.0.1', help='address the render server listens on')
+    parser.add_argument("--port", type=int, default=8765, help='port of the render server')
+    parser.add_argument("--max_batch_rays", type=int, default=1024 * 64,
+                        help='maximal number of rays of concurrent requests rendered together')
+    parser.add_argument("--batch_window_ms", type=float, default=0.,
+                        help='time to wait for more requests before rendering a batch')
+    args = parser.parse_args()
+
+    batch_kwargs = dict(chunk=args.chunk, max_batch_rays=args.max_batch_rays,
+                        batch_window=args.batch_window_ms / 1e3)
+    if args.scenes is not None:
+        registry = ModelRegistry.from_file(args, args.scenes, args.registry_mem_mb * 2 ** 20,
+                                           prefetch=args.registry_prefetch)
+        server = RenderServer(registry=registry, **batch_kwargs)
+    else:
+        bounding_box, near, far = load_blender_bbox(args.datadir)
+        _, render_kwargs_test, _, _, _ = create_nerf(args, bounding_box=bounding_box)
+        render_kwargs_test.update({'near': near, 'far': far})
+        server = RenderServer(render_kwargs_test, n_aux=nerf_model_kwargs(args).get('nAuxParams', 0),
+                              **batch_kwargs)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+    main()
@@ -0,0 +1,113 @@
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import imageio
+import numpy as np
+
+from nerf_utils import to8b
+
+
+class RenderWriter:
+    def __init__(self, video_path=None, disp_video_path=None, n_threads=4, max_pending=16, fps=30, quality=8):
+        """
+        Write rendered frames in the background, so that rendering does not wait on disk.
+
+        PNGs are encoded on a thread pool, while a single thread appends frames to the videos in order.
+        The disparity video is normalized by the maximum disparity over all frames. Disparity frames are
+        therefore spilled to a temporary file while the running maximum is tracked, and encoded in a second
+        pass when the writer is closed. Neither the rgb nor the disparity frames are kept in memory.
+
+        :param video_path: str. Path of the rgb video, or None to not write it.
+        :param disp_video_path: str. Path of the disparity video, or None to not write it.
+        :param n_threads: int. Number of threads encoding PNGs.
+        :param max_pending: int. Maximum number of writes in flight. Rendering only blocks once the
+            writer falls this far behind, which bounds the memory held by queued frames.
+        :param fps: int. Frame rate of the videos.
+        :param quality: int. Quality of the videos, see imageio's ffmpeg writer.
+        """
+        self.png_pool = ThreadPoolExecutor(max_workers=n_threads)
+        # a single worker keeps the video frames in order
+        self.video_pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+        self.fps = fps
+        self.quality = quality
+        self.rgb_video = imageio.get_writer(video_path, fps=fps, quality=quality) if video_path is not None else None
+
+        self.disp_video_path = disp_video_path
+        self.disp_file = tempfile.TemporaryFile() if disp_video_path is not None else None
+        self.disp_shape = None
+        self.disp_max = 0.
+        self.n_frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, rgb, disp=None, png_path=None):
+        """
+        Queue a rendered frame.
+
+        :param rgb: array of shape (H, W, 3). The rendered image in [0, 1].
+        :param disp: array of shape (H, W). The disparity map, required if a disparity video is written.
+        :param png_path: str. If given, the image is also saved as a PNG to this path.
+        """
+        if png_path is not None:
+            self._submit(self.png_pool, self._write_png, png_path, rgb)
+        if self.rgb_video is not None or self.disp_file is not None:
+            self._submit(self.video_pool, self._append_frame, rgb, disp)
+        self.n_frames += 1
+
+    def close(self):
+        """
+        Wait for all queued frames, encode the disparity video and release the encoders.
+        """
+        self.png_pool.shutdown(wait=True)
+        self.video_pool.shutdown(wait=True)
+        try:
+            # re-raise errors of the background writes
+            for future in self.futures:
+                future.result()
+        finally:
+            if self.rgb_video is not None:
+                self.rgb_video.close()
+                self.rgb_video = None
+
+        if self.disp_file is not None:
+            self._encode_disp_video()
+            self.disp_file.close()
+            self.disp_file = None
+
+    def _submit(self, pool, fn, *args):
+        self.pending.acquire()
+        future = pool.submit(fn, *args)
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures.append(future)
+
+    @staticmethod
+    def _write_png(path, rgb):
+        imageio.imwrite(path, to8b(rgb))
+
+    def _append_frame(self, rgb, disp):
+        if self.rgb_video is not None:
+            self.rgb_video.append_data(to8b(rgb))
+        if self.disp_file is not None:
+            disp = np.asarray(disp, dtype=np.float32)
+            self.disp_shape = disp.shape
+            self.disp_max = max(self.disp_max, float(np.max(disp)))
+            disp.tofile(self.disp_file)
+
+    def _encode_disp_video(self):
+        if self.disp_shape is None:
+            return
+
+        self.disp_file.seek(0)
+        frame_size = int(np.prod(self.disp_shape))
+        with imageio.get_writer(self.disp_video_path, fps=self.fps, quality=self.quality) as video:
+            for _ in range(self.n_frames):
+                disp = np.fromfile(self.disp_file, dtype=np.float32, count=frame_size).reshape(self.disp_shape)
+                video.append_data(to8b(disp / max(self.disp_max, 1e-10)))
@@ -1,7 +1,9 @@
 import os
+import json
 import imageio
 import time
 import torch.nn.functional
+from contextlib import nullcontext
 
 from tqdm import tqdm, trange
 from datetime import datetime
@@ -9,59 +11,152 @@ from datetime import datetime
 from NeRF import NeRF
 
 from render import *
+from render_writer import RenderWriter
+from eval_worker import EvalWorker
+from validation import RayValidator
+from profiler import StepProfiler, phase
+from sync_detector import SyncDetector
+from autotune import autotune
+from model_registry import ModelRegistry
+from export_model import is_exported_model, load_exported_model
+from hash_compression import is_compressed_model, load_compressed_model
+from mixed_precision import DTYPES, grad_scaler, use_mixed_precision
+from quantize_mlp import quantize_for_render
+from compile_utils import compile_module, maybe_compile
+from parallel_render import render_images_parallel
+from dist_train import GradientAllReduce, broadcast_models, broadcast_object, get_rank, is_distributed
 from argparser import config_parser
-from load_blender import load_blender_data
+from load_blender import load_blender_camera, load_blender_data
 
 np.random.seed(0)
 
 
-def run_network(pts, view_dir, model, chunk=1024 * 64, aux_scene_params=None):
+def run_network(pts, view_dir, model, chunk=1024 * 64, aux_scene_params=None, precision=None):
     xx = pts
     pts_flatten = pts.view(pts.shape[0] * pts.shape[1], pts.shape[2])  # (N, 64, 3) -> (N * 64, 3)
     view_dir = view_dir.view(view_dir.shape[0], 1, view_dir.shape[1])  # (N, 3) -> (N, 1, 3)
     view_dir = view_dir.repeat(1, xx.shape[1], 1)  # (N, 1, 3) -> (N, 64, 3)
     view_dir = view_dir.view(view_dir.shape[0] * view_dir.shape[1], view_dir.shape[2])  # (N, 64, 3) -> (N * 64, 3)
 
-    outputs_flat = torch.cat([model(pts_flatten[i:i + chunk], view_dir[i:i + chunk], p=aux_scene_params)
-                              for i in range(0, pts_flatten.shape[0], chunk)], 0)
+    per_point_aux = aux_scene_params is not None and aux_scene_params.dim() == 2
+    if per_point_aux:
+        # one set of auxiliary params per ray, (N, n_aux) -> (N * 64, n_aux)
+        aux_scene_params = aux_scene_params[:, None].expand(-1, xx.shape[1], -1)
+        aux_scene_params = aux_scene_params.reshape(-1, aux_scene_params.shape[-1])
+
+    # the encoders and the MLP run in reduced precision, compositing the outputs stays in float32
+    with torch.autocast(device.type, dtype=precision, enabled=precision is not None):
+        outputs_flat = torch.cat([model(pts_flatten[i:i + chunk], view_dir[i:i + chunk],
+                                        p=aux_scene_params[i:i + chunk] if per_point_aux else aux_scene_params)
+                                  for i in range(0, pts_flatten.shape[0], chunk)], 0)
+    outputs_flat = outputs_flat.float()
     outputs = torch.reshape(outputs_flat, list(pts.shape[:-1]) + [outputs_flat.shape[-1]])
     return outputs
 
 
-def create_nerf(args, bounding_box=None):
+def nerf_model_kwargs(args, bounding_box=None):
     """
-    Instantiate NeRF's MLP model.
+    Keyword arguments of NeRF for the coarse and fine models described by args.
     """
     if args.i_embed == 1:
-        model = NeRF(StemDepth=1, ColorDepth=3,
-                     StemHiddenDim=64, ColorHiddenDim=64,
-                     GeoFeatDim=15, RequiresPositionEmbedding=(0,),
-                     INGP=True, BoundingBox=bounding_box,
-                     Log2TableSize=args.log2_hashmap_size,
-                     FinestRes=args.finest_res, nAuxParams=1).to(device)
-    else:
-        model = NeRF().to(device)
+        return dict(StemDepth=1, ColorDepth=3,
+                    StemHiddenDim=64, ColorHiddenDim=64,
+                    GeoFeatDim=15, RequiresPositionEmbedding=(0,),
+                    INGP=True, BoundingBox=bounding_box,
+                    Log2TableSize=args.log2_hashmap_size,
+                    FinestRes=args.finest_res, nAuxParams=1)
+    return dict(nAuxParams=1)
 
-    grad_vars = list(model.parameters())
 
-    model_fine = None
+def create_models(args, bounding_box=None):
+    """
+    Instantiate the coarse and fine NeRF models, model_fine is None without importance sampling.
+    """
+    model = NeRF(**nerf_model_kwargs(args, bounding_box)).to(device)
 
+    model_fine = None
     if args.N_importance > 0:
-        if args.i_embed == 1:
-            model_fine = NeRF(StemDepth=1, ColorDepth=3,
-                              StemHiddenDim=64, ColorHiddenDim=64,
-                              GeoFeatDim=15, RequiresPositionEmbedding=(0,),
-                              INGP=True, BoundingBox=bounding_box,
-                              Log2TableSize=args.log2_hashmap_size,
-                              FinestRes=args.finest_res, nAuxParams=1).to(device)
-        else:
-            model_fine = NeRF().to(device)
+        model_fine = NeRF(**nerf_model_kwargs(args, bounding_box)).to(device)
+
+    return model, model_fine
 
-        grad_vars += list(model_fine.parameters())
+
+def create_render_kwargs(args, model, model_fine):
+    """
+    Build the keyword arguments of render() for training and testing.
+    With args.compile, the forward of the models and render_rays, i.e. the network queries and the whole
+    forward and backward of a training batch, are compiled.
+    """
+    if args.compile != 'none':
+        for m in (model, model_fine):
+            if m is not None:
+                compile_module(m, args.compile)
 
     network_query_fn = lambda inputs, viewdirs, network_fn, aux_scene_params: run_network(
                                                                         inputs, viewdirs, network_fn,
-                                                                        chunk=args.netchunk, aux_scene_params=aux_scene_params)
+                                                                        chunk=args.netchunk, aux_scene_params=aux_scene_params,
+                                                                        precision=DTYPES[args.mixed_precision])
+
+    render_kwargs_train = {
+        'network_query_fn': network_query_fn,
+        'perturb': args.perturb,
+        'N_importance': args.N_importance,
+        'network_fine': model_fine,
+        'N_samples': args.N_samples,
+        'network_fn': model,
+        'use_viewdirs': args.use_viewdirs,
+        'white_bkgd': args.white_bkgd,
+        'raw_noise_std': args.raw_noise_std,
+    }
+    if args.compile == 'torch_compile':
+        # TorchScript can not compile the sampling in render_rays, only the models
+        render_kwargs_train['render_rays_fn'] = maybe_compile(render_rays, args.compile)
+
+    # NDC only good for LLFF-style forward facing data
+    if args.dataset_type != 'llff' or args.no_ndc:
+        if get_rank() == 0:
+            print('Not ndc!')
+        render_kwargs_train['ndc'] = False
+        render_kwargs_train['lindisp'] = args.lindisp
+
+    render_kwargs_test = {k: render_kwargs_train[k] for k in render_kwargs_train}
+    render_kwargs_test['perturb'] = False
+    render_kwargs_test['raw_noise_std'] = 0.
+
+    return render_kwargs_train, render_kwargs_test
+
+
+def create_nerf(args, bounding_box=None):
+    """
+    Instantiate NeRF's MLP model.
+
+    If args.ft_path is a model written by export_model, its weights are mapped from the file instead, with the
+    bounding box and model configuration stored in it, and the optimizer starts without state.
+    The same holds for models compressed by hash_compression, whose hash tables are dequantized at load time,
+    or on every lookup with args.quantized_lookup.
+    With args.mixed_precision, the hash tables are gathered from bf16 or fp16 copies of the float32 weights.
+    With args.morton_sort, the samples of each network chunk are looked up in Z-order.
+    """
+    exported = args.ft_path is not None and (is_exported_model(args.ft_path) or is_compressed_model(args.ft_path))
+    if exported and is_compressed_model(args.ft_path):
+        model, model_fine, bounding_box, start = load_compressed_model(args.ft_path, args.quantized_lookup)
+        print('Loaded compressed model', args.ft_path)
+    elif exported:
+        model, model_fine, bounding_box, start = load_exported_model(args.ft_path)
+        print('Loaded exported model', args.ft_path)
+    else:
+        model, model_fine = create_models(args, bounding_box)
+        start = 0
+
+    for m in (model, model_fine):
+        if m is not None:
+            use_mixed_precision(m, DTYPES[args.mixed_precision])
+            if m.isINGP():
+                m.PositionEmbedding.morton_sort = args.morton_sort
+
+    grad_vars = list(model.parameters())
+    if model_fine is not None:
+        grad_vars += list(model_fine.parameters())
 
     # Create optimizer
     if args.i_embed == 1:
@@ -69,23 +164,27 @@ def create_nerf(args, bounding_box=None):
     else:
         optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
 
-    start = 0
     basedir = args.basedir
     expname = args.expname
 
     ##########################
 
     # Load checkpoints
-    if args.ft_path is not None and args.ft_path != 'None':
+    if exported:
+        # the weights are already loaded, exported models have no optimizer state
+        ckpts = []
+    elif args.ft_path is not None and args.ft_path != 'None':
         ckpts = [args.ft_path]
     else:
         ckpts = [os.path.join(basedir, expname, f) for f in sorted(os.listdir(os.path.join(basedir, expname))) if
                  'tar' in f]
 
-    print('Found ckpts', ckpts)
+    if get_rank() == 0:
+        print('Found ckpts', ckpts)
     if len(ckpts) > 0 and not args.no_reload:
         ckpt_path = ckpts[-1]
-        print('Reloading from', ckpt_path)
+        if get_rank() == 0:
+            print('Reloading from', ckpt_path)
         ckpt = torch.load(ckpt_path)
 
         start = ckpt['global_step']
@@ -98,32 +197,54 @@ def create_nerf(args, bounding_box=None):
 
     ##########################
 
-    render_kwargs_train = {
-        'network_query_fn': network_query_fn,
-        'perturb': args.perturb,
-        'N_importance': args.N_importance,
-        'network_fine': model_fine,
-        'N_samples': args.N_samples,
-        'network_fn': model,
-        'use_viewdirs': args.use_viewdirs,
-        'white_bkgd': args.white_bkgd,
-        'raw_noise_std': args.raw_noise_std,
+    render_kwargs_train, render_kwargs_test = create_render_kwargs(args, model, model_fine)
+
+    return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer
+
+
+def create_reproject_kwargs(args):
+    """
+    Collect the temporal reprojection options for rendering camera paths, None if disabled.
+    """
+    if not args.render_reproject:
+        return None
+    if args.dataset_type == 'llff' and not args.no_ndc:
+        print('Reprojection is not supported with NDC rays, rendering every frame in full')
+        return None
+
+    return {
+        'reproj_keyframe': args.reproj_keyframe,
+        'reproj_band': args.reproj_band,
+        'reproj_samples': args.reproj_samples,
+        'reproj_importance': args.reproj_importance,
+        'reproj_acc_thresh': args.reproj_acc_thresh,
     }
 
-    # NDC only good for LLFF-style forward facing data
-    if args.dataset_type != 'llff' or args.no_ndc:
-        print('Not ndc!')
-        render_kwargs_train['ndc'] = False
-        render_kwargs_train['lindisp'] = args.lindisp
 
-    render_kwargs_test = {k: render_kwargs_train[k] for k in render_kwargs_train}
-    render_kwargs_test['perturb'] = False
-    render_kwargs_test['raw_noise_std'] = 0.
+def path_light_values(n_frames):
+    """
+    The light intensity of every frame of a rendered path, sampled at x in [0.0, 2.0] as abs(sin(x * pi/2))^2.
+    """
+    light_vals = torch.linspace(0.0, 2.0, n_frames)
+    return torch.abs(torch.sin(light_vals * 3.14159265/2.0)) ** 2.0
 
-    return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer
 
+def render_images(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, savedir=None, render_factor=0,
+                  aux_scene_params=None, reproject_kwargs=None, tile=0, memmap_dir=None, batch_poses=1,
+                  writer=None):
+    """
+    Render a sequence of poses. If reproject_kwargs is given, consecutive poses are treated as a camera
+    path and each frame reuses the previous frame's depth (see render_reprojected).
+    If tile > 0, frames are rendered tile by tile (see render_tiled), into .npy files memory-mapped
+    from memmap_dir if it is given.
+    If batch_poses > 1, the rays of that many consecutive poses are rendered as one stream
+    (see render_batched).
+    Frames are saved in the background by a RenderWriter. If the caller passes its own writer, frames are
+    handed to it instead of being kept in memory and None is returned in place of the stacked frames.
+    """
+    if tile > 0 and (reproject_kwargs is not None or batch_poses > 1):
+        raise ValueError('tiled rendering can not be combined with reprojection or batched poses')
 
-def render_images(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, savedir=None, render_factor=0, aux_scene_params=None):
     H, W, focal = hwf
 
     if render_factor != 0:
@@ -137,12 +258,14 @@ def render_images(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, save
     disps = []
     psnrs = []
 
+    keep_frames = writer is None
+    if keep_frames:
+        writer = RenderWriter()
+
     t = time.time()
 
     # FOR RENDERING VIDEO WITH VARYING LIGHT INTENSITY:
-    # sample x in [0.0, 2.0] : abs(sin(x * pi/2))^2
-    light_vals = torch.linspace(0.0, 2.0, len(render_poses))
-    light_vals = torch.abs(torch.sin(light_vals * 3.14159265/2.0)) ** 2.0
+    light_vals = path_light_values(len(render_poses))
 
     # FOR RENDERING VIDEO WITH VARYING LIGHT POSITION:
     # ts = torch.linspace(0.0, 2 * 3.141592, len(render_poses))
@@ -165,64 +288,172 @@ def render_images(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, save
     # obj_poses = obj_poses.t()
     # print(obj_poses)
 
-    for i, c2w in enumerate(tqdm(render_poses)):
-        print(i, time.time() - t)
-        t = time.time()
-        # if aux_scene_params is None:
-        #     aux_scene_param = torch.tensor(0.1)
-        # else:
-        #     aux_scene_param = aux_scene_params[i]
-        aux_scene_param = light_vals[i]
-        # aux_scene_param = light_poses[i]
-        # aux_scene_param = diffuse_vals[i]
-        # aux_scene_param = obj_poses[i]
-        rgb, disp, acc, _ = render(H, W, K, chunk=chunk, c2w=c2w[:3, :4], aux_scene_params=aux_scene_param, **render_kwargs)
-        rgbs.append(rgb.cpu().numpy())
-        disps.append(disp.cpu().numpy())
-        if i == 0:
-            print(rgb.shape, disp.shape)
-
-        if gt_imgs is not None and render_factor == 0:
-            p = -10. * np.log10(np.mean(np.square(rgb.cpu().numpy() - gt_imgs[i])))
-            print(p)
-            psnrs.append(p)
-
-        if savedir is not None:
-            rgb8 = to8b(rgbs[-1])
-            filename = os.path.join(savedir, '{:03d}.png'.format(i))
-            imageio.imwrite(filename, rgb8)
-
-    rgbs = np.stack(rgbs, 0)
-    disps = np.stack(disps, 0)
+    try:
+        batched = {}
+        for i, c2w in enumerate(tqdm(render_poses)):
+            print(i, time.time() - t)
+            t = time.time()
+            # if aux_scene_params is None:
+            #     aux_scene_param = torch.tensor(0.1)
+            # else:
+            #     aux_scene_param = aux_scene_params[i]
+            aux_scene_param = light_vals[i]
+            # aux_scene_param = light_poses[i]
+            # aux_scene_param = diffuse_vals[i]
+            # aux_scene_param = obj_poses[i]
+            if reproject_kwargs is not None:
+                keyframe = reproject_kwargs['reproj_keyframe']
+                if i == 0 or (keyframe > 0 and i % keyframe == 0):
+                    prev_frame = None
+                rgb, disp, acc, prev_frame = render_reprojected(H, W, K, c2w[:3, :4], prev_frame=prev_frame, chunk=chunk,
+                                                                aux_scene_params=aux_scene_param,
+                                                                **{k: v for k, v in reproject_kwargs.items()
+                                                                   if k != 'reproj_keyframe'},
+                                                                **render_kwargs)
+                print('reprojected {:.1%} of pixels'.format(prev_frame['reprojected'].float().mean().item()))
+            elif batch_poses > 1:
+                if i not in batched:
+                    group = range(i, min(i + batch_poses, len(render_poses)))
+                    rgb, disp, acc, _ = render_batched(H, W, K, render_poses[group.start:group.stop, :3, :4],
+                                                       aux_scene_params=[light_vals[j] for j in group], chunk=chunk,
+                                                       **render_kwargs)
+                    batched = {j: (rgb[k], disp[k]) for k, j in enumerate(group)}
+                rgb, disp = batched.pop(i)
+            elif tile > 0:
+                rgb_out, disp_out = None, None
+                if memmap_dir is not None:
+                    rgb_out = np.lib.format.open_memmap(os.path.join(memmap_dir, '{:03d}_rgb.npy'.format(i)),
+                                                        mode='w+', dtype=np.float32, shape=(H, W, 3))
+                    disp_out = np.lib.format.open_memmap(os.path.join(memmap_dir, '{:03d}_disp.npy'.format(i)),
+                                                         mode='w+', dtype=np.float32, shape=(H, W))
+                rgb, disp, acc = render_tiled(H, W, K, c2w[:3, :4], tile=tile, chunk=chunk, rgb_out=rgb_out,
+                                              disp_out=disp_out, aux_scene_params=aux_scene_param, **render_kwargs)
+            else:
+                rgb, disp, acc, _ = render(H, W, K, chunk=chunk, c2w=c2w[:3, :4], aux_scene_params=aux_scene_param,
+                                           **render_kwargs)
+            if torch.is_tensor(rgb):
+                rgb, disp = rgb.cpu().numpy(), disp.cpu().numpy()
+            if keep_frames:
+                rgbs.append(rgb)
+                disps.append(disp)
+            if i == 0:
+                print(rgb.shape, disp.shape)
+
+            if gt_imgs is not None and render_factor == 0:
+                p = -10. * np.log10(np.mean(np.square(rgb - gt_imgs[i])))
+                print(p)
+                psnrs.append(p)
+
+            filename = os.path.join(savedir, '{:03d}.png'.format(i)) if savedir is not None else None
+            writer.write(rgb, disp, png_path=filename)
+    finally:
+        if keep_frames:
+            writer.close()
+
     if gt_imgs is not None and render_factor == 0:
         print("Avg PSNR over Test set: ", sum(psnrs) / len(psnrs))
 
-    return rgbs, disps
+    if not keep_frames:
+        return None, None
 
+    return np.stack(rgbs, 0), np.stack(disps, 0)
 
-def train():
-    parser = config_parser()
-    args = parser.parse_args()
 
-    # Load data
-    K = None
-    if args.dataset_type == 'blender':
-        images, poses, render_poses, hwf, i_split, bounding_box, near, far, aux_scene_params = load_blender_data(args.datadir,
-                                                                                               args.half_res,
-                                                                                               args.testskip,
-                                                                                               args.use_aux_params)
-        args.bounding_box = bounding_box
-        print('Loaded blender', images.shape, render_poses.shape, hwf, args.datadir)
-        i_train, i_val, i_test = i_split
+def render_scenes(args):
+    """
+    Render the orbiting path of several scenes with --render_only, loading them through a ModelRegistry.
+
+    :return: str. The directory of the rendered scenes.
+    """
+    registry = ModelRegistry.from_file(args, args.scenes, args.registry_mem_mb * 2 ** 20,
+                                       prefetch=args.registry_prefetch)
+    outdir = os.path.join(args.basedir, args.expname)
+    for name in args.render_scenes or list(registry.scenes):
+        scene = registry.get(name)
+        render_poses, hwf = load_blender_camera(scene['args'].datadir, args.half_res)
+        H, W, focal = hwf
+        K = np.array([
+            [focal, 0, 0.5 * W],
+            [0, focal, 0.5 * H],
+            [0, 0, 1]
+        ])
+
+        savedir = os.path.join(outdir, name)
+        os.makedirs(savedir, exist_ok=True)
+        with torch.no_grad(), RenderWriter(video_path=os.path.join(savedir, 'video.mp4'),
+                                           n_threads=args.writer_threads) as writer:
+            render_images(render_poses.to(device), hwf, K, scene['args'].chunk, scene['render_kwargs'],
+                          savedir=savedir, render_factor=args.render_factor, writer=writer)
+        print('Done rendering', savedir)
+
+    stats = registry.stats()
+    print('Registry:', stats)
+    with open(os.path.join(outdir, 'registry_stats.json'), 'w') as fp:
+        json.dump(stats, fp, indent=2)
+    return outdir
 
-        if args.white_bkgd:
-            images = images[..., :3] * images[..., -1:] + (1. - images[..., -1:])
-        else:
-            images = images[..., :3]
 
+def load_dataset(args):
+    """
+    Load the scene of args, with the images composited over a white background with args.white_bkgd.
+
+    :return: dict of the images, poses, render_poses, hwf, i_split, bounding_box, near, far and
+        aux_scene_params of load_blender_data, None for an unknown dataset type
+    """
+    if args.dataset_type != 'blender':
+        return None
+    images, poses, render_poses, hwf, i_split, bounding_box, near, far, aux_scene_params = load_blender_data(
+        args.datadir, args.half_res, args.testskip, args.use_aux_params)
+    if get_rank() == 0:
+        print('Loaded blender', images.shape, render_poses.shape, hwf, args.datadir)
+
+    if args.white_bkgd:
+        images = images[..., :3] * images[..., -1:] + (1. - images[..., -1:])
     else:
+        images = images[..., :3]
+
+    return {'images': images, 'poses': poses, 'render_poses': render_poses, 'hwf': hwf, 'i_split': i_split,
+            'bounding_box': bounding_box, 'near': near, 'far': far, 'aux_scene_params': aux_scene_params}
+
+
+def train(cmdline=None, dataset=None, callback=None, stop_event=None):
+    """
+    Train a model, or only render it with --render_only.
+    Run by dist_train in every process of a distributed training, and by sweep in every job of a sweep.
+
+    :param cmdline: list of str. The command line arguments, sys.argv is parsed if None.
+    :param dataset: dict. The scene as returned by load_dataset, loaded from args.datadir if None.
+    :param callback: function called with the record of every held-out ray validation (see --i_val_rays).
+    :param stop_event: Event. Training stops before the next step once it is set.
+    :return: str. The experiment directory.
+    """
+    parser = config_parser()
+    args = parser.parse_args(cmdline)
+    if args.render_tile > 0 and (args.render_reproject or args.render_batch_poses > 1):
+        parser.error('--render_tile can not be combined with --render_reproject or --render_batch_poses')
+    if args.render_workers > 0 and (args.render_reproject or args.render_batch_poses > 1 or args.render_factor):
+        parser.error('--render_workers can not be combined with --render_reproject, --render_batch_poses or '
+                     '--render_factor')
+    if args.render_only and args.scenes is not None:
+        return render_scenes(args)
+    # in distributed training, see dist_train, every rank samples its own rays and rank 0 logs and saves
+    rank = get_rank()
+    if is_distributed():
+        np.random.seed(rank)
+        torch.manual_seed(rank)
+
+    # Load data
+    K = None
+    if dataset is None:
+        dataset = load_dataset(args)
+    if dataset is None:
         print('Unknown dataset type', args.dataset_type, 'exiting')
         return
+    images, poses, render_poses, hwf, i_split, bounding_box, near, far, aux_scene_params = (
+        dataset[k] for k in ('images', 'poses', 'render_poses', 'hwf', 'i_split', 'bounding_box', 'near', 'far',
+                             'aux_scene_params'))
+    args.bounding_box = bounding_box
+    i_train, i_val, i_test = i_split
 
     # Cast intrinsics to right types
     H, W, focal = hwf
@@ -245,25 +476,34 @@ def train():
         args.expname += "_INGP"
         args.expname += "_log2T" + str(args.log2_hashmap_size)
     args.expname += datetime.now().strftime('_%d_%H_%M')
+    # the ranks may start in different minutes
+    args.expname = broadcast_object(args.expname)
 
     expname = args.expname
-    print("expname:", expname)
+    if rank == 0:
+        print("expname:", expname)
 
     os.makedirs(os.path.join(basedir, expname), exist_ok=True)
-    f = os.path.join(basedir, expname, 'args.txt')
-    with open(f, 'w') as file:
-        for arg in sorted(vars(args)):
-            attr = getattr(args, arg)
-            file.write('{} = {}\n'.format(arg, attr))
-    if args.config is not None:
-        f = os.path.join(basedir, expname, 'config.txt')
+    if rank == 0:
+        f = os.path.join(basedir, expname, 'args.txt')
         with open(f, 'w') as file:
-            file.write(open(args.config, 'r').read())
+            for arg in sorted(vars(args)):
+                attr = getattr(args, arg)
+                file.write('{} = {}\n'.format(arg, attr))
+        if args.config is not None:
+            f = os.path.join(basedir, expname, 'config.txt')
+            with open(f, 'w') as file:
+                file.write(open(args.config, 'r').read())
 
     # Create nerf model
     # TODO: switch to scene param model
     render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer = create_nerf(args, bounding_box=bounding_box)
     global_step = start
+    grad_all_reduce = None
+    if is_distributed():
+        broadcast_models(render_kwargs_train['network_fn'], render_kwargs_train['network_fine'])
+        grad_all_reduce = GradientAllReduce([render_kwargs_train['network_fn'], render_kwargs_train['network_fine']],
+                                            dense_tables=args.dist_dense_tables)
 
     bds_dict = {
         'near': near,
@@ -272,12 +512,23 @@ def train():
     render_kwargs_train.update(bds_dict)
     render_kwargs_test.update(bds_dict)
 
+    if args.autotune:
+        autotune(args, H, W, K, render_kwargs_test, n_aux=nerf_model_kwargs(args).get('nAuxParams', 0),
+                 cache_path=args.autotune_cache)
+
     # Move testing data to GPU
     render_poses = torch.Tensor(render_poses).to(device)
 
     # Short circuit if only rendering out from trained model
     if args.render_only:
         print('RENDER ONLY')
+        if args.quantize_int8 and torch.cuda.is_available():
+            print('int8 quantization runs on the CPU only, rendering in float')
+        elif args.quantize_int8:
+            render_kwargs_test = quantize_for_render(render_kwargs_test, images, poses,
+                                                     aux_scene_params if args.use_aux_params else None,
+                                                     i_train, i_test, hwf, K, chunk=args.chunk)
+
         with torch.no_grad():
             if args.render_test:
                 # render_test switches to test poses
@@ -291,12 +542,32 @@ def train():
             os.makedirs(testsavedir, exist_ok=True)
             print('test poses shape', render_poses.shape)
 
-            rgbs, _ = render_images(render_poses, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images,
-                                    savedir=testsavedir, render_factor=args.render_factor)
+            parallel = args.render_workers > 0 and not torch.cuda.is_available()
+            if args.render_workers > 0 and not parallel:
+                print('Parallel rendering runs on the CPU only, rendering in one process')
+
+            sync_detector = SyncDetector() if args.detect_syncs > 0 else None
+            with RenderWriter(video_path=os.path.join(testsavedir, 'video.mp4'),
+                              n_threads=args.writer_threads) as writer, sync_detector or nullcontext():
+                if parallel:
+                    render_images_parallel(args, render_kwargs_test, render_poses,
+                                           path_light_values(len(render_poses)), hwf, K, args.chunk,
+                                           n_workers=args.render_workers, n_threads=args.render_worker_threads,
+                                           tile=args.render_tile, gt_imgs=images, savedir=testsavedir,
+                                           memmap_dir=testsavedir if args.render_tile_memmap else None,
+                                           writer=writer)
+                else:
+                    render_images(render_poses, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images,
+                                  savedir=testsavedir, render_factor=args.render_factor,
+                                  reproject_kwargs=None if args.render_test else create_reproject_kwargs(args),
+                                  tile=args.render_tile,
+                                  memmap_dir=testsavedir if args.render_tile_memmap else None,
+                                  batch_poses=args.render_batch_poses, writer=writer)
             print('Done rendering', testsavedir)
-            imageio.mimwrite(os.path.join(testsavedir, 'video.mp4'), to8b(rgbs), fps=30, quality=8)
+            if sync_detector is not None:
+                sync_detector.report(os.path.join(testsavedir, 'sync_report.json'))
 
-            return
+            return os.path.join(basedir, expname)
 
     # Prepare ray batch tensor if batching random rays
     N_rand = args.N_rand
@@ -304,71 +575,123 @@ def train():
     poses = torch.Tensor(poses).to(device)
 
     N_iters = args.N_iters + 1
-    print('Begin')
-    print('TRAIN views are', i_train)
-    print('TEST views are', i_test)
-    print('VAL views are', i_val)
-    print('light intensities', len(aux_scene_params))
+    if rank == 0:
+        print('Begin')
+        print('TRAIN views are', i_train)
+        print('TEST views are', i_test)
+        print('VAL views are', i_val)
+        print('light intensities', len(aux_scene_params))
     loss_list = []
     psnr_list = []
     time_list = []
+
+    eval_worker = None
+    if args.eval_worker and rank == 0:
+        all_aux_scene_params = torch.Tensor(aux_scene_params)
+        eval_worker = EvalWorker(args, hwf, K, near, far, bounding_box, render_poses,
+                                 test_poses=torch.cat((poses[i_train[0:3]], poses[i_test]), dim=0),
+                                 test_images=np.concatenate((images[i_train[0:3]], images[i_test]), axis=0),
+                                 test_aux_scene_params=torch.cat([all_aux_scene_params[i_train[0:3]],
+                                                                  all_aux_scene_params[i_test]], dim=0))
+        eval_models = {'network_fn_state_dict': render_kwargs_train['network_fn'],
+                       'network_fine_state_dict': render_kwargs_train['network_fine']}
+
+    validator = None
+    if args.i_val_rays > 0 and rank == 0:
+        validator = RayValidator(images, poses.cpu().numpy(), aux_scene_params if args.use_aux_params else None,
+                                 i_val if len(i_val) > 0 else i_test, hwf, K, n_rays=args.n_val_rays)
+    profiler = None
+    if args.profile and rank == 0:
+        profiler = StepProfiler(os.path.join(basedir, expname, 'metrics.jsonl'), log_every=args.i_metrics,
+                                trace_dir=os.path.join(basedir, expname), trace_start=args.profile_trace_start,
+                                trace_steps=args.profile_trace_steps)
+        render_kwargs_train['profiler'] = profiler
+
+    sync_detector = SyncDetector() if args.detect_syncs > 0 and rank == 0 else None
+    scaler = grad_scaler(args.mixed_precision)
+    # converted once, instead of copying to the device on every step
+    aux_scene_params = torch.Tensor(aux_scene_params).to(device)
+
+    train_start_time = time.time()
+
+    def log_eval_results(results):
+        if not results:
+            return
+        with open(os.path.join(basedir, expname, 'eval_log.jsonl'), 'a') as fp:
+            for result in results:
+                if 'error' in result:
+                    tqdm.write(f"[EVAL] Iter: {result['step']} {result['kind']} failed:\n{result['error']}")
+                elif 'psnr' in result:
+                    tqdm.write(f"[EVAL] Iter: {result['step']} Test PSNR: {result['psnr']}  Saved {result['path']}")
+                else:
+                    tqdm.write(f"[EVAL] Iter: {result['step']} Saved {result['path']}")
+                fp.write(json.dumps(result) + '\n')
+
     start = start + 1
-    for i in trange(start, N_iters):
+    for i in trange(start, N_iters, disable=rank != 0):
+        if stop_event is not None and stop_event.is_set():
+            tqdm.write(f"Stopped before iter {i}")
+            break
         time0 = time.time()
+        if profiler is not None:
+            profiler.start_step(i)
+        if sync_detector is not None and i == start:
+            sync_detector.start()
+
+        with phase(profiler, 'ray_generation'):
+            # Random from one image
+            img_i = np.random.choice(i_train)
+            target = images[img_i]
+            target = torch.Tensor(target).to(device)
+            pose = poses[img_i, :3, :4]
+
+            # Grab the auxiliary scene param for current image
+            aux_scene_param = aux_scene_params[img_i] if args.use_aux_params else None
+
+            rays_o, rays_d = get_rays(H, W, K, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
+
+            if i < args.precrop_iters:
+                dH = int(H // 2 * args.precrop_frac)
+                dW = int(W // 2 * args.precrop_frac)
+                coords = torch.stack(
+                    torch.meshgrid(
+                        torch.linspace(H // 2 - dH, H // 2 + dH - 1, 2 * dH),
+                        torch.linspace(W // 2 - dW, W // 2 + dW - 1, 2 * dW)
+                    ), -1)
+                if i == start:
+                    print(
+                        f"[Config] Center cropping of size {2 * dH} x {2 * dW} is enabled until iter {args.precrop_iters}")
+            else:
+                coords = torch.stack(torch.meshgrid(torch.linspace(0, H - 1, H), torch.linspace(0, W - 1, W)),
+                                     -1)  # (H, W, 2)
 
-        # Random from one image
-        img_i = np.random.choice(i_train)
-        target = images[img_i]
-        target = torch.Tensor(target).to(device)
-        pose = poses[img_i, :3, :4]
-        aux_scene_params = torch.Tensor(aux_scene_params).to(device)
-
-        # Grab the auxiliary scene param for current image
-        aux_scene_param = aux_scene_params[img_i] if args.use_aux_params else None
-
-        rays_o, rays_d = get_rays(H, W, K, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
-
-        if i < args.precrop_iters:
-            dH = int(H // 2 * args.precrop_frac)
-            dW = int(W // 2 * args.precrop_frac)
-            coords = torch.stack(
-                torch.meshgrid(
-                    torch.linspace(H // 2 - dH, H // 2 + dH - 1, 2 * dH),
-                    torch.linspace(W // 2 - dW, W // 2 + dW - 1, 2 * dW)
-                ), -1)
-            if i == start:
-                print(
-                    f"[Config] Center cropping of size {2 * dH} x {2 * dW} is enabled until iter {args.precrop_iters}")
-        else:
-            coords = torch.stack(torch.meshgrid(torch.linspace(0, H - 1, H), torch.linspace(0, W - 1, W)),
-                                 -1)  # (H, W, 2)
-
-        coords = torch.reshape(coords, [-1, 2])  # (H * W, 2)
-        select_inds = np.random.choice(coords.shape[0], size=[N_rand], replace=False)  # (N_rand,)
-        select_coords = coords[select_inds].long()  # (N_rand, 2)
-        rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-        rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-        batch_rays = torch.stack([rays_o, rays_d], 0)
-        target_s = target[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
+            coords = torch.reshape(coords, [-1, 2])  # (H * W, 2)
+            select_inds = np.random.choice(coords.shape[0], size=[N_rand], replace=False)  # (N_rand,)
+            select_coords = coords[select_inds].long()  # (N_rand, 2)
+            rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
+            rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
+            batch_rays = torch.stack([rays_o, rays_d], 0)
+            target_s = target[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
 
         #####  Core optimization loop  #####
         rgb, disp, acc, extras = render(H, W, K, chunk=args.chunk, rays=batch_rays,
                                         verbose=i < 10, retraw=True, aux_scene_params=aux_scene_param,
                                         **render_kwargs_train)
 
-        optimizer.zero_grad()
-        img_loss = img2mse(rgb, target_s)
-        # trans = extras['raw'][..., -1]
-        loss = img_loss
-        psnr = mse2psnr(img_loss)
+        with phase(profiler, 'loss'):
+            optimizer.zero_grad()
+            img_loss = img2mse(rgb, target_s)
+            # trans = extras['raw'][..., -1]
+            loss = img_loss
+            psnr = mse2psnr(img_loss)
 
-        if 'rgb0' in extras:
-            img_loss0 = img2mse(extras['rgb0'], target_s)
-            loss = loss + img_loss0
-            psnr0 = mse2psnr(img_loss0)
+            if 'rgb0' in extras:
+                img_loss0 = img2mse(extras['rgb0'], target_s)
+                loss = loss + img_loss0
+                psnr0 = mse2psnr(img_loss0)
 
-        sparsity_loss = args.sparse_loss_weight * (extras["sparsity_loss"].sum() + extras["sparsity_loss0"].sum())
-        loss = loss + sparsity_loss
+            sparsity_loss = args.sparse_loss_weight * (extras["sparsity_loss"].sum() + extras["sparsity_loss0"].sum())
+            loss = loss + sparsity_loss
 
         # add Total Variation loss
         # if args.i_embed==1:
@@ -384,93 +707,141 @@ def train():
         #     if i>1000:
         #         args.tv_loss_weight = 0.0
 
-        loss.backward()
-        optimizer.step()
-
-        # NOTE: IMPORTANT!
-        ###   update learning rate   ###
-        decay_rate = 0.1
-        decay_steps = args.lrate_decay * 1000
-        new_lrate = args.lrate * (decay_rate ** (global_step / decay_steps))
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = new_lrate
-        ################################
+        with phase(profiler, 'backward'):
+            scaler.scale(loss).backward()
+        if grad_all_reduce is not None:
+            with phase(profiler, 'all_reduce'):
+                grad_all_reduce()
+        with phase(profiler, 'optimizer'):
+            scaler.step(optimizer)
+            scaler.update()
+
+            # NOTE: IMPORTANT!
+            ###   update learning rate   ###
+            decay_rate = 0.1
+            decay_steps = args.lrate_decay * 1000
+            new_lrate = args.lrate * (decay_rate ** (global_step / decay_steps))
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = new_lrate
+            ################################
 
         t = time.time() - time0
         # print(f"Step: {global_step}, Loss: {loss}, Time: {dt}")
         #####           end            #####
 
-        # Rest is logging
-        if i % args.i_weights == 0:
-            path = os.path.join(basedir, expname, '{:06d}.tar'.format(i))
-            torch.save({
-                'global_step': global_step,
-                'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
-                'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-            }, path)
-            print('Saved checkpoints at', path)
-
-        if i % args.i_video == 0 and i > 0:
-            # Turn on testing mode
-            with torch.no_grad():
-                rgbs, disps = render_images(render_poses, hwf, K, args.chunk, render_kwargs_test)
-            print('Done, saving', rgbs.shape, disps.shape)
-            moviebase = os.path.join(basedir, expname, '{}_spiral_{:06d}_'.format(expname, i))
-            imageio.mimwrite(moviebase + 'rgb.mp4', to8b(rgbs), fps=30, quality=8)
-            imageio.mimwrite(moviebase + 'disp.mp4', to8b(disps / np.max(disps)), fps=30, quality=8)
-
-            # if args.use_viewdirs:
-            #     render_kwargs_test['c2w_staticcam'] = render_poses[0][:3,:4]
-            #     with torch.no_grad():
-            #         rgbs_still, _ = render_path(render_poses, hwf, args.chunk, render_kwargs_test)
-            #     render_kwargs_test['c2w_staticcam'] = None
-            #     imageio.mimwrite(moviebase + 'rgb_still.mp4', to8b(rgbs_still), fps=30, quality=8)
-        if (i % args.i_testset == 0 and i > 0) or i == 100:
-            testsavedir = os.path.join(basedir, expname, 'testset_{:06d}'.format(i))
-            os.makedirs(testsavedir, exist_ok=True)
-            # print('test poses shape', poses[i_test].shape)
-            with torch.no_grad():
-                test_poses = torch.cat((poses[i_train[0:3]], poses[i_test]), dim=0).to(device)
-                test_image = np.concatenate((images[i_train[0:3]], images[i_test]), axis=0)
-
-                # test_poses = torch.cat((test_poses, poses[i_test]), dim=0).to(device)
-                # test_image = np.concatenate((test_image, images[i_test]), axis=0)
-                # print('test_poses ', test_poses.shape)
-                # -0.18 -0.093 0.25
-                # diffuse :
-                test_aux_scene_params = torch.cat([aux_scene_params[i_train[0:3]], aux_scene_params[i_test]], dim=0)
-
-                # light pos:
-                # train_scene_params = aux_scene_params[i_train[0:3]]
-                # train_scene_params[2] = torch.tensor([-0.18, -0.093, 0.25])
-                # test_aux_scene_params = torch.cat([train_scene_params, aux_scene_params[i_test]], dim=0)
-                # print(train_scene_params)
-                # 0/0
-                # light intensity:
-                # test_aux_scene_params = torch.cat([torch.Tensor([0.75, 0.75, 0.2]), torch.Tensor(aux_scene_params[i_test])], dim=0)
-                # test_aux_scene_params = torch.cat([test_aux_scene_params, torch.Tensor([0.25, 0.75])], dim=0)
-                # print('test aux scene ', len(test_aux_scene_params))
-                render_images(test_poses, hwf, K, args.chunk, render_kwargs_test,
-                              gt_imgs=test_image, savedir=testsavedir, aux_scene_params=test_aux_scene_params)
-            print('Saved test set')
-
-        if i % args.i_print == 0:
-            tqdm.write(f"[TRAIN] Iter: {i} Loss: {loss.item()}  PSNR: {psnr.item()}")
-            # loss_list.append(loss.item())
-            # psnr_list.append(psnr.item())
-            # time_list.append(t)
-            # loss_psnr_time = {
-            #     "losses": loss_list,
-            #     "psnr": psnr_list,
-            #     "time": time_list
-            # }
-            # with open(os.path.join(basedir, expname, "loss_vs_time.pkl"), "wb") as fp:
-            #     pickle.dump(loss_psnr_time, fp)
+        # Rest is logging, by rank 0 while the other ranks go on training
+        if rank != 0:
+            global_step += 1
+            continue
+
+        with phase(profiler, 'logging'):
+            if i % args.i_weights == 0:
+                path = os.path.join(basedir, expname, '{:06d}.tar'.format(i))
+                torch.save({
+                    'global_step': global_step,
+                    'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
+                    'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict(),
+                }, path)
+                print('Saved checkpoints at', path)
+
+            if i % args.i_video == 0 and i > 0 and eval_worker is not None:
+                if not eval_worker.submit(i, 'video', eval_models):
+                    tqdm.write(f"Evaluation worker busy, skipped video of iter {i}")
+            elif i % args.i_video == 0 and i > 0:
+                moviebase = os.path.join(basedir, expname, '{}_spiral_{:06d}_'.format(expname, i))
+                # Turn on testing mode
+                with torch.no_grad(), RenderWriter(video_path=moviebase + 'rgb.mp4', disp_video_path=moviebase + 'disp.mp4',
+                                                   n_threads=args.writer_threads) as writer:
+                    render_images(render_poses, hwf, K, args.chunk, render_kwargs_test,
+                                  reproject_kwargs=create_reproject_kwargs(args),
+                                  batch_poses=args.render_batch_poses, writer=writer)
+                print('Done, saved', moviebase)
+
+                # if args.use_viewdirs:
+                #     render_kwargs_test['c2w_staticcam'] = render_poses[0][:3,:4]
+                #     with torch.no_grad():
+                #         rgbs_still, _ = render_path(render_poses, hwf, args.chunk, render_kwargs_test)
+                #     render_kwargs_test['c2w_staticcam'] = None
+                #     imageio.mimwrite(moviebase + 'rgb_still.mp4', to8b(rgbs_still), fps=30, quality=8)
+            if ((i % args.i_testset == 0 and i > 0) or i == 100) and eval_worker is not None:
+                if not eval_worker.submit(i, 'testset', eval_models):
+                    tqdm.write(f"Evaluation worker busy, skipped test set of iter {i}")
+            elif (i % args.i_testset == 0 and i > 0) or i == 100:
+                testsavedir = os.path.join(basedir, expname, 'testset_{:06d}'.format(i))
+                os.makedirs(testsavedir, exist_ok=True)
+                # print('test poses shape', poses[i_test].shape)
+                with torch.no_grad():
+                    test_poses = torch.cat((poses[i_train[0:3]], poses[i_test]), dim=0).to(device)
+                    test_image = np.concatenate((images[i_train[0:3]], images[i_test]), axis=0)
+
+                    # test_poses = torch.cat((test_poses, poses[i_test]), dim=0).to(device)
+                    # test_image = np.concatenate((test_image, images[i_test]), axis=0)
+                    # print('test_poses ', test_poses.shape)
+                    # -0.18 -0.093 0.25
+                    # diffuse :
+                    test_aux_scene_params = torch.cat([aux_scene_params[i_train[0:3]], aux_scene_params[i_test]], dim=0)
+
+                    # light pos:
+                    # train_scene_params = aux_scene_params[i_train[0:3]]
+                    # train_scene_params[2] = torch.tensor([-0.18, -0.093, 0.25])
+                    # test_aux_scene_params = torch.cat([train_scene_params, aux_scene_params[i_test]], dim=0)
+                    # print(train_scene_params)
+                    # 0/0
+                    # light intensity:
+                    # test_aux_scene_params = torch.cat([torch.Tensor([0.75, 0.75, 0.2]), torch.Tensor(aux_scene_params[i_test])], dim=0)
+                    # test_aux_scene_params = torch.cat([test_aux_scene_params, torch.Tensor([0.25, 0.75])], dim=0)
+                    # print('test aux scene ', len(test_aux_scene_params))
+                    render_images(test_poses, hwf, K, args.chunk, render_kwargs_test,
+                                  gt_imgs=test_image, savedir=testsavedir, aux_scene_params=test_aux_scene_params,
+                                  batch_poses=args.render_batch_poses)
+                print('Saved test set')
+
+            if i % args.i_print == 0:
+                tqdm.write(f"[TRAIN] Iter: {i} Loss: {loss.item()}  PSNR: {psnr.item()}")
+                # loss_list.append(loss.item())
+                # psnr_list.append(psnr.item())
+                # time_list.append(t)
+                # loss_psnr_time = {
+                #     "losses": loss_list,
+                #     "psnr": psnr_list,
+                #     "time": time_list
+                # }
+                # with open(os.path.join(basedir, expname, "loss_vs_time.pkl"), "wb") as fp:
+                #     pickle.dump(loss_psnr_time, fp)
+
+            if validator is not None and i % args.i_val_rays == 0:
+                val = validator.evaluate(render_kwargs_test)
+                buckets = '  '.join(f'{k}: {v:.2f}' for k, v in val['buckets'].items())
+                tqdm.write(f"[VAL] Iter: {i} PSNR: {val['psnr']:.2f}  {buckets}")
+                record = {'step': i, 'time': time.time() - train_start_time, **val}
+                with open(os.path.join(basedir, expname, 'val_psnr.jsonl'), 'a') as fp:
+                    fp.write(json.dumps(record) + '\n')
+                if callback is not None:
+                    callback(record)
+
+            if eval_worker is not None:
+                log_eval_results(eval_worker.poll())
+
+        if profiler is not None:
+            profiler.end_step(i, loss=loss.detach(), psnr=psnr.detach())
+        if sync_detector is not None and (i == start + args.detect_syncs - 1 or i == N_iters - 1):
+            sync_detector.stop()
+            tqdm.write(f"Recorded host syncs of iters {start} to {i}")
+            sync_detector.report(os.path.join(basedir, expname, 'sync_report.json'))
+            sync_detector = None
 
         global_step += 1
 
+    if eval_worker is not None:
+        log_eval_results(eval_worker.close())
+    if profiler is not None:
+        profiler.close()
+
+    return os.path.join(basedir, expname)
+
 if __name__ == '__main__':
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
     train()
@@ -0,0 +1,225 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import time
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from argparser import config_parser
+
+
+def expand_grid(grid):
+    """
+    The configs of a grid, e.g. {"lrate": [0.01, 0.005], "N_samples": [32, 64]} gives the 4 combinations.
+    """
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def config_cmdline(config):
+    """
+    Command line arguments overriding those of the base configuration with config.
+    """
+    cmdline = []
+    for key, value in config.items():
+        if isinstance(value, bool):
+            cmdline += ['--' + key] if value else []
+        else:
+            cmdline += ['--' + key, str(value)]
+    return cmdline
+
+
+def share_dataset(dataset):
+    """
+    Move the arrays of a dataset of run_nerf.load_dataset into shared memory, so that the jobs map them instead
+    of receiving copies.
+    """
+    shared = dict(dataset)
+    for key in ('images', 'poses', 'render_poses'):
+        shared[key] = torch.as_tensor(np.ascontiguousarray(dataset[key])).share_memory_()
+    return shared
+
+
+def _run_job(job_id, cmdline, dataset, cores, messages, stop_event):
+    # imported here, so that the workers import run_nerf in the spawned process only
+    from run_nerf import train
+
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        # numpy views of the shared memory, as load_dataset returns them
+        dataset = {k: v.numpy() if torch.is_tensor(v) and k != 'render_poses' else v for k, v in dataset.items()}
+        expdir = train(cmdline, dataset=dataset, callback=lambda record: messages.put(('val', job_id, record)),
+                       stop_event=stop_event)
+        messages.put(('done', job_id, expdir))
+    except Exception:
+        messages.put(('error', job_id, traceback.format_exc()))
+
+
+class SuccessiveHalving:
+    def __init__(self, min_steps, max_steps, eta=3):
+        """
+        Asynchronous successive halving: a job reaching the rung steps min_steps * eta^k continues only if its
+        validation PSNR is among the best 1 / eta of the PSNRs recorded at that rung so far. Jobs are never
+        paused to wait for the others, the first jobs at a rung continue until eta of them were recorded.
+        """
+        self.eta = eta
+        self.rungs = []
+        step = min_steps
+        while step < max_steps:
+            self.rungs.append(step)
+            step *= eta
+        self.results = {rung: [] for rung in self.rungs}
+
+    def keep(self, step, psnr):
+        """
+        Record psnr at step and tell whether the job continues.
+        """
+        if step not in self.results:
+            return True
+        results = self.results[step]
+        results.append(psnr)
+        if len(results) < self.eta:
+            return True
+        threshold = sorted(results, reverse=True)[max(len(results) // self.eta, 1) - 1]
+        return psnr >= threshold
+
+
+def run_sweep(base_cmdline, configs, dataset, cores_per_job=1, n_jobs=0, min_steps=500, max_steps=20000, eta=3,
+              expname='sweep'):
+    """
+    Train every config on the shared dataset, n_jobs at a time, each pinned to its own cores_per_job cores,
+    stopping configs early by successive halving on the held-out ray validation PSNR.
+
+    :param base_cmdline: list of str. The arguments shared by all jobs.
+    :param configs: list of dicts of the arguments of every job, see config_cmdline.
+    :param n_jobs: int. Number of concurrent jobs, 0 fits as many as the available cores allow.
+    :param expname: str. The experiment name of job k is expname_sweepk.
+    :return: list of one result dict per config
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    n_jobs = n_jobs if n_jobs > 0 else max(len(cores) // cores_per_job, 1)
+    # core sets of the job slots, wrapped around if more jobs than cores were asked for
+    slots = [[cores[(k * cores_per_job + c) % len(cores)] for c in range(cores_per_job)] for k in range(n_jobs)]
+    print('Sweeping {} configs, {} at a time on cores {}'.format(len(configs), n_jobs, slots))
+
+    ctx = mp.get_context('spawn')
+    messages = ctx.Queue()
+    scheduler = SuccessiveHalving(min_steps, max_steps, eta)
+    results = [{'job': k, 'config': config, 'status': 'pending', 'step': None, 'psnr': None, 'time': None}
+               for k, config in enumerate(configs)]
+    pending = list(range(len(configs)))
+    running = {}
+
+    def finish(job_id, status):
+        process, slot, stop_event, start = running.pop(job_id)
+        process.join()
+        # jobs stopped by the scheduler also end with 'done'
+        if results[job_id]['status'] != 'stopped':
+            results[job_id]['status'] = status
+        results[job_id]['time'] = time.time() - start
+        slots.append(slot)
+        print('Job {} {} after {:.0f} s: {}'.format(job_id, results[job_id]['status'], results[job_id]['time'],
+                                                    configs[job_id]))
+
+    while pending or running:
+        while pending and slots:
+            job_id, slot = pending.pop(0), slots.pop(0)
+            stop_event = ctx.Event()
+            cmdline = base_cmdline + config_cmdline(configs[job_id]) + [
+                '--expname', '{}_sweep{:03d}'.format(expname, job_id),
+                '--i_val_rays', str(min_steps), '--N_iters', str(max_steps)]
+            process = ctx.Process(target=_run_job, args=(job_id, cmdline, dataset, slot, messages, stop_event))
+            process.start()
+            running[job_id] = (process, slot, stop_event, time.time())
+            results[job_id]['status'] = 'running'
+
+        try:
+            kind, job_id, payload = messages.get(timeout=1.)
+        except queue.Empty:
+            for job_id in [j for j, (process, _, _, _) in running.items() if not process.is_alive()]:
+                finish(job_id, 'failed')
+            continue
+
+        if job_id not in running:
+            # a job whose process was found dead while its last message was still in flight
+            continue
+        if kind == 'val':
+            results[job_id].update(step=payload['step'], psnr=payload['psnr'])
+            if not scheduler.keep(payload['step'], payload['psnr']):
+                results[job_id]['status'] = 'stopped'
+                running[job_id][2].set()
+        elif kind == 'done':
+            results[job_id]['expdir'] = payload
+            finish(job_id, 'done')
+        else:
+            print('Job {} failed:\n{}'.format(job_id, payload))
+            finish(job_id, 'failed')
+
+    return results
+
+
+def format_results(results):
+    """
+    The results of run_sweep as a text table, best validation PSNR first.
+    """
+    keys = sorted({k for result in results for k in result['config']})
+    header = ['job'] + keys + ['status', 'step', 'val PSNR', 'time s']
+    rows = []
+    for result in sorted(results, key=lambda r: -r['psnr'] if r['psnr'] is not None else float('inf')):
+        rows.append([str(result['job'])] + [str(result['config'].get(k, '')) for k in keys] + [
+            result['status'], str(result['step']), '{:.2f}'.format(result['psnr']) if result['psnr'] is not None
+            else '-', '{:.0f}'.format(result['time']) if result['time'] is not None else '-'])
+    widths = [max(len(row[c]) for row in [header] + rows) for c in range(len(header))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in [header] + rows)
+
+
+def main():
+    # imported here, the jobs import run_nerf themselves
+    from run_nerf import load_dataset
+
+    # the sweep options are not arguments of run_nerf, the others are passed on to every job
+    sweep_parser = argparse.ArgumentParser(description='Train a grid of configs on one scene loaded once.')
+    sweep_parser.add_argument("--sweep", type=str, required=True,
+                              help='JSON file of the swept arguments and their values, e.g. {"lrate": [0.01, 0.005]}')
+    sweep_parser.add_argument("--sweep_cores_per_job", type=int, default=1,
+                              help='number of cores every job is pinned to')
+    sweep_parser.add_argument("--sweep_jobs", type=int, default=0,
+                              help='number of concurrent jobs, 0 fits as many as the available cores allow')
+    sweep_parser.add_argument("--sweep_min_steps", type=int, default=500,
+                              help='first successive halving rung, and validation interval of the jobs')
+    sweep_parser.add_argument("--sweep_eta", type=int, default=3,
+                              help='only the best 1 / eta of the configs continue at every rung')
+    sweep_args, base_cmdline = sweep_parser.parse_known_args()
+    args = config_parser().parse_args(base_cmdline)
+
+    with open(sweep_args.sweep) as fp:
+        configs = expand_grid(json.load(fp))
+
+    t = time.time()
+    dataset = share_dataset(load_dataset(args))
+    print('Loaded the scene once in {:.1f} s'.format(time.time() - t))
+
+    results = run_sweep(base_cmdline, configs, dataset, cores_per_job=sweep_args.sweep_cores_per_job,
+                        n_jobs=sweep_args.sweep_jobs, min_steps=sweep_args.sweep_min_steps, max_steps=args.N_iters,
+                        eta=sweep_args.sweep_eta, expname=args.expname)
+
+    table = format_results(results)
+    print(table)
+    os.makedirs(args.basedir, exist_ok=True)
+    path = os.path.join(args.basedir, '{}_sweep.json'.format(args.expname))
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    with open(os.path.splitext(path)[0] + '.txt', 'w') as fp:
+        fp.write(table + '\n')
+    print('Saved', path)
+
+
+if __name__ == '__main__':
+    main()
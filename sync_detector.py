@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import traceback
+import warnings
+from collections import Counter
+
+import torch
+
+# (owner, attribute) of the operations that copy data to the host or branch on tensor values
+SYNC_OPS = [
+    (torch.Tensor, 'item'),
+    (torch.Tensor, '__bool__'),
+    (torch.Tensor, '__int__'),
+    (torch.Tensor, '__float__'),
+    (torch.Tensor, 'tolist'),
+    (torch.Tensor, 'numpy'),
+    (torch.Tensor, 'cpu'),
+    (torch.Tensor, 'nonzero'),
+    (torch.Tensor, 'masked_select'),
+    (torch.Tensor, 'unique'),
+    (torch.Tensor, '__getitem__'),
+    (torch, 'nonzero'),
+    (torch, 'masked_select'),
+    (torch, 'unique'),
+]
+
+_TORCH_DIR = os.path.dirname(torch.__file__)
+# frames of these files are never the call site of interest
+_SKIPPED_FILES = (os.path.abspath(__file__), os.path.abspath(warnings.__file__))
+
+
+def _is_data_dependent_index(index):
+    """
+    Boolean mask indexing has an output shape that depends on the values of the mask.
+    """
+    index = index if isinstance(index, tuple) else (index,)
+    return any(torch.is_tensor(i) and i.dtype == torch.bool for i in index)
+
+
+class SyncDetector:
+    def __init__(self, stack_depth=6):
+        """
+        Record the device to host syncs and data dependent branches inside a with block.
+
+        Tensor methods that read values back to the host (item, __bool__, tolist, cpu, ...) or whose output
+        shape depends on tensor values (nonzero, boolean mask indexing, ...) are patched to record the
+        innermost frames outside of torch. With CUDA, only calls on CUDA tensors are recorded and torch's sync
+        debug mode additionally reports syncs inside torch kernels. Without it, calls on any tensor are
+        recorded, since each of them would stall the host if the tensor lived on an accelerator. This
+        includes host-side tensors that stay on the CPU on every device, e.g. the step counts of optimizers.
+
+        :param stack_depth: int. Number of frames kept per recorded call site.
+        """
+        self.stack_depth = stack_depth
+        self.cuda_only = torch.cuda.is_available()
+        self.counts = Counter()
+        self.stacks = {}
+        self._originals = []
+        self._local = threading.local()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        """
+        Start recording, for spans that do not fit a with block.
+        """
+        for owner, name in SYNC_OPS:
+            original = getattr(owner, name)
+            self._originals.append((owner, name, original, name in vars(owner)))
+            setattr(owner, name, self._wrap(name, original))
+
+        if torch.cuda.is_available():
+            self._sync_debug_mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode('warn')
+        # restores the filters and warnings.showwarning on exit
+        self._warnings = warnings.catch_warnings()
+        self._warnings.__enter__()
+        warnings.simplefilter('always')
+        self._showwarning = warnings.showwarning
+        warnings.showwarning = self._on_warning
+
+    def stop(self):
+        self._warnings.__exit__(None, None, None)
+        if torch.cuda.is_available():
+            torch.cuda.set_sync_debug_mode(self._sync_debug_mode)
+
+        for owner, name, original, own_attribute in reversed(self._originals):
+            if own_attribute:
+                setattr(owner, name, original)
+            else:
+                # inherited, e.g. from torch._C.TensorBase
+                delattr(owner, name)
+        self._originals = []
+
+    def _wrap(self, name, original):
+        detector = self
+
+        def wrapper(*args, **kwargs):
+            active = getattr(detector._local, 'active', False)
+            if not active and (name != '__getitem__' or _is_data_dependent_index(args[1])) \
+                    and (args[0].is_cuda or not detector.cuda_only):
+                detector._record(name)
+
+            # calls made by the original itself are not recorded
+            detector._local.active = True
+            try:
+                return original(*args, **kwargs)
+            finally:
+                detector._local.active = active
+
+        return wrapper
+
+    def _on_warning(self, message, category, filename, lineno, file=None, line=None):
+        if 'synchroniz' in str(message):
+            self._record('cuda_sync')
+        else:
+            self._showwarning(message, category, filename, lineno, file, line)
+
+    def _record(self, name):
+        frames = [frame for frame in traceback.extract_stack()
+                  if not frame.filename.startswith(_TORCH_DIR) and os.path.abspath(frame.filename) not in _SKIPPED_FILES]
+        frames = frames[-self.stack_depth:]
+        site = frames[-1] if frames else None
+        key = (name, '{}:{} in {}'.format(os.path.basename(site.filename), site.lineno, site.name) if site else '?')
+        self.counts[key] += 1
+        if key not in self.stacks:
+            self.stacks[key] = ['{}:{} in {}: {}'.format(f.filename, f.lineno, f.name, f.line) for f in frames]
+
+    def report(self, path=None):
+        """
+        Print the recorded call sites, most frequent first, and save them as JSON if path is given.
+        """
+        records = [{'op': op, 'site': site, 'count': count, 'stack': self.stacks[(op, site)]}
+                   for (op, site), count in self.counts.most_common()]
+        print('Host syncs and data dependent branches: {} at {} call sites'.format(sum(self.counts.values()),
+                                                                                len(records)))
+        for record in records:
+            print('{:8d}  {:14s} {}'.format(record['count'], record['op'], record['site']))
+
+        if path is not None:
+            with open(path, 'w') as fp:
+                json.dump(records, fp, indent=2)
+        return records
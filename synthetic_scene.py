@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+
+import imageio
+import numpy as np
+
+from load_blender import pose_spherical
+
+# (center, radius, base color) of the spheres of the default scene, inside the near/far range of load_blender_data
+DEFAULT_SPHERES = [
+    ((0.0, 0.0, 0.0), 0.25, (0.8, 0.3, 0.2)),
+    ((0.3, 0.15, 0.05), 0.12, (0.2, 0.6, 0.9)),
+    ((-0.25, -0.2, 0.1), 0.1, (0.3, 0.8, 0.3)),
+]
+LIGHT_DIR = np.array([0.4, 0.3, 0.85]) / np.linalg.norm([0.4, 0.3, 0.85])
+
+
+def camera_rays(H, W, focal, c2w):
+    """
+    Rays of all pixels of a camera, with the same conventions as nerf_utils.get_rays.
+
+    :return: rays_o, rays_d: arrays of shape (H, W, 3).
+    """
+    i, j = np.meshgrid(np.arange(W, dtype=np.float32), np.arange(H, dtype=np.float32), indexing='xy')
+    dirs = np.stack([(i - 0.5 * W) / focal, -(j - 0.5 * H) / focal, -np.ones_like(i)], -1)
+    rays_d = dirs @ c2w[:3, :3].T
+    rays_o = np.broadcast_to(c2w[:3, 3], rays_d.shape)
+    return rays_o, rays_d
+
+
+def trace(rays_o, rays_d, spheres=DEFAULT_SPHERES, metallic=0.):
+    """
+    Reference ray tracer of a scene of spheres on a transparent background.
+
+    The spheres are shaded with an ambient and a Lambertian term, the auxiliary param metallic blends in a
+    Blinn-Phong highlight and darkens the diffuse color, so that it changes the appearance of the scene
+    without changing its geometry.
+
+    :param rays_o: array of shape (..., 3). The ray origins.
+    :param rays_d: array of shape (..., 3). The ray directions.
+    :param spheres: list of (center, radius, color) tuples.
+    :param metallic: float in [0, 1]. The auxiliary scene param.
+    :return: array of shape (..., 4). RGBA colors in [0, 1].
+    """
+    rays_d = rays_d / np.linalg.norm(rays_d, axis=-1, keepdims=True)
+    t_hit = np.full(rays_d.shape[:-1], np.inf)
+    color = np.zeros(rays_d.shape[:-1] + (3,))
+    normal = np.zeros_like(rays_d)
+
+    for center, radius, base_color in spheres:
+        oc = rays_o - np.asarray(center)
+        b = np.sum(oc * rays_d, -1)
+        disc = b * b - (np.sum(oc * oc, -1) - radius ** 2)
+        t = -b - np.sqrt(np.maximum(disc, 0.))
+        hit = (disc > 0) & (t > 0) & (t < t_hit)
+
+        t_hit = np.where(hit, t, t_hit)
+        color[hit] = base_color
+        normal[hit] = (rays_o[hit] + t[hit, None] * rays_d[hit] - np.asarray(center)) / radius
+
+    hit = np.isfinite(t_hit)
+    half = LIGHT_DIR - rays_d
+    half = half / np.linalg.norm(half, axis=-1, keepdims=True)
+    diffuse = np.clip(np.sum(normal * LIGHT_DIR, -1, keepdims=True), 0., None)
+    specular = np.clip(np.sum(normal * half, -1, keepdims=True), 0., None) ** 32
+
+    rgb = color * (0.2 + 0.8 * diffuse) * (1. - 0.5 * metallic) + metallic * specular
+    rgba = np.concatenate([np.clip(rgb, 0., 1.), hit[..., None].astype(np.float64)], -1)
+    rgba[~hit] = 0.
+    return rgba
+
+
+def make_scene(basedir, H=64, W=64, n_train=50, n_val=8, n_test=8, aux_values=(0., 0.5, 1.),
+               camera_angle_x=0.6911112070083618, radius=1.05, seed=0):
+    """
+    Render a synthetic scene in the layout read by load_blender_data: transforms_{train,val,test}.json with
+    the camera poses and the 'metallic' auxiliary param of every frame, and RGBA PNGs.
+
+    :param basedir: str. The directory the scene is written to.
+    :param H: int. Image height.
+    :param W: int. Image width.
+    :param n_train: int. Number of training views.
+    :param n_val: int. Number of validation views.
+    :param n_test: int. Number of test views.
+    :param aux_values: tuple. The values of the auxiliary param, every view takes one at random.
+    :param camera_angle_x: float. The horizontal field of view.
+    :param radius: float. Distance of the cameras to the origin.
+    :param seed: int. Seed of the camera poses and auxiliary params.
+    """
+    rng = np.random.RandomState(seed)
+    focal = .5 * W / np.tan(.5 * camera_angle_x)
+
+    for split, n in (('train', n_train), ('val', n_val), ('test', n_test)):
+        os.makedirs(os.path.join(basedir, split), exist_ok=True)
+        frames = []
+        for k in range(n):
+            c2w = pose_spherical(rng.uniform(-180., 180.), rng.uniform(-60., -10.), radius).numpy()
+            metallic = float(rng.choice(aux_values))
+            rgba = trace(*camera_rays(H, W, focal, c2w), metallic=metallic)
+
+            file_path = './{}/r_{}'.format(split, k)
+            imageio.imwrite(os.path.join(basedir, file_path + '.png'), (255 * rgba).round().astype(np.uint8))
+            frames.append({'file_path': file_path, 'transform_matrix': c2w.tolist(), 'metallic': metallic})
+
+        with open(os.path.join(basedir, 'transforms_{}.json'.format(split)), 'w') as fp:
+            json.dump({'camera_angle_x': camera_angle_x, 'frames': frames}, fp, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a synthetic blender-style scene of spheres.')
+    parser.add_argument('basedir', type=str, help='directory the scene is written to')
+    parser.add_argument('--H', type=int, default=64, help='image height')
+    parser.add_argument('--W', type=int, default=64, help='image width')
+    parser.add_argument('--n_train', type=int, default=50, help='number of training views')
+    parser.add_argument('--n_val', type=int, default=8, help='number of validation views')
+    parser.add_argument('--n_test', type=int, default=8, help='number of test views')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the poses and auxiliary params')
+    args = parser.parse_args()
+
+    make_scene(args.basedir, args.H, args.W, args.n_train, args.n_val, args.n_test, seed=args.seed)
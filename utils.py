@@ -80,6 +80,34 @@ def get_bbox3d_for_llff(poses, hwf, near=0.0, far=1.0):
             torch.tensor(max_bound) + torch.tensor([0.1, 0.1, 0.0001]))
 
 
+def _spread_bits(v):
+    """
+    Insert two zero bits after each of the lower 21 bits of the int64 tensor v.
+    """
+    v = v & 0x1fffff
+    v = (v | v << 32) & 0x1f00000000ffff
+    v = (v | v << 16) & 0x1f0000ff0000ff
+    v = (v | v << 8) & 0x100f00f00f00f00f
+    v = (v | v << 4) & 0x10c30c30c30c30c3
+    v = (v | v << 2) & 0x1249249249249249
+    return v
+
+
+def morton_codes(x, bounding_box, bits=10):
+    """
+    Morton (Z-order) codes of the voxels containing the points x, in a grid of 2^bits voxels per axis over the
+    bounding box. Points close in space get close codes, so sorting by them groups the points spatially.
+
+    :param x: tensor of shape (N, 3).
+    :param bounding_box: pair of tensors of shape (3,).
+    :param bits: int. At most 21, for the codes to fit in int64.
+    :return: int64 tensor of shape (N,)
+    """
+    box_min, box_max = bounding_box
+    voxels = ((x - box_min) / (box_max - box_min) * (1 << bits)).long().clamp(0, (1 << bits) - 1)
+    return _spread_bits(voxels[:, 0]) << 2 | _spread_bits(voxels[:, 1]) << 1 | _spread_bits(voxels[:, 2])
+
+
 if __name__ == "__main__":
     with open("data/nerf_synthetic/chair/transforms_train.json", "r") as f:
         camera_transforms = json.load(f)
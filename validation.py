@@ -0,0 +1,98 @@
+import numpy as np
+import torch
+
+from render import render
+from nerf_utils import device, get_rays
+
+
+class RayValidator:
+    def __init__(self, images, poses, aux_scene_params, indices, hwf, K, n_rays=4096, max_buckets=8, seed=0):
+        """
+        Cheap held-out validation on a fixed random subset of rays.
+
+        The rays, their target colors and auxiliary scene params are sampled once from the held-out views and
+        kept on device, so that every evaluation is a single no-grad render of n_rays rays. PSNR is reported
+        overall and per bucket of auxiliary scene params.
+
+        :param images: array of shape (n_images, H, W, 3). All images of the scene.
+        :param poses: array of shape (n_images, 4, 4). The camera poses of the images.
+        :param aux_scene_params: array of shape (n_images, ...) or None. Auxiliary scene params of the images.
+        :param indices: array. Indices of the held-out images to sample rays from.
+        :param hwf: tuple. A tuple of (height, width, focal)
+        :param K: array of shape (3, 3). The intrinsic matrix of the camera
+        :param n_rays: int. Number of held-out rays.
+        :param max_buckets: int. Auxiliary scene params with more distinct values than this are binned
+            into max_buckets quantiles of their first component.
+        :param seed: int. Seed of the ray sampling, so that runs are validated on the same rays.
+        """
+        H, W, _ = hwf
+        self.H, self.W, self.K = H, W, K
+        self.n_rays = n_rays
+
+        rng = np.random.RandomState(seed)
+        image_index = rng.choice(indices, size=n_rays)
+        pixels = rng.randint(0, H * W, size=n_rays)
+
+        rays_o, rays_d = torch.zeros((n_rays, 3)), torch.zeros((n_rays, 3))
+        for i in np.unique(image_index):
+            selected = np.nonzero(image_index == i)[0]
+            o, d = get_rays(H, W, K, torch.Tensor(poses[i, :3, :4]).to(device))
+            rays_o[selected] = o.reshape(-1, 3)[pixels[selected]]
+            rays_d[selected] = d.reshape(-1, 3)[pixels[selected]]
+        self.rays = torch.stack([rays_o, rays_d], 0).to(device)
+
+        target = np.asarray(images).reshape(len(images), H * W, -1)[image_index, pixels, :3]
+        self.target = torch.Tensor(target).to(device)
+
+        if aux_scene_params is None:
+            self.aux_scene_params = None
+            self.bucket_labels = ['all']
+            buckets = np.zeros(n_rays, dtype=np.int64)
+        else:
+            aux_scene_params = np.asarray(aux_scene_params, dtype=np.float32).reshape(len(images), -1)
+            self.aux_scene_params = torch.Tensor(aux_scene_params[image_index]).to(device)
+            self.bucket_labels, buckets = self.bucketize(aux_scene_params[indices], aux_scene_params[image_index],
+                                                         max_buckets)
+        self.buckets = torch.from_numpy(buckets).to(device)
+
+    @staticmethod
+    def bucketize(values, ray_values, max_buckets):
+        """
+        Assign each ray to a bucket of auxiliary scene params, return the bucket labels and ray buckets.
+        """
+        unique = np.unique(values, axis=0)
+        if len(unique) <= max_buckets:
+            labels = [np.array2string(u, precision=3, separator=',') for u in unique]
+            buckets = np.array([np.nonzero(np.all(unique == v, axis=-1))[0][0] for v in ray_values])
+            return labels, buckets
+
+        edges = np.quantile(values[:, 0], np.linspace(0., 1., max_buckets + 1))
+        labels = ['[{:.3f}, {:.3f}]'.format(lo, hi) for lo, hi in zip(edges[:-1], edges[1:])]
+        buckets = np.clip(np.searchsorted(edges, ray_values[:, 0], side='right') - 1, 0, max_buckets - 1)
+        return labels, buckets
+
+    def evaluate(self, render_kwargs):
+        """
+        Render the held-out rays in one chunk.
+
+        :param render_kwargs: The keyword arguments of render() used for testing.
+        :return: dict with the overall 'psnr' and a dict 'buckets' of PSNR per auxiliary scene params bucket.
+        """
+        with torch.no_grad():
+            rgb, _, _, _ = render(self.H, self.W, self.K, chunk=self.n_rays, rays=self.rays,
+                                  aux_scene_params=self.aux_scene_params, **render_kwargs)
+            se = torch.mean((rgb - self.target) ** 2, -1)
+
+            n_buckets = len(self.bucket_labels)
+            bucket_se = torch.zeros(n_buckets).index_add_(0, self.buckets, se)
+            bucket_count = torch.zeros(n_buckets).index_add_(0, self.buckets, torch.ones_like(se))
+            mse = torch.cat([se.mean()[None], bucket_se / bucket_count.clamp(min=1)])
+            # a single device to host copy for all metrics
+            metrics = torch.stack([-10. * torch.log10(mse), torch.cat([se.new_ones(1), bucket_count])])
+            psnr, bucket_count = metrics.cpu().numpy()
+
+        return {
+            'psnr': float(psnr[0]),
+            'buckets': {label: float(p) for label, p, count in zip(self.bucket_labels, psnr[1:], bucket_count[1:])
+                        if count > 0},
+        }